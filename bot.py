@@ -4,6 +4,7 @@ bot.py - Telegram机器人主程序 (完整集成多语言菜单系统)
 集成 Freqtrade REST API + 多语言动态菜单
 """
 
+import asyncio
 import logging
 import os
 import json
@@ -20,7 +21,7 @@ from telegram.ext import (
 )
 
 # 导入自定义模块
-from database import Database
+from database import Database, AsyncDatabase
 from config_manager import ConfigManager
 from swarm_manager import SwarmManager
 from utils import (
@@ -53,12 +54,14 @@ logger = logging.getLogger(__name__)
 
 # 初始化管理器
 db = Database()
+async_db = AsyncDatabase(db)  # 处理器中的数据库调用走专用线程池，避免阻塞事件循环
 config_manager = ConfigManager()
 swarm_manager = SwarmManager()
 rate_limiter = RateLimiter(max_requests=20, time_window=60)
 MASTER_PRIVATE_KEY = os.getenv("MASTER_PRIVATE_KEY")
 TRONGRID_API_KEY = os.getenv("TRONGRID_API_KEY")
 NETWORK = os.getenv("TRON_NETWORK", "nile")  # 默
+OPERATION_LOG_RETENTION_DAYS = int(os.getenv("OPERATION_LOG_RETENTION_DAYS", "90"))
 payment_system = PaymentSystem(MASTER_PRIVATE_KEY,TRONGRID_API_KEY,NETWORK)
 menu_system = MenuSystem()  # ⭐ 初始化菜单系统
 
@@ -72,11 +75,11 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8084831161:AAGbUGzo6nyggEtVowCAjUL_w76EiMDeZ
 
 # ========== ⭐ 辅助函数 ==========
 
-def update_user_trading_status(user_id: int, is_trading: bool):
+async def update_user_trading_status(user_id: int, is_trading: bool):
     """更新用户交易状态到数据库"""
     try:
         status = '运行中' if is_trading else '停止'
-        db.update_user_status(user_id, status)
+        await async_db.update_user_status(user_id, status)
         logger.info(f"用户 {user_id} 状态更新为: {status}")
     except Exception as e:
         logger.error(f"更新用户状态失败: {e}")
@@ -112,24 +115,25 @@ async def safe_edit_message(msg, text: str, **kwargs):
 
 # ========== ⭐ 用户状态管理 ==========
 
-def get_user_status(user_id: int) -> tuple:
+async def get_user_status(user_id: int) -> tuple:
     """
     获取用户状态和邀请码状态
 
     Returns:
         (UserStatus, has_invite_code)
     """
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         return UserStatus.NOT_REGISTERED, False
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
 
     # 检查是否有API密钥
     if not user.get('api_key'):
         return UserStatus.REGISTERED, False
 
     # ⭐ 检查是否已使用邀请码
-    has_invite_code = bool(db.get_user_invite_code(user_id))
+    has_invite_code = bool(user_ctx['invite_code'])
 
     # 检查交易状态
     status = user.get('status', '停止')
@@ -275,7 +279,7 @@ async def use_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """使用邀请码"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -320,7 +324,7 @@ async def use_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = await update.message.reply_text("🔄 正在验证邀请码...")
 
     # 应用邀请码
-    success, discount, message, user_code = db.apply_invite_code(user_id, code)
+    success, discount, message, user_code = await async_db.apply_invite_code(user_id, code)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -355,7 +359,7 @@ async def use_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.edit_text(response, parse_mode='HTML')
 
         # ⭐ 自动更新主菜单 - 显示"我的邀请码"按钮
-        user_status, _ = get_user_status(user_id)
+        user_status, _ = await get_user_status(user_id)
         keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code=True)
 
         if lang == "zh":
@@ -383,12 +387,12 @@ async def view_invite_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示邀请码子菜单"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
     # 检查是否已使用邀请码
-    user_code = db.get_user_invite_code(user_id)
+    user_code = await async_db.get_user_invite_code(user_id)
 
     if not user_code:
         # 还没使用邀请码,引导用户使用
@@ -439,12 +443,12 @@ async def my_invite_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看我的邀请统计 (子菜单入口)"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
     # 获取邀请统计
-    stats = db.get_invite_stats(user_id)
+    stats = await async_db.get_invite_stats(user_id)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -524,13 +528,13 @@ async def my_invitees_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看我邀请的用户列表 (子菜单入口)"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
     # 获取邀请列表
-    invitees = db.get_user_invitees(user_id, limit=20)
-    stats = db.get_invite_stats(user_id)
+    invitees = await async_db.get_user_invitees(user_id, limit=20)
+    stats = await async_db.get_invite_stats(user_id)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -610,13 +614,13 @@ async def share_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """分享邀请码"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
     # 获取用户邀请码
-    user_code = db.get_user_invite_code(user_id)
-    stats = db.get_invite_stats(user_id)
+    user_code = await async_db.get_user_invite_code(user_id)
+    stats = await async_db.get_invite_stats(user_id)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -690,13 +694,13 @@ async def view_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
     # 检查是否绑定API
-    user = db.get_user_by_telegram_id(user_id)
-    if not user.get('api_key'):
+    if not user_ctx['user'].get('api_key'):
         lang = menu_system.get_user_language(user_id).value
         if lang == "zh":
             await update.message.reply_text(
@@ -732,10 +736,10 @@ async def view_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """启动命令 - 显示动态主菜单"""
     user_id = update.message.from_user.id
-    #user_status = get_user_status(user_id)
+    #user_status = await get_user_status(user_id)
 
     # ⭐ 获取动态键盘
-    user_status, has_invite_code = get_user_status(user_id)  # ⭐ 获取邀请码状态
+    user_status, has_invite_code = await get_user_status(user_id)  # ⭐ 获取邀请码状态
 
     # 生成主菜单键盘
     keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)  # ⭐ 传入参数
@@ -791,17 +795,17 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ 操作过于频繁,请稍后再试")
         return
 
-    if db.user_exists(user_id):
+    if await async_db.user_exists(user_id):
         await update.message.reply_text(f"ℹ️ 用户 {user_name} 已经注册过了!")
         logger.info(f"用户 {user_id} 尝试重复注册")
     else:
-        new_user_id = db.insert_user(user_id, user_name)
+        new_user_id = await async_db.insert_user(user_id, user_name)
         if new_user_id:
             # 创建用户目录
             config_manager.create_user_directory(user_id)
 
             # ⭐ 更新菜单
-            user_status, has_invite_code = get_user_status(user_id)
+            user_status, has_invite_code = await get_user_status(user_id)
             keyboard = menu_system.get_main_keyboard(user_id, user_status)
 
             lang = menu_system.get_user_language(user_id).value
@@ -845,7 +849,7 @@ async def bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
     # 检查用户是否注册
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -890,14 +894,14 @@ async def bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # 保存API到数据库
-    db.update_user_api(user_id, secret, api_key)
+    await async_db.update_user_api(user_id, secret, api_key)
 
     # 创建用户配置文件
     if config_manager.create_user_config(user_id, api_key, secret):
         api_port = config_manager.get_user_api_port(user_id)
 
         # ⭐ 更新菜单
-        user_status, has_invite_code = get_user_status(user_id)
+        user_status, has_invite_code = await get_user_status(user_id)
         keyboard = menu_system.get_main_keyboard(user_id, user_status)
 
         lang = menu_system.get_user_language(user_id).value
@@ -949,7 +953,7 @@ async def switch_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     success_msg = menu_system.switch_language(user_id)
 
     # 更新菜单
-    user_status, has_invite_code = get_user_status(user_id)
+    user_status, has_invite_code = await get_user_status(user_id)
     keyboard = menu_system.get_main_keyboard(user_id, user_status)
 
     await update.message.reply_text(
@@ -965,7 +969,7 @@ async def view_status_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示状态查看子菜单"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -983,7 +987,7 @@ async def view_config_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示配置管理子菜单"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1000,7 +1004,7 @@ async def view_config_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """返回主菜单"""
     user_id = update.message.from_user.id
-    user_status, has_invite_code = get_user_status(user_id)  # ⭐ 获取邀请码状态
+    user_status, has_invite_code = await get_user_status(user_id)  # ⭐ 获取邀请码状态
     keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
     lang = menu_system.get_user_language(user_id).value
@@ -1025,15 +1029,20 @@ async def my_payment_address(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """查看我的充值地址和订阅状态"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    # 获取用户地址
-    address = payment_system.get_user_address(user_id)
+    # 获取用户地址（缓存命中时不经过线程池）
+    address = payment_system.address_cache.get(user_id)
+    if address is None:
+        address = await async_db.run(payment_system.get_user_address, user_id)
+
+    # 用户可能即将转账，通知支付监控高频轮询该地址（后台写入，不阻塞回复）
+    context.application.create_task(async_db.watch_payment_address(user_id))
 
     # 获取订阅状态
-    status = payment_system.get_subscription_status(user_id)
+    status = await async_db.run(payment_system.get_subscription_status, user_id)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -1105,12 +1114,13 @@ async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看订阅详情"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    subscription = db.get_user_subscription(user_id)
-    balance = db.get_user_balance(user_id)
+    subscription = user_ctx['subscription']
+    balance = user_ctx['balance']
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -1119,7 +1129,7 @@ async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += f"💰 账户余额: <b>{balance:.2f} USDT</b>\n\n"
 
         if subscription:
-            is_valid, _ = db.is_subscription_valid(user_id)
+            is_valid, _ = await async_db.is_subscription_valid(user_id)
             status_emoji = "✅" if is_valid else "❌"
 
             end_date = datetime.fromisoformat(subscription['end_date'])
@@ -1151,7 +1161,7 @@ async def subscription_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += f"💰 Account Balance: <b>{balance:.2f} USDT</b>\n\n"
 
         if subscription:
-            is_valid, _ = db.is_subscription_valid(user_id)
+            is_valid, _ = await async_db.is_subscription_valid(user_id)
             status_emoji = "✅" if is_valid else "❌"
 
             end_date = datetime.fromisoformat(subscription['end_date'])
@@ -1186,11 +1196,11 @@ async def view_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看订阅套餐"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    plans = db.get_all_plans()
+    plans = await async_db.get_all_plans()
     lang = menu_system.get_user_language(user_id).value
 
     if lang == "zh":
@@ -1233,11 +1243,11 @@ async def recharge_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看充值记录"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    records = db.get_user_recharge_records(user_id, limit=10)
+    records = await async_db.get_user_recharge_records(user_id, limit=10)
 
     lang = menu_system.get_user_language(user_id).value
 
@@ -1291,7 +1301,7 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"📍 [STEP 1] 用户 {user_id} 准备启动服务")
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         logger.info(f"📍 [STEP 1.1] 用户 {user_id} 不存在")
         await update.message.reply_text("❌ 请先注册!")
         return
@@ -1308,7 +1318,7 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ⭐ 检查订阅状态
     try:
-        status = payment_system.get_subscription_status(user_id)
+        status = await async_db.run(payment_system.get_subscription_status, user_id)
         logger.info(f"📍 [STEP 3.1] 用户 {user_id} 订阅状态: {status}")
     except Exception as e:
         logger.error(f"❌ [STEP 3.1 ERROR] 获取订阅状态失败: {e}", exc_info=True)
@@ -1351,7 +1361,7 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 检查是否绑定API
     try:
-        user = db.get_user_by_telegram_id(user_id)
+        user = await async_db.get_user_by_telegram_id(user_id)
         logger.info(f"📍 [STEP 4.1] 用户 {user_id} 数据: {user.get('api_key', 'None')[:10]}...")
     except Exception as e:
         logger.error(f"❌ [STEP 4.1 ERROR] 获取用户数据失败: {e}", exc_info=True)
@@ -1392,7 +1402,7 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"📍 [STEP 8] 用户 {user_id} 更新交易状态")
 
             # ⭐⭐ 关键修复: 立即更新数据库状态
-            update_user_trading_status(user_id, True)
+            await update_user_trading_status(user_id, True)
 
             logger.info(f"📍 [STEP 8.1] 用户 {user_id} 交易状态已更新")
 
@@ -1423,7 +1433,7 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"📍 [STEP 9] 用户 {user_id} 获取菜单键盘")
 
             # ⭐ 更新菜单为交易状态
-            user_status, has_invite_code = get_user_status(user_id)
+            user_status, has_invite_code = await get_user_status(user_id)
             keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
             logger.info(f"📍 [STEP 9.1] 用户 {user_id} 准备编辑消息")
@@ -1436,10 +1446,10 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"📍 [STEP 8 FAILED] 用户 {user_id} 启动失败")
 
             # 启动失败，确保状态是停止
-            update_user_trading_status(user_id, False)
+            await update_user_trading_status(user_id, False)
 
             # 更新菜单
-            user_status, has_invite_code = get_user_status(user_id)
+            user_status, has_invite_code = await get_user_status(user_id)
             keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
             await safe_edit_message(
@@ -1453,10 +1463,10 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"❌ [EXCEPTION] 启动机器人时发生异常: {e}", exc_info=True)
 
         # 确保状态正确
-        update_user_trading_status(user_id, False)
+        await update_user_trading_status(user_id, False)
 
         # 恢复菜单
-        user_status, has_invite_code = get_user_status(user_id)
+        user_status, has_invite_code = await get_user_status(user_id)
         keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
         await safe_edit_message(
@@ -1470,7 +1480,7 @@ async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """停止交易机器人(改进版 - 确保状态同步)"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1486,10 +1496,10 @@ async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # ⭐⭐ 关键修复: 无论成功与否，更新数据库状态
         if success or "已停止" in message or "不存在" in message:
-            update_user_trading_status(user_id, False)
+            await update_user_trading_status(user_id, False)
 
         # ⭐ 更新菜单为停止状态
-        user_status, has_invite_code = get_user_status(user_id)
+        user_status, has_invite_code = await get_user_status(user_id)
         keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
         if success:
@@ -1511,10 +1521,10 @@ async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"停止机器人时发生异常: {e}")
 
         # 假设停止成功，更新状态
-        update_user_trading_status(user_id, False)
+        await update_user_trading_status(user_id, False)
 
         # 恢复菜单
-        user_status, has_invite_code = get_user_status(user_id)
+        user_status, has_invite_code = await get_user_status(user_id)
         keyboard = menu_system.get_main_keyboard(user_id, user_status, has_invite_code)
 
         await safe_edit_message(
@@ -1528,7 +1538,7 @@ async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """重启交易机器人"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1547,13 +1557,14 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看状态"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
     msg = await update.message.reply_text("🔄 正在获取状态...")
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
     status_info = swarm_manager.get_service_status(user_id)
 
     lang = menu_system.get_user_language(user_id).value
@@ -1593,7 +1604,7 @@ async def view_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看日志"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1617,11 +1628,12 @@ async def ft_profit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看利润统计（增强版 - 包含持仓盈亏）"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
     if not user.get('api_key'):
         await update.message.reply_text("❌ 请先绑定API!\n\n使用 /bind 命令绑定")
         return
@@ -1667,11 +1679,12 @@ async def ft_performance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示各币种性能（增强版 - 双语支持）"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
     if not user.get('api_key'):
         await update.message.reply_text("❌ 请先绑定API!\n\n使用 /bind 命令绑定")
         return
@@ -1707,11 +1720,12 @@ async def ft_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看当前持仓（增强版 - 显示方向和持仓时长）"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
     if not user.get('api_key'):
         await update.message.reply_text("❌ 请先绑定API!\n\n使用 /bind 命令绑定")
         return
@@ -1743,11 +1757,12 @@ async def ft_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看账户余额"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    user_ctx = await async_db.load_user_context(user_id)
+    if not user_ctx:
         await update.message.reply_text("❌ 请先注册!")
         return
 
-    user = db.get_user_by_telegram_id(user_id)
+    user = user_ctx['user']
     if not user.get('api_key'):
         await update.message.reply_text("❌ 请先绑定API!\n\n使用 /bind 命令绑定")
         return
@@ -1783,7 +1798,7 @@ async def ft_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示每日统计"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1808,7 +1823,7 @@ async def ft_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示交易计数"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1838,7 +1853,7 @@ async def ft_version(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示版本信息"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1857,7 +1872,7 @@ async def ft_start_trading(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """通过API启动交易"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1876,7 +1891,7 @@ async def ft_stop_trading(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """通过API停止交易"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1897,7 +1912,7 @@ async def ft_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """执行自定义 Freqtrade 命令(通过 Docker)"""
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         await update.message.reply_text("❌ 请先注册!")
         return
 
@@ -1952,7 +1967,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
 
     if query.data == "config_view":
-        if not db.user_exists(user_id):
+        if not await async_db.user_exists(user_id):
             await query.message.reply_text("❌ 请先注册!")
             return
 
@@ -2042,8 +2057,8 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 尝试恢复用户菜单
         try:
-            if user_id and db.user_exists(user_id):
-                user_status, has_invite_code = get_user_status(user_id)
+            if user_id and await async_db.user_exists(user_id):
+                user_status, has_invite_code = await get_user_status(user_id)
                 keyboard = menu_system.get_main_keyboard(
                     user_id, user_status, has_invite_code
                 )
@@ -2068,6 +2083,46 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
 
 
+# ========== 订阅过期处理 ==========
+
+def stop_expired_services(user_ids: List[int]):
+    """订阅过期监听器：停止失去有效订阅且仍在运行的交易服务（在线程池中执行）"""
+    for user_id in user_ids:
+        user = db.get_user_by_telegram_id(user_id)
+        if not user or user.get('status') != '运行中':
+            continue
+
+        success, message = swarm_manager.stop_service(user_id)
+        db.log_operation(user_id, "subscription_expired", f"订阅过期，停止服务: {message}")
+        logger.info(f"用户 {user_id} 订阅过期，停止服务: {message}")
+
+
+async def daily_maintenance_loop():
+    """每日维护：归档过期的操作日志，补充用户邀请码池，清理过期的充值地址轮询提示"""
+    while True:
+        try:
+            await async_db.archive_operation_logs(OPERATION_LOG_RETENTION_DAYS)
+        except Exception as e:
+            logger.error(f"操作日志归档失败: {e}")
+        try:
+            await async_db.refill_invite_code_pool()
+        except Exception as e:
+            logger.error(f"补充邀请码池失败: {e}")
+        try:
+            await async_db.clear_expired_address_watch()
+        except Exception as e:
+            logger.error(f"清理充值地址轮询提示失败: {e}")
+        await asyncio.sleep(24 * 3600)
+
+
+async def post_init(application: Application):
+    """应用启动后启动后台任务"""
+    payment_system.add_expiry_listener(stop_expired_services)
+    application.create_task(payment_system.expiry_sweep_loop())
+    application.create_task(daily_maintenance_loop())
+    application.create_task(payment_system.address_pregenerate_loop())
+
+
 # ========== 主函数 ==========
 
 def main():
@@ -2083,7 +2138,7 @@ def main():
 
     # 创建应用
     try:
-        app = Application.builder().token(BOT_TOKEN).build()
+        app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
 
         # ========== 基础命令 ==========
         app.add_handler(CommandHandler("start", start))
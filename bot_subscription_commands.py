@@ -10,10 +10,11 @@ bot_subscription_commands.py - 优化后的订阅命令处理（支持中英双
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from database import Database
+from database import Database, AsyncDatabase
 from menu_system import MenuSystem
 
 db = Database()
+async_db = AsyncDatabase(db)
 menu_system = None
 
 
@@ -31,14 +32,14 @@ async def view_plans_flexible(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     user_id = update.message.from_user.id
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         lang = menu_system.get_user_language(user_id).value
         error_msg = "❌ 请先注册！" if lang == "zh" else "❌ Please register first!"
         await update.message.reply_text(error_msg)
         return
 
-    plans = db.get_all_plans()
-    balance = db.get_user_balance(user_id)
+    plans = await async_db.get_all_plans()
+    balance = await async_db.get_user_balance(user_id)
     lang = menu_system.get_user_language(user_id).value
 
     if lang == "zh":
@@ -115,7 +116,7 @@ async def subscribe_flexible(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.message.from_user.id
     lang = menu_system.get_user_language(user_id).value
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         error_msg = "❌ 请先使用 /register 注册" if lang == "zh" else "❌ Please use /register first"
         await update.message.reply_text(error_msg)
         return
@@ -149,7 +150,7 @@ async def subscribe_flexible(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         # 预览订阅信息
-        tier_info = db.get_tier_by_payment(payment_amount)
+        tier_info = await async_db.get_tier_by_payment(payment_amount)
 
         if not tier_info:
             if lang == "zh":
@@ -165,7 +166,7 @@ async def subscribe_flexible(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         # 显示订阅预览
-        balance = db.get_user_balance(user_id)
+        balance = await async_db.get_user_balance(user_id)
 
         if lang == "zh":
             message = "📋 <b>订阅预览</b>\n" + "=" * 40 + "\n\n"
@@ -251,12 +252,12 @@ async def handle_subscription_callback(update: Update, context: ContextTypes.DEF
             payment_amount = float(callback_data.split("_")[2])
 
             # 执行订阅
-            success, message = db.create_subscription_flexible(user_id, payment_amount, days=30)
+            success, message = await async_db.create_subscription_flexible(user_id, payment_amount, days=30)
 
             if success:
                 # 获取新的订阅信息
-                subscription = db.get_user_subscription(user_id)
-                balance = db.get_user_balance(user_id)
+                subscription = await async_db.get_user_subscription(user_id)
+                balance = await async_db.get_user_balance(user_id)
 
                 if lang == "zh":
                     result_message = "✅ <b>订阅成功！</b>\n" + "=" * 40 + "\n\n"
@@ -324,7 +325,7 @@ async def calculate_quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(error_msg)
             return
 
-        plans = db.get_all_plans()
+        plans = await async_db.get_all_plans()
 
         if lang == "zh":
             message = f"💰 <b>支付金额: {payment_amount} USDT</b>\n"
@@ -393,20 +394,20 @@ async def my_subscription_flexible(update: Update, context: ContextTypes.DEFAULT
     user_id = update.message.from_user.id
     lang = menu_system.get_user_language(user_id).value
 
-    if not db.user_exists(user_id):
+    if not await async_db.user_exists(user_id):
         error_msg = "❌ 请先注册！" if lang == "zh" else "❌ Please register first!"
         await update.message.reply_text(error_msg)
         return
 
-    subscription = db.get_user_subscription(user_id)
-    balance = db.get_user_balance(user_id)
+    subscription = await async_db.get_user_subscription(user_id)
+    balance = await async_db.get_user_balance(user_id)
 
     if lang == "zh":
         message = "📋 <b>我的订阅</b>\n" + "=" * 40 + "\n\n"
         message += f"💰 <b>账户余额:</b> {balance:.2f} USDT\n\n"
 
         if subscription:
-            is_valid, _ = db.is_subscription_valid(user_id)
+            is_valid, _ = await async_db.is_subscription_valid(user_id)
             status_emoji = "✅" if is_valid else "❌"
 
             from datetime import datetime
@@ -449,7 +450,7 @@ async def my_subscription_flexible(update: Update, context: ContextTypes.DEFAULT
         message += f"💰 <b>Account Balance:</b> {balance:.2f} USDT\n\n"
 
         if subscription:
-            is_valid, _ = db.is_subscription_valid(user_id)
+            is_valid, _ = await async_db.is_subscription_valid(user_id)
             status_emoji = "✅" if is_valid else "❌"
 
             from datetime import datetime
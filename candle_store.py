@@ -0,0 +1,160 @@
+"""
+candle_store.py - 本地 K 线存储
+每个 交易对/周期 一个只追加的二进制文件（定长记录），用 numpy memmap 读取，
+重启后无需再从交易所拉取历史数据；支持按时间范围零拷贝切片和离线 CSV 回填
+"""
+
+import logging
+import os
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# 一根 K 线的定长记录
+CANDLE_DTYPE = np.dtype([
+    ('open_time', '<i8'),   # 开盘时间 (ms)
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+
+
+class CandleStore:
+    """按 交易对/周期 分文件的只追加 K 线存储"""
+
+    def __init__(self, root: str = "trend_data"):
+        self.root = root
+        self._locks = {}
+        self._locks_guard = Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, symbol: str, timeframe: str) -> str:
+        return os.path.join(self.root, f"{symbol}_{timeframe}.ohlcv")
+
+    def _lock(self, symbol: str, timeframe: str) -> Lock:
+        with self._locks_guard:
+            return self._locks.setdefault((symbol, timeframe), Lock())
+
+    def load(self, symbol: str, timeframe: str) -> np.ndarray:
+        """
+        以只读 memmap 打开全部 K 线（零拷贝）
+
+        返回: CANDLE_DTYPE 结构化数组，按 open_time 升序；文件不存在时返回空数组
+        """
+        path = self.path(symbol, timeframe)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        # 忽略写入中断留下的半条记录
+        count = size // CANDLE_DTYPE.itemsize
+        if count == 0:
+            return np.empty(0, dtype=CANDLE_DTYPE)
+        return np.memmap(path, dtype=CANDLE_DTYPE, mode='r', shape=(count,))
+
+    def tail(self, symbol: str, timeframe: str, n: int) -> np.ndarray:
+        """最后 n 根 K 线"""
+        return self.load(symbol, timeframe)[-n:]
+
+    def range(self, symbol: str, timeframe: str, start=None, end=None) -> np.ndarray:
+        """
+        开盘时间在 [start, end) 内的 K 线（memmap 切片，零拷贝）
+
+        参数:
+            start / end: 毫秒时间戳，为空表示不限
+        """
+        candles = self.load(symbol, timeframe)
+        lo, hi = self.bounds(candles, start, end)
+        return candles[lo:hi]
+
+    @staticmethod
+    def bounds(candles: np.ndarray, start=None, end=None):
+        """[start, end) 在 candles 中的下标区间，二分查找"""
+        open_time = candles['open_time']
+        lo = int(np.searchsorted(open_time, start, 'left')) if start is not None else 0
+        hi = int(np.searchsorted(open_time, end, 'left')) if end is not None else len(candles)
+        return lo, max(lo, hi)
+
+    def last_open_time(self, symbol: str, timeframe: str):
+        """最后一根已存储 K 线的开盘时间，没有数据时返回 None"""
+        candles = self.tail(symbol, timeframe, 1)
+        return int(candles['open_time'][0]) if len(candles) else None
+
+    def append(self, symbol: str, timeframe: str, rows) -> int:
+        """
+        追加已收盘的 K 线
+
+        参数:
+            rows: [(open_time, open, high, low, close, volume), ...]，按时间升序
+
+        返回: 实际写入的条数（早于或等于最后一根的记录会被跳过）
+        """
+        with self._lock(symbol, timeframe):
+            last = self.last_open_time(symbol, timeframe)
+            if last is not None:
+                rows = [row for row in rows if row[0] > last]
+            if not rows:
+                return 0
+
+            data = np.array([tuple(row) for row in rows], dtype=CANDLE_DTYPE)
+            path = self.path(symbol, timeframe)
+            with open(path, 'ab') as f:
+                # 先截掉可能存在的半条记录，保证定长对齐
+                f.truncate(os.path.getsize(path) // CANDLE_DTYPE.itemsize * CANDLE_DTYPE.itemsize)
+                data.tofile(f)
+            return len(data)
+
+    def backfill(self, symbol: str, timeframe: str, candles: np.ndarray) -> int:
+        """
+        合并一批历史 K 线（可早于已有数据），按 open_time 去重排序后整体重写
+
+        先写临时文件再原子替换；已打开的 memmap 仍指向旧文件，不受影响
+
+        返回: 新增的条数
+        """
+        candles = np.asarray(candles, dtype=CANDLE_DTYPE)
+        with self._lock(symbol, timeframe):
+            existing = np.array(self.load(symbol, timeframe))
+            merged = np.concatenate([existing, candles])
+            # 已有数据优先（stable 排序后保留每个 open_time 的第一条）
+            order = np.argsort(merged['open_time'], kind='stable')
+            merged = merged[order]
+            keep = np.ones(len(merged), dtype=bool)
+            keep[1:] = merged['open_time'][1:] != merged['open_time'][:-1]
+            merged = merged[keep]
+
+            path = self.path(symbol, timeframe)
+            tmp_path = f"{path}.tmp"
+            merged.tofile(tmp_path)
+            os.replace(tmp_path, path)
+
+        added = len(merged) - len(existing)
+        logger.info(f"📥 {symbol} {timeframe} 回填 {added} 根 K 线，共 {len(merged)} 根")
+        return added
+
+
+def read_ohlcv_csv(path: str, chunksize: int = 1_000_000) -> np.ndarray:
+    """
+    读取币安格式的 K 线 CSV（data.binance.vision 导出，前六列为 open_time,open,high,low,close,volume）
+
+    有无表头均可；微秒时间戳自动转换为毫秒
+    """
+    with open(path) as f:
+        first = f.readline().split(',')[0].strip()
+    header = 0 if not first.lstrip('-').isdigit() else None
+
+    parts = []
+    for chunk in pd.read_csv(path, header=header, usecols=range(6), chunksize=chunksize):
+        chunk.columns = CANDLE_DTYPE.names
+        data = np.empty(len(chunk), dtype=CANDLE_DTYPE)
+        for name in CANDLE_DTYPE.names:
+            data[name] = chunk[name].to_numpy()
+        parts.append(data)
+
+    candles = np.concatenate(parts) if parts else np.empty(0, dtype=CANDLE_DTYPE)
+    # 2025 年起币安现货数据使用微秒时间戳
+    micro = candles['open_time'] > 10 ** 14
+    candles['open_time'][micro] //= 1000
+    return candles
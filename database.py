@@ -19,6 +19,18 @@ database.py - 数据库管理模块（灵活订阅优化版）
 
 import sqlite3
 import os
+import asyncio
+import functools
+import threading
+import time
+import atexit
+import glob
+import random
+import string
+import weakref
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from uuid import uuid4
 from typing import Optional, List, Tuple, Dict
 from datetime import datetime, timedelta
@@ -28,22 +40,766 @@ logger = logging.getLogger(__name__)
 
 DATABASE_FILE = "user_data/users.db"
 
+# 每个连接建立时执行的 PRAGMA（WAL 允许 bot / 支付监控 / 通知服务并发读写）
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",       # 16MB 页缓存
+    "PRAGMA mmap_size=268435456",     # 256MB 内存映射
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class PooledConnection:
+    """
+    连接池中的连接代理
+
+    行为与 sqlite3.Connection 一致，区别在于 close() 不会真正关闭连接，
+    而是回滚未提交的事务后归还到连接池。
+    也可作为上下文管理器使用：正常退出时提交，异常时回滚，最后归还连接。
+    """
+
+    __slots__ = ('_conn', '_pool', '_finalizer', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection, pool: 'ConnectionPool'):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_pool', pool)
+        # 调用方异常退出而没有 close() 时，代理被回收即回滚并归还连接，
+        # 不会让未提交的写事务一直持有 RESERVED 锁
+        finalizer = weakref.finalize(self, pool.release, conn)
+        finalizer.atexit = False
+        object.__setattr__(self, '_finalizer', finalizer)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # row_factory 等属性直接设置到底层连接上
+        setattr(self._conn, name, value)
+
+    def close(self):
+        """归还连接到连接池（重复调用无效果）"""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+
+class _PoolConnection(sqlite3.Connection):
+    """sqlite3.Connection 本身不支持弱引用，子类化后连接池才能弱引用跟踪"""
+
+
+class ConnectionPool:
+    """
+    SQLite 连接池
+
+    每个线程维护自己的空闲连接列表，连接在同一线程内复用，
+    避免每次查询都重新 connect / 设置 PRAGMA / 关闭。
+    嵌套调用（例如外层方法持有连接时内层方法再取连接）会拿到不同的连接，
+    与原先每次新建连接的语义一致。
+    """
+
+    def __init__(self, db_file: str, max_idle_per_thread: int = 4, timeout: float = 30.0):
+        self.db_file = db_file
+        self.max_idle_per_thread = max_idle_per_thread
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 弱引用跟踪：随线程退出而丢弃的空闲连接可以被回收关闭
+        self._connections = weakref.WeakSet()
+
+    def _idle(self) -> List[sqlite3.Connection]:
+        idle = getattr(self._local, 'idle', None)
+        if idle is None:
+            idle = self._local.idle = []
+        return idle
+
+    def _connect(self) -> sqlite3.Connection:
+        """新建连接并设置 PRAGMA"""
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False,
+                               factory=_PoolConnection)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections.add(conn)
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        """获取连接（优先复用当前线程的空闲连接）"""
+        idle = self._idle()
+        conn = idle.pop() if idle else self._connect()
+        return PooledConnection(conn, self)
+
+    def release(self, conn: sqlite3.Connection):
+        """归还连接：回滚未提交事务并重置 row_factory"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.Error as e:
+            logger.warning(f"归还连接失败，丢弃该连接: {e}")
+            self._discard(conn)
+            return
+
+        idle = self._idle()
+        if len(idle) < self.max_idle_per_thread:
+            idle.append(conn)
+        else:
+            self._discard(conn)
+
+    def _discard(self, conn: sqlite3.Connection):
+        with self._lock:
+            self._connections.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """关闭连接池中的所有连接（进程退出时调用）"""
+        with self._lock:
+            connections, self._connections = list(self._connections), weakref.WeakSet()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(db_file: str = DATABASE_FILE) -> ConnectionPool:
+    """获取数据库文件对应的连接池（同一进程内所有 Database 实例共享）"""
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_file)
+        return pool
+
+
+class UserContextCache:
+    """
+    用户上下文短期缓存（按用户）
+
+    load_user_context() 的结果缓存 ttl 秒，写操作通过 invalidate() 立即失效。
+    每次失效都会增加该用户的版本号，查询期间发生写入时不会把旧结果写回缓存。
+    """
+
+    def __init__(self, ttl: float = 2.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[float, Optional[Dict]]] = {}
+        self._versions: Dict[int, int] = {}
+
+    def get(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        """返回 (是否命中, 上下文)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[user_id]
+                return False, None
+            return True, value
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def set(self, user_id: int, value: Optional[Dict], version: int):
+        """写入缓存（读取期间已被失效时放弃写入）"""
+        with self._lock:
+            if self._versions.get(user_id, 0) != version:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+_context_caches: Dict[str, UserContextCache] = {}
+
+
+def get_user_context_cache(db_file: str = DATABASE_FILE) -> UserContextCache:
+    """获取数据库文件对应的用户上下文缓存（同一进程内所有 Database 实例共享）"""
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        cache = _context_caches.get(key)
+        if cache is None:
+            cache = _context_caches[key] = UserContextCache()
+        return cache
+
+
+class PlanCache:
+    """
+    订阅套餐进程内缓存
+
+    subscription_plans 只有几行且几乎不变，首次访问时整表加载，之后读取不再访问数据库；
+    套餐变更后调用 invalidate()。档位匹配使用按最低费用排序的数组 + bisect。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def get(self, loader) -> Dict:
+        """返回缓存快照，未加载时调用 loader() 读取全部套餐"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._build(loader())
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    @staticmethod
+    def _build(plans: List[Dict]) -> Dict:
+        plans = sorted(plans, key=lambda plan: plan['tier_level'])
+        by_payment = sorted(plans, key=lambda plan: (plan['min_payment'], plan['tier_level']))
+
+        # best_tier[i]: 最低费用 <= min_payments[i] 的套餐中档位最高者
+        best_tier = []
+        for plan in by_payment:
+            if not best_tier or plan['tier_level'] > best_tier[-1]['tier_level']:
+                best_tier.append(plan)
+            else:
+                best_tier.append(best_tier[-1])
+
+        return {
+            'plans': plans,
+            'by_id': {plan['id']: plan for plan in plans},
+            'min_payments': [plan['min_payment'] for plan in by_payment],
+            'best_tier': best_tier,
+        }
+
+
+_plan_caches: Dict[str, PlanCache] = {}
+
+
+def get_plan_cache(db_file: str = DATABASE_FILE) -> PlanCache:
+    """获取数据库文件对应的套餐缓存（同一进程内所有 Database 实例共享）"""
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        cache = _plan_caches.get(key)
+        if cache is None:
+            cache = _plan_caches[key] = PlanCache()
+        return cache
+
+
+class OperationLogWriter:
+    """
+    操作日志批量写入器
+
+    log_operation() 只把日志放入内存缓冲区，后台线程在缓冲区达到 max_batch 条
+    或距上次写入超过 flush_interval 秒时批量插入。进程退出时自动刷新。
+    """
+
+    def __init__(self, db_file: str, max_batch: int = 200, flush_interval: float = 1.0):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._buffer: List[Tuple[int, str, str, str]] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="operation-log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, user_id: int, operation: str, details: str = ""):
+        """写入缓冲区（时间戳取调用时刻，UTC，与 CURRENT_TIMESTAMP 格式一致）"""
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self._cond:
+            self._buffer.append((user_id, operation, details, timestamp))
+            closed = self._closed
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+        if closed:
+            # 写入器已关闭（后台线程已退出），直接同步写入
+            self.flush()
+
+    def flush(self) -> int:
+        """立即写入缓冲区中的日志，返回写入条数"""
+        with self._flush_lock:
+            with self._cond:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+
+            conn = get_connection_pool(self.db_file).acquire()
+            try:
+                with conn:
+                    conn.executemany('''
+                        INSERT INTO operation_logs (user_id, operation, details, timestamp)
+                        VALUES (?, ?, ?, ?)
+                    ''', rows)
+            except sqlite3.Error as e:
+                logger.error(f"写入操作日志失败: {len(rows)} 条: {e}")
+                with self._cond:
+                    self._buffer[:0] = rows
+                return 0
+            return len(rows)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._buffer) < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        """刷新剩余日志并停止后台线程"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+
+_log_writers: Dict[str, OperationLogWriter] = {}
+
+
+def get_operation_log_writer(db_file: str = DATABASE_FILE) -> OperationLogWriter:
+    """获取数据库文件对应的操作日志写入器（同一进程内所有 Database 实例共享）"""
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        writer = _log_writers.get(key)
+        if writer is None:
+            writer = _log_writers[key] = OperationLogWriter(db_file)
+        return writer
+
+
+def close_database(db_file: str = DATABASE_FILE):
+    """刷新操作日志并关闭数据库文件对应的连接（进程退出或测试结束时调用）"""
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        writer = _log_writers.pop(key, None)
+        pool = _pools.get(key)
+    if writer is not None:
+        writer.close()
+    if pool is not None:
+        pool.close_all()
+
+
+@atexit.register
+def _close_log_writers():
+    for key in list(_log_writers):
+        close_database(key)
+
+
+# 邀请码字符集（去掉易混淆的 0/O/1/I）
+INVITE_CODE_ALPHABET = ''.join(c for c in string.ascii_uppercase + string.digits if c not in '0O1I')
+# 用户邀请码池的补充目标数量
+INVITE_CODE_POOL_SIZE = 1000
+
+# 从 user_invitations / invite_rewards 重新计算邀请统计
+INVITE_STATS_REBUILD_SQL = '''
+    INSERT INTO invite_stats (inviter_user_id, invitee_count, total_reward, last_reward_at)
+    SELECT inviter_user_id, SUM(invitee_count), SUM(total_reward), MAX(last_reward_at)
+    FROM (
+        SELECT inviter_user_id, COUNT(*) AS invitee_count,
+               0 AS total_reward, NULL AS last_reward_at
+        FROM user_invitations
+        GROUP BY inviter_user_id
+        UNION ALL
+        SELECT inviter_user_id, 0, SUM(reward_amount), MAX(created_at)
+        FROM invite_rewards
+        GROUP BY inviter_user_id
+    )
+    GROUP BY inviter_user_id
+'''
+
+# 邀请奖励比例（按被邀请人原始充值金额计算）
+INVITE_REWARD_RATE = 0.10
+
+# ========== 数据库迁移 ==========
+# 每个迁移为 (版本号, 名称, SQL 列表)，按版本号递增顺序执行，已执行的版本记录在 schema_migrations 表中。
+# 新增迁移只能追加到末尾，不要修改已发布的迁移。
+MIGRATIONS = [
+    (1, 'hot_query_indexes', [
+        # get_user_subscription / check_subscription_status
+        'CREATE INDEX IF NOT EXISTS idx_user_subscriptions_user_status_end '
+        'ON user_subscriptions(user_id, status, end_date)',
+        # PaymentSystem.find_new_recharges 去重
+        'CREATE INDEX IF NOT EXISTS idx_recharge_records_user_tx '
+        'ON recharge_records(user_id, tx_hash)',
+        # get_user_recharge_records
+        'CREATE INDEX IF NOT EXISTS idx_recharge_records_user_created '
+        'ON recharge_records(user_id, created_at)',
+        # get_user_invite_rewards（覆盖索引）
+        'CREATE INDEX IF NOT EXISTS idx_invite_rewards_inviter_created '
+        'ON invite_rewards(inviter_user_id, created_at, reward_amount)',
+        # get_user_invitees 关联奖励
+        'CREATE INDEX IF NOT EXISTS idx_invite_rewards_invitee_inviter '
+        'ON invite_rewards(invitee_user_id, inviter_user_id, reward_amount)',
+        # get_user_invitees
+        'CREATE INDEX IF NOT EXISTS idx_user_invitations_inviter_created '
+        'ON user_invitations(inviter_user_id, created_at)',
+        # 操作日志按用户和时间查询
+        'CREATE INDEX IF NOT EXISTS idx_operation_logs_user_time '
+        'ON operation_logs(user_id, timestamp)',
+        # get_user_invite_code / _generate_user_invite_code
+        'CREATE INDEX IF NOT EXISTS idx_invite_codes_owner_active '
+        'ON invite_codes(owner_user_id, is_active)',
+        # get_user_invite_discount
+        'CREATE INDEX IF NOT EXISTS idx_invite_code_usage_user_used '
+        'ON invite_code_usage(user_id, used_at)',
+    ]),
+    (2, 'subscription_expiry_index', [
+        # expire_overdue_subscriptions 批量过期扫描
+        'CREATE INDEX IF NOT EXISTS idx_user_subscriptions_status_end '
+        'ON user_subscriptions(status, end_date)',
+    ]),
+    (3, 'invite_stats', [
+        # 邀请统计物化表，由 apply_invite_code / use_invite_code / 邀请奖励写入时同步维护
+        '''
+        CREATE TABLE IF NOT EXISTS invite_stats (
+            inviter_user_id INTEGER PRIMARY KEY,
+            invitee_count INTEGER NOT NULL DEFAULT 0,
+            total_reward REAL NOT NULL DEFAULT 0,
+            last_reward_at TIMESTAMP
+        )
+        ''',
+        # get_invite_leaderboard
+        'CREATE INDEX IF NOT EXISTS idx_invite_stats_leaderboard '
+        'ON invite_stats(invitee_count DESC, total_reward DESC)',
+        # 从源数据回填
+        INVITE_STATS_REBUILD_SQL,
+    ]),
+    (4, 'balance_ledger', [
+        # 余额流水（只追加），user_balance.balance 为流水累计值的缓存
+        '''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            reason TEXT NOT NULL,
+            ref TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_balance_ledger_user '
+        'ON balance_ledger(user_id, id)',
+        # 现有余额记为期初流水
+        '''
+        INSERT INTO balance_ledger (user_id, amount, balance_after, reason)
+        SELECT user_id, balance, balance, 'opening'
+        FROM user_balance
+        WHERE balance != 0
+        ''',
+    ]),
+    (5, 'operation_logs_archive_index', [
+        # archive_operation_logs 按时间范围迁移
+        'CREATE INDEX IF NOT EXISTS idx_operation_logs_time '
+        'ON operation_logs(timestamp)',
+    ]),
+    (6, 'invite_code_pool', [
+        # 预生成的用户邀请码，create_user_invite_code 按 id 顺序取用
+        '''
+        CREATE TABLE IF NOT EXISTS invite_code_pool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL UNIQUE
+        )
+        ''',
+    ]),
+    (7, 'chain_checkpoints', [
+        # 链上扫描进度（合约事件扫描已处理到的区块），重启后从检查点继续
+        '''
+        CREATE TABLE IF NOT EXISTS chain_checkpoints (
+            name TEXT PRIMARY KEY,
+            block_number INTEGER NOT NULL DEFAULT 0,
+            block_timestamp INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (8, 'address_scan_cursors', [
+        # 逐地址轮询的增量游标：每个充值地址已处理到的最新转账区块时间（毫秒）
+        '''
+        CREATE TABLE IF NOT EXISTS address_scan_cursors (
+            address TEXT PRIMARY KEY,
+            last_timestamp INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (9, 'recharge_queue', [
+        # 充值结算队列：检测到的链上充值先入队（tx_hash 唯一），由结算 worker 在单个事务中入账
+        '''
+        CREATE TABLE IF NOT EXISTS recharge_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_hash TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            address TEXT,
+            amount REAL NOT NULL,
+            block_timestamp INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            locked_at TIMESTAMP,
+            recharge_record_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # claim_recharges 按状态取最早的任务
+        'CREATE INDEX IF NOT EXISTS idx_recharge_queue_status '
+        'ON recharge_queue(status, id)',
+    ]),
+    (10, 'address_watch', [
+        # 充值地址高频轮询提示：用户查看充值地址后，支付监控在 hot_until（Unix 秒）之前高频轮询
+        '''
+        CREATE TABLE IF NOT EXISTS address_watch (
+            user_id INTEGER PRIMARY KEY,
+            hot_until REAL NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (11, 'recharge_queue_per_user', [
+        # 一笔交易可能同时转给多个受监控地址（批量转账），去重键改为 (tx_hash, user_id)，
+        # 否则第二个用户的入账会被 tx_hash 唯一约束静默忽略。SQLite 不能修改约束，只能重建表
+        '''
+        CREATE TABLE recharge_queue_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_hash TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            address TEXT,
+            amount REAL NOT NULL,
+            block_timestamp INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            locked_at TIMESTAMP,
+            recharge_record_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (tx_hash, user_id)
+        )
+        ''',
+        'INSERT INTO recharge_queue_new SELECT * FROM recharge_queue',
+        'DROP TABLE recharge_queue',
+        'ALTER TABLE recharge_queue_new RENAME TO recharge_queue',
+        'CREATE INDEX IF NOT EXISTS idx_recharge_queue_status '
+        'ON recharge_queue(status, id)',
+    ]),
+]
+
+# ========== 热点查询 ==========
+# 方法与 HOT_QUERIES 共用同一份 SQL，执行计划检查覆盖的就是实际运行的语句
+
+SQL_USER_SUBSCRIPTION = '''
+    SELECT us.id, us.plan_id, us.tier_level, us.monthly_rate, us.payment_amount,
+           us.actual_capital, us.start_date, us.end_date, us.status, sp.plan_name
+    FROM user_subscriptions us
+    JOIN subscription_plans sp ON us.plan_id = sp.id
+    WHERE us.user_id = ? AND us.status = 'active'
+    ORDER BY us.end_date DESC
+    LIMIT 1
+'''
+
+# {placeholders}: 每批 tx_hash 的 ?,?,... 占位符
+SQL_PROCESSED_TX_HASHES = '''
+    SELECT tx_hash FROM recharge_records
+    WHERE user_id = ? AND tx_hash IN ({placeholders})
+'''
+
+SQL_USER_RECHARGE_RECORDS = '''
+    SELECT id, amount, tx_hash, status, created_at, verified_at
+    FROM recharge_records
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+'''
+
+SQL_INVITE_LEADERBOARD = '''
+    SELECT s.inviter_user_id, u.name, s.invitee_count, s.total_reward
+    FROM invite_stats s
+    JOIN users u ON u.user_id = s.inviter_user_id
+    WHERE s.invitee_count > 0
+    ORDER BY s.invitee_count DESC, s.total_reward DESC
+    LIMIT ?
+'''
+
+SQL_USER_INVITE_REWARDS = '''
+    SELECT invitee_user_id, recharge_amount, reward_amount, created_at
+    FROM invite_rewards
+    WHERE inviter_user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+'''
+
+SQL_INVITE_STATS = '''
+    SELECT
+        (SELECT code FROM invite_codes
+         WHERE owner_user_id = me.user_id AND is_active = 1
+         LIMIT 1),
+        COALESCE(s.invitee_count, 0),
+        COALESCE(s.total_reward, 0),
+        iu.name, ui.invite_code, ui.inviter_reward_total, ui.created_at,
+        u.has_used_invite,
+        (SELECT ic.discount_percent
+         FROM invite_code_usage icu
+         JOIN invite_codes ic ON icu.code_id = ic.id
+         WHERE icu.user_id = me.user_id
+         ORDER BY icu.used_at DESC
+         LIMIT 1)
+    FROM (SELECT ? AS user_id) me
+    LEFT JOIN users u ON u.user_id = me.user_id
+    LEFT JOIN invite_stats s ON s.inviter_user_id = me.user_id
+    LEFT JOIN user_invitations ui ON ui.invitee_user_id = me.user_id
+    LEFT JOIN users iu ON iu.user_id = ui.inviter_user_id
+'''
+
+SQL_USER_INVITE_CODE = '''
+    SELECT code FROM invite_codes
+    WHERE owner_user_id = ? AND is_active = 1
+    LIMIT 1
+'''
+
+SQL_INVITE_DISCOUNT = '''
+    SELECT ic.discount_percent
+    FROM invite_code_usage icu
+    JOIN invite_codes ic ON icu.code_id = ic.id
+    WHERE icu.user_id = ?
+    ORDER BY icu.used_at DESC
+    LIMIT 1
+'''
+
+# {where}: query_operation_logs 按参数拼接的过滤条件
+SQL_OPERATION_LOGS = '''
+    SELECT id, user_id, operation, details, timestamp
+    FROM operation_logs
+    {where}
+    ORDER BY timestamp DESC, id DESC
+    LIMIT ?
+'''
+
+# 订阅过期清理每批处理的行数（每批一个短事务，避免长时间持有写锁）
+EXPIRY_CHUNK_ROWS = 2000
+
+# 下面两条在同一事务内执行，按 (status, end_date) 索引顺序取到同一批行
+SQL_OVERDUE_SUBSCRIPTION_USERS = '''
+    SELECT user_id FROM user_subscriptions
+    WHERE status = 'active' AND end_date <= ?
+    LIMIT ?
+'''
+
+SQL_EXPIRE_SUBSCRIPTIONS = '''
+    UPDATE user_subscriptions
+    SET status = 'expired'
+    WHERE rowid IN (
+        SELECT rowid FROM user_subscriptions
+        WHERE status = 'active' AND end_date <= ?
+        LIMIT ?
+    )
+'''
+
+# {placeholders}: 本次过期涉及的用户
+SQL_USERS_WITH_ACTIVE_SUBSCRIPTION = '''
+    SELECT DISTINCT user_id FROM user_subscriptions
+    WHERE user_id IN ({placeholders}) AND status = 'active' AND end_date > ?
+'''
+
+# 热点查询（名称, SQL, 参数），用于 EXPLAIN QUERY PLAN 回归检查
+HOT_QUERIES = [
+    ('get_user_subscription', SQL_USER_SUBSCRIPTION, (1,)),
+    ('get_processed_tx_hashes', SQL_PROCESSED_TX_HASHES.format(placeholders='?, ?, ?'),
+     (1, 'tx1', 'tx2', 'tx3')),
+    ('get_user_recharge_records', SQL_USER_RECHARGE_RECORDS, (1, 20)),
+    ('get_invite_leaderboard', SQL_INVITE_LEADERBOARD, (10,)),
+    ('get_user_invite_rewards', SQL_USER_INVITE_REWARDS, (1, 20)),
+    ('get_invite_stats', SQL_INVITE_STATS, (1,)),
+    ('query_operation_logs', SQL_OPERATION_LOGS.format(where='WHERE user_id = ? AND timestamp >= ?'),
+     (1, '2000-01-01', 100)),
+    ('get_user_invite_code', SQL_USER_INVITE_CODE, (1,)),
+    ('get_user_invite_discount', SQL_INVITE_DISCOUNT, (1,)),
+    ('expire_overdue_subscriptions.users', SQL_OVERDUE_SUBSCRIPTION_USERS, ('2024-01-01', EXPIRY_CHUNK_ROWS)),
+    ('expire_overdue_subscriptions', SQL_EXPIRE_SUBSCRIPTIONS, ('2024-01-01', EXPIRY_CHUNK_ROWS)),
+    ('expire_overdue_subscriptions.still_active',
+     SQL_USERS_WITH_ACTIVE_SUBSCRIPTION.format(placeholders='?, ?, ?'), (1, 2, 3, '2024-01-01')),
+]
 
 class Database:
     """数据库管理类"""
 
-    def __init__(self, db_file: str = DATABASE_FILE):
+    def __init__(self, db_file: str = DATABASE_FILE, use_pool: bool = True):
         self.db_file = db_file
         self._ensure_directory()
+        self._pool = get_connection_pool(db_file) if use_pool else None
+        self._context_cache = get_user_context_cache(db_file)
+        self._log_writer = get_operation_log_writer(db_file)
+        self._plan_cache = get_plan_cache(db_file)
 
     def _ensure_directory(self):
         """确保数据库目录存在"""
         os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
 
     def _get_connection(self) -> sqlite3.Connection:
-        """获取数据库连接"""
+        """获取数据库连接（使用连接池时 close() 会把连接归还到池中）"""
+        if self._pool is not None:
+            return self._pool.acquire()
         return sqlite3.connect(self.db_file)
 
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        """
+        事务上下文管理器
+
+        正常退出时提交，发生异常时回滚并重新抛出，最后归还连接。
+
+        Args:
+            immediate: 是否使用 BEGIN IMMEDIATE 立即获取写锁（读-改-写场景）
+
+        用法:
+            with db.transaction() as conn:
+                conn.execute(...)
+        """
+        conn = self._get_connection()
+        try:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
     def _init_subscription_plans(self, cursor):
         """
         初始化订阅套餐（灵活定价版）
@@ -259,8 +1015,99 @@ class Database:
         conn.commit()
 
         conn.close()
+        self.invalidate_plan_cache()
         logger.info("数据库表创建完成")
 
+        self.run_migrations()
+
+    # ========== 数据库迁移 ==========
+
+    def get_schema_version(self) -> int:
+        """获取当前数据库结构版本（未执行过迁移返回 0）"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name = 'schema_migrations'
+        ''')
+        if not cursor.fetchone():
+            conn.close()
+            return 0
+
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        version = cursor.fetchone()[0]
+        conn.close()
+        return version
+
+    def run_migrations(self) -> int:
+        """
+        执行尚未应用的数据库迁移
+
+        每个迁移在独立事务中执行，失败时回滚并停止后续迁移。
+
+        Returns:
+            迁移后的结构版本
+        """
+        with self.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            ''')
+
+        current_version = self.get_schema_version()
+
+        for version, name, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            try:
+                with self.transaction(immediate=True) as conn:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(
+                        'INSERT INTO schema_migrations (version, name) VALUES (?, ?)',
+                        (version, name)
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"数据库迁移失败: v{version} {name}: {e}")
+                break
+
+            current_version = version
+            logger.info(f"数据库迁移完成: v{version} {name}")
+
+        return current_version
+
+    def explain_query_plan(self, sql: str, params: tuple = ()) -> List[str]:
+        """返回查询的 EXPLAIN QUERY PLAN 明细"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        details = [row[3] for row in cursor.fetchall()]
+        conn.close()
+        return details
+
+    def find_full_table_scans(self) -> Dict[str, List[str]]:
+        """
+        检查热点查询是否退化为全表扫描
+
+        Returns:
+            {查询名称: 全表扫描的计划明细}，全部走索引时返回空字典
+        """
+        scans = {}
+        for name, sql, params in HOT_QUERIES:
+            details = self.explain_query_plan(sql, params)
+            # 扫描单行常量或子查询协程（如 get_invite_stats 的 (SELECT ? AS user_id) me）不是全表扫描
+            coroutines = {d.split()[-1] for d in details if d.startswith('CO-ROUTINE')}
+            bad = [d for d in details
+                   if (d.startswith('SCAN') and d != 'SCAN CONSTANT ROW' and d.split()[1] not in coroutines)
+                   or 'USE TEMP B-TREE' in d]
+            if bad:
+                scans[name] = bad
+        return scans
+
     def _init_default_invite_codes(self, cursor):
         """初始化默认邀请码"""
         cursor.execute('SELECT COUNT(*) FROM invite_codes')
@@ -302,34 +1149,24 @@ class Database:
         """
         根据支付金额自动匹配最佳档位
 
-        规则：找到支付金额>=最低费用的最高档位
+        规则：找到支付金额>=最低费用的最高档位（使用套餐缓存，不访问数据库）
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        snapshot = self._get_plan_snapshot()
+        index = bisect_right(snapshot['min_payments'], payment_amount) - 1
 
-        cursor.execute('''
-            SELECT id, plan_name, tier_level, monthly_rate, min_payment_30days, standard_capital
-            FROM subscription_plans
-            WHERE min_payment_30days <= ?
-            ORDER BY tier_level DESC
-            LIMIT 1
-        ''', (payment_amount,))
-
-        row = cursor.fetchone()
-        conn.close()
-
-        if not row:
+        if index < 0:
             return None
 
-        actual_capital = self.calculate_actual_capital(row[3], payment_amount)
+        plan = snapshot['best_tier'][index]
+        actual_capital = self.calculate_actual_capital(plan['monthly_rate'], payment_amount)
 
         return {
-            'id': row[0],
-            'plan_name': row[1],
-            'tier_level': row[2],
-            'monthly_rate': row[3],
-            'min_payment': row[4],
-            'standard_capital': row[5],
+            'id': plan['id'],
+            'plan_name': plan['plan_name'],
+            'tier_level': plan['tier_level'],
+            'monthly_rate': plan['monthly_rate'],
+            'min_payment': plan['min_payment'],
+            'standard_capital': plan['standard_capital'],
             'payment_amount': payment_amount,
             'actual_capital': actual_capital
         }
@@ -361,6 +1198,7 @@ class Database:
 
             conn.commit()
             conn.close()
+            self._invalidate_user_context(user_id)
             self.log_operation(user_id, "register", "用户注册")
             return user_uuid
 
@@ -446,6 +1284,7 @@ class Database:
 
             conn.commit()
             conn.close()
+            self._invalidate_user_context(user_id)
 
             print(f"[INFO] 用户 {user_id} 服务信息已更新")
             print(f"       - 服务ID: {service_id}")
@@ -466,6 +1305,7 @@ class Database:
         ''', (user_id,))
         conn.commit()
         conn.close()
+        self._invalidate_user_context(user_id)
     def user_exists(self, user_id: int) -> bool:
         """检查用户是否存在"""
         conn = self._get_connection()
@@ -486,6 +1326,7 @@ class Database:
         ''', (security, api_key, user_id))
         conn.commit()
         conn.close()
+        self._invalidate_user_context(user_id)
         self.log_operation(user_id, "update_api", "更新API")
 
     def update_user_status(self, user_id: int, status: str):
@@ -499,6 +1340,7 @@ class Database:
         ''', (status, user_id))
         conn.commit()
         conn.close()
+        self._invalidate_user_context(user_id)
         self.log_operation(user_id, "update_status", f"状态: {status}")
 
     def get_user_by_telegram_id(self, user_id: int) -> Optional[Dict]:
@@ -533,17 +1375,307 @@ class Database:
         """获取用户详细信息"""
         return self.get_user_by_telegram_id(user_id)
 
-    def log_operation(self, user_id: int, operation: str, details: str = ""):
-        """记录用户操作"""
+    # ========== 用户上下文 ==========
+
+    def load_user_context(self, user_id: int, use_cache: bool = True) -> Optional[Dict]:
+        """
+        一次查询加载用户的完整上下文（替代 user_exists + get_user_by_telegram_id +
+        get_user_subscription + get_user_balance + get_user_address + get_user_invite_code）
+
+        结果会短期缓存，相关写操作会使缓存失效。返回值是共享对象，请勿修改。
+
+        Returns:
+            用户不存在时返回 None，否则:
+            {
+                'user': 同 get_user_by_telegram_id,
+                'subscription': 同 get_user_subscription（无有效订阅为 None）,
+                'balance': 余额,
+                'payment_address': 充值地址,
+                'invite_code': 我的邀请码
+            }
+
+            语言设置不在数据库中（由 MenuSystem.user_languages 在内存中维护），不包含在上下文里
+        """
+        if use_cache:
+            hit, cached = self._context_cache.get(user_id)
+            if hit:
+                return cached
+        version = self._context_cache.version(user_id)
+
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO operation_logs (user_id, operation, details)
-            VALUES (?, ?, ?)
-        ''', (user_id, operation, details))
-        conn.commit()
+            SELECT
+                u.id, u.name, u.user_id, u.status, u.security, u.api_key,
+                u.service_id, u.service_name, u.balance, u.inviter_user_id,
+                u.invite_code, u.has_used_invite, u.created_at, u.updated_at,
+                ub.balance,
+                upa.address,
+                (SELECT code FROM invite_codes
+                 WHERE owner_user_id = u.user_id AND is_active = 1
+                 LIMIT 1),
+                us.id, us.plan_id, us.tier_level, us.monthly_rate, us.payment_amount,
+                us.actual_capital, us.start_date, us.end_date, us.status,
+                sp.plan_name
+            FROM users u
+            LEFT JOIN user_balance ub ON ub.user_id = u.user_id
+            LEFT JOIN user_payment_addresses upa ON upa.user_id = u.user_id
+            LEFT JOIN user_subscriptions us ON us.id = (
+                SELECT id FROM user_subscriptions
+                WHERE user_id = u.user_id AND status = 'active'
+                ORDER BY end_date DESC
+                LIMIT 1
+            )
+            LEFT JOIN subscription_plans sp ON sp.id = us.plan_id
+            WHERE u.user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+
+        context = None
+        if row:
+            subscription = None
+            if row[17] is not None and row[26] is not None:
+                subscription = {
+                    'id': row[17],
+                    'plan_id': row[18],
+                    'tier_level': row[19],
+                    'monthly_rate': row[20],
+                    'payment_amount': row[21],
+                    'max_capital': row[22],
+                    'start_date': row[23],
+                    'end_date': row[24],
+                    'status': row[25],
+                    'plan_name': row[26]
+                }
+
+            context = {
+                'user': {
+                    'id': row[0],
+                    'name': row[1],
+                    'user_id': row[2],
+                    'status': row[3],
+                    'security': row[4],
+                    'api_key': row[5],
+                    'service_id': row[6],
+                    'service_name': row[7],
+                    'balance': row[8],
+                    'inviter_user_id': row[9],
+                    'invite_code': row[10],
+                    'has_used_invite': row[11],
+                    'created_at': row[12],
+                    'updated_at': row[13]
+                },
+                'subscription': subscription,
+                'balance': row[14] if row[14] is not None else 0.0,
+                'payment_address': row[15],
+                'invite_code': row[16]
+            }
+
+        self._context_cache.set(user_id, context, version)
+        return context
+
+    def _invalidate_user_context(self, user_id: int):
+        """写操作后使用户上下文缓存失效"""
+        self._context_cache.invalidate(user_id)
+
+    def get_running_users(self) -> List[Dict]:
+        """获取所有交易运行中的用户（交易通知服务使用）"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, name, service_name
+            FROM users
+            WHERE status = '运行中'
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+
+        return [
+            {'user_id': row[0], 'name': row[1], 'service_name': row[2]}
+            for row in rows
+        ]
+
+    def log_operation(self, user_id: int, operation: str, details: str = ""):
+        """记录用户操作（缓冲后批量写入，见 OperationLogWriter）"""
+        self._log_writer.write(user_id, operation, details)
+
+    def flush_operation_logs(self) -> int:
+        """立即写入缓冲中的操作日志"""
+        return self._log_writer.flush()
+
+    def _archive_dir(self) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_file)), 'archive')
+
+    def _archive_file(self, month: str) -> str:
+        return os.path.join(self._archive_dir(), f"operation_logs_{month}.db")
+
+    def archive_operation_logs(self, days: int = 90) -> Dict[str, int]:
+        """
+        归档操作日志：把 days 天前的日志按月移动到 archive/operation_logs_YYYYMM.db
+
+        每个月份在一个事务中 INSERT OR IGNORE 到归档库并从主库删除，
+        中途失败重新执行不会产生重复记录。
+
+        Returns:
+            {月份 YYYYMM: 归档条数}
+        """
+        self.flush_operation_logs()
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+
+        conn = self._get_connection()
+        months = [row[0] for row in conn.execute('''
+            SELECT DISTINCT strftime('%Y%m', timestamp)
+            FROM operation_logs
+            WHERE timestamp < ?
+        ''', (cutoff,))]
+        conn.close()
+
+        if not months:
+            return {}
+
+        os.makedirs(self._archive_dir(), exist_ok=True)
+        archived = {}
+
+        for month in sorted(months):
+            month_start = f"{month[:4]}-{month[4:]}-01 00:00:00"
+            month_end = datetime.strptime(month_start, '%Y-%m-%d %H:%M:%S') + timedelta(days=32)
+            month_end = min(month_end.strftime('%Y-%m-01 00:00:00'), cutoff)
+
+            conn = self._get_connection()
+            try:
+                conn.execute('ATTACH DATABASE ? AS archive', (self._archive_file(month),))
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS archive.operation_logs (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        operation TEXT NOT NULL,
+                        details TEXT,
+                        timestamp TIMESTAMP
+                    )
+                ''')
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS archive.idx_operation_logs_user_time
+                    ON operation_logs(user_id, timestamp)
+                ''')
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('''
+                    INSERT OR IGNORE INTO archive.operation_logs
+                    SELECT id, user_id, operation, details, timestamp
+                    FROM main.operation_logs
+                    WHERE timestamp >= ? AND timestamp < ?
+                ''', (month_start, month_end))
+                cursor = conn.execute('''
+                    DELETE FROM main.operation_logs
+                    WHERE timestamp >= ? AND timestamp < ?
+                ''', (month_start, month_end))
+                archived[month] = cursor.rowcount
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"归档操作日志失败: {month}: {e}")
+                raise
+            finally:
+                try:
+                    conn.execute('DETACH DATABASE archive')
+                except sqlite3.Error:
+                    pass
+                conn.close()
+
+        freed = self._reclaim_free_pages()
+        logger.info(f"操作日志归档完成: {archived}，释放 {freed} 页")
+        return archived
+
+    def _reclaim_free_pages(self) -> int:
+        """
+        归还删除日志后留下的空闲页，让数据库文件真正变小
+
+        旧库 auto_vacuum=NONE，第一次需要设置为 INCREMENTAL 并整体 VACUUM 一次；
+        之后每次只做 incremental_vacuum，不重写整个文件
+
+        Returns:
+            释放的页数
+        """
+        conn = self._get_connection()
+        try:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if free_pages == 0:
+                return 0
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                conn.execute('PRAGMA incremental_vacuum').fetchall()
+            else:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+            # WAL 模式下截断发生在检查点，之后主库文件才会变小
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            return free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        except sqlite3.Error as e:
+            # 回收空间失败不影响归档结果，下次归档再试
+            logger.warning(f"回收空闲页失败: {e}")
+            return 0
+        finally:
+            conn.close()
+
+    def query_operation_logs(self, user_id: int = None, since: str = None, until: str = None,
+                             limit: int = 100) -> List[Dict]:
+        """
+        查询操作日志（包含已归档的月份文件），按时间倒序
+
+        Args:
+            user_id: 用户 ID（为空查询所有用户）
+            since: 起始时间（含，'YYYY-MM-DD HH:MM:SS'，UTC）
+            until: 结束时间（不含）
+            limit: 最多返回条数
+        """
+        self.flush_operation_logs()
+
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if since:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until:
+            conditions.append('timestamp < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        sql = SQL_OPERATION_LOGS.format(where=where)
+
+        conn = self._get_connection()
+        rows = conn.execute(sql, (*params, limit)).fetchall()
         conn.close()
 
+        # 归档文件按月份倒序查询，已取满且更早的月份不再打开
+        since_month = since[:7].replace('-', '') if since else None
+        until_month = until[:7].replace('-', '') if until else None
+        archive_files = sorted(glob.glob(os.path.join(self._archive_dir(), 'operation_logs_*.db')), reverse=True)
+        for path in archive_files:
+            month = os.path.basename(path)[len('operation_logs_'):-len('.db')]
+            if (since_month and month < since_month) or (until_month and month > until_month):
+                continue
+            if len(rows) >= limit and month < rows[limit - 1][4][:7].replace('-', ''):
+                break
+
+            archive_conn = sqlite3.connect(path)
+            try:
+                rows.extend(archive_conn.execute(sql, (*params, limit)).fetchall())
+            finally:
+                archive_conn.close()
+            rows.sort(key=lambda row: (row[4], row[0]), reverse=True)
+            del rows[limit:]
+
+        return [
+            {
+                'id': row[0],
+                'user_id': row[1],
+                'operation': row[2],
+                'details': row[3],
+                'timestamp': row[4]
+            }
+            for row in rows
+        ]
+
     # ========== 充值地址管理 ==========
 
     def save_user_payment_address(self, user_id: int, address: str) -> bool:
@@ -558,6 +1690,7 @@ class Database:
             ''', (user_id, address))
             conn.commit()
             conn.close()
+            self._invalidate_user_context(user_id)
             return True
         except Exception as e:
             conn.rollback()
@@ -565,6 +1698,44 @@ class Database:
             logger.error(f"保存充值地址失败: {e}")
             return False
 
+    def save_user_payment_addresses(self, addresses: Dict[int, str]) -> int:
+        """
+        批量保存预生成的充值地址（已有地址的用户保持不变）
+
+        Returns:
+            新写入的地址数
+        """
+        if not addresses:
+            return 0
+
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO user_payment_addresses (user_id, address)
+                VALUES (?, ?)
+            ''', list(addresses.items()))
+            inserted = conn.total_changes - before
+
+        for user_id in addresses:
+            self._invalidate_user_context(user_id)
+        return inserted
+
+    def get_users_without_payment_address(self, limit: int = 500) -> List[int]:
+        """获取尚未分配充值地址的注册用户（按注册顺序）"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.user_id
+            FROM users u
+            LEFT JOIN user_payment_addresses upa ON upa.user_id = u.user_id
+            WHERE upa.user_id IS NULL
+            ORDER BY u.rowid
+            LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+
     def get_user_payment_address(self, user_id: int) -> Optional[str]:
         """获取用户的充值地址"""
         conn = self._get_connection()
@@ -583,10 +1754,125 @@ class Database:
         conn.close()
         return {row[0]: row[1] for row in rows}
 
+    # ========== 链上扫描检查点 ==========
+
+    def get_chain_checkpoint(self, name: str) -> Optional[Dict]:
+        """
+        获取链上扫描检查点
+
+        Returns:
+            {'block_number', 'block_timestamp'(毫秒)} 或 None（尚未扫描）
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT block_number, block_timestamp FROM chain_checkpoints WHERE name = ?', (name,)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return {'block_number': row[0], 'block_timestamp': row[1]} if row else None
+
+    def save_chain_checkpoint(self, name: str, block_number: int, block_timestamp: int):
+        """保存链上扫描检查点（block_timestamp 之前的区块均已处理）"""
+        with self.transaction() as conn:
+            conn.execute('''
+                INSERT INTO chain_checkpoints (name, block_number, block_timestamp)
+                VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    block_number = excluded.block_number,
+                    block_timestamp = excluded.block_timestamp,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (name, block_number, block_timestamp))
+
+    def get_address_cursors(self, addresses: List[str] = None) -> Dict[str, int]:
+        """获取充值地址（默认全部）的增量扫描游标 {address: 已处理的最新转账时间(毫秒)}"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        if addresses is None:
+            cursor.execute('SELECT address, last_timestamp FROM address_scan_cursors')
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            # SQLite 默认最多 999 个绑定参数
+            for start in range(0, len(addresses), 900):
+                batch = addresses[start:start + 900]
+                cursor.execute(
+                    f"SELECT address, last_timestamp FROM address_scan_cursors "
+                    f"WHERE address IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                rows.extend(cursor.fetchall())
+        conn.close()
+        return {row[0]: row[1] for row in rows}
+
+    def save_address_cursors(self, cursors: Dict[str, int]):
+        """批量保存充值地址的增量扫描游标（只前进不后退）"""
+        if not cursors:
+            return
+
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO address_scan_cursors (address, last_timestamp)
+                VALUES (?, ?)
+                ON CONFLICT(address) DO UPDATE SET
+                    last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+                    updated_at = CURRENT_TIMESTAMP
+            ''', list(cursors.items()))
+
+    # ========== 充值地址轮询提示 ==========
+
+    def watch_payment_address(self, user_id: int, seconds: float = 1800):
+        """标记用户的充值地址需要高频轮询（用户刚查看充值地址，可能即将转账）"""
+        with self.transaction() as conn:
+            conn.execute('''
+                INSERT INTO address_watch (user_id, hot_until)
+                VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    hot_until = MAX(hot_until, excluded.hot_until),
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, time.time() + seconds))
+
+    def get_address_watch_hints(self, expiring_within_days: float = 3) -> Dict[int, float]:
+        """
+        获取需要高频轮询的用户 {user_id: hot_until(Unix 秒)}
+
+        包括最近查看过充值地址的用户，以及订阅将在 expiring_within_days 天内到期的用户
+        （到期后一天内仍保持高频，等待续费充值）。
+
+        已到期的订阅可能已被 expire_overdue_subscriptions 标记为 expired，所以同时查询
+        active 和 expired 两种状态，下界为一天前。
+        """
+        now = datetime.now()
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT user_id, hot_until FROM address_watch WHERE hot_until > ?', (time.time(),))
+        hints = {row[0]: row[1] for row in cursor.fetchall()}
+
+        cursor.execute('''
+            SELECT user_id, MAX(end_date)
+            FROM user_subscriptions
+            WHERE status IN ('active', 'expired') AND end_date BETWEEN ? AND ?
+            GROUP BY user_id
+        ''', ((now - timedelta(days=1)).isoformat(' '),
+              (now + timedelta(days=expiring_within_days)).isoformat(' ')))
+        rows = cursor.fetchall()
+        conn.close()
+
+        for user_id, end_date in rows:
+            hot_until = (datetime.fromisoformat(str(end_date)) + timedelta(days=1)).timestamp()
+            hints[user_id] = max(hints.get(user_id, 0.0), hot_until)
+        return hints
+
+    def clear_expired_address_watch(self) -> int:
+        """删除已过期的高频轮询提示"""
+        with self.transaction() as conn:
+            return conn.execute('DELETE FROM address_watch WHERE hot_until <= ?', (time.time(),)).rowcount
+
     # ========== 订阅套餐管理（优化版）==========
 
-    def get_all_plans(self) -> List[Dict]:
-        """获取所有订阅套餐"""
+    def _load_plans(self) -> List[Dict]:
+        """从数据库读取全部套餐（供套餐缓存加载）"""
         conn = self._get_connection()
         cursor = conn.cursor()
         cursor.execute('''
@@ -610,28 +1896,31 @@ class Database:
             })
         return plans
 
-    def get_plan_by_id(self, plan_id: int) -> Optional[Dict]:
-        """根据ID获取套餐信息"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, plan_name, tier_level, monthly_rate, min_payment_30days, standard_capital
-            FROM subscription_plans
-            WHERE id = ?
-        ''', (plan_id,))
-        row = cursor.fetchone()
-        conn.close()
+    def _get_plan_snapshot(self) -> Dict:
+        return self._plan_cache.get(self._load_plans)
 
-        if not row:
+    def invalidate_plan_cache(self):
+        """套餐变更后调用，下次读取时重新加载"""
+        self._plan_cache.invalidate()
+
+    def get_all_plans(self) -> List[Dict]:
+        """获取所有订阅套餐"""
+        return [dict(plan) for plan in self._get_plan_snapshot()['plans']]
+
+    def get_plan_by_id(self, plan_id: int) -> Optional[Dict]:
+        """根据ID获取套餐信息"""
+        plan = self._get_plan_snapshot()['by_id'].get(plan_id)
+
+        if not plan:
             return None
 
         return {
-            'id': row[0],
-            'plan_name': row[1],
-            'tier_level': row[2],
-            'monthly_rate': row[3],
-            'min_payment': row[4],
-            'standard_capital': row[5]
+            'id': plan['id'],
+            'plan_name': plan['plan_name'],
+            'tier_level': plan['tier_level'],
+            'monthly_rate': plan['monthly_rate'],
+            'min_payment': plan['min_payment'],
+            'standard_capital': plan['standard_capital']
         }
 
     # ========== 订阅管理（优化版）==========
@@ -660,31 +1949,24 @@ class Database:
         if balance < total_price:
             return False, f"余额不足。需要{total_price:.2f} USDT，当前余额{balance:.2f} USDT"
 
-        # 3. 扣除余额
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        new_balance = balance - total_price
-        cursor.execute('''
-            UPDATE user_balance 
-            SET balance = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (new_balance, user_id))
-
-        # 4. 创建订阅记录
+        # 3. 扣除余额并创建订阅记录（同一事务，扣款时再次检查余额）
         start_date = datetime.now()
         end_date = start_date + timedelta(days=days)
         actual_capital = tier_info['actual_capital']
 
-        cursor.execute('''
-            INSERT INTO user_subscriptions 
-            (user_id, plan_id, tier_level, monthly_rate, payment_amount, actual_capital, start_date, end_date, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active')
-        ''', (user_id, tier_info['id'], tier_info['tier_level'], tier_info['monthly_rate'],
-              payment_amount, actual_capital, start_date, end_date))
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            if self._apply_balance_change(cursor, user_id, -total_price, 'subscription') is None:
+                return False, f"余额不足。需要{total_price:.2f} USDT"
 
-        conn.commit()
-        conn.close()
+            cursor.execute('''
+                INSERT INTO user_subscriptions 
+                (user_id, plan_id, tier_level, monthly_rate, payment_amount, actual_capital, start_date, end_date, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active')
+            ''', (user_id, tier_info['id'], tier_info['tier_level'], tier_info['monthly_rate'],
+                  payment_amount, actual_capital, start_date, end_date))
+
+        self._invalidate_user_context(user_id)
 
         self.log_operation(user_id, "create_subscription_flexible",
                           f"档位:{tier_info['plan_name']}, 支付:{payment_amount}, 额度:{actual_capital:.2f}, 天数:{days}")
@@ -710,24 +1992,7 @@ class Database:
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT 
-                us.id, 
-                us.plan_id, 
-                us.tier_level,
-                us.monthly_rate,
-                us.payment_amount,
-                us.actual_capital, 
-                us.start_date, 
-                us.end_date, 
-                us.status,
-                sp.plan_name
-            FROM user_subscriptions us
-            JOIN subscription_plans sp ON us.plan_id = sp.id
-            WHERE us.user_id = ? AND us.status = 'active'
-            ORDER BY us.end_date DESC
-            LIMIT 1
-        ''', (user_id,))
+        cursor.execute(SQL_USER_SUBSCRIPTION, (user_id,))
 
         row = cursor.fetchone()
         conn.close()
@@ -749,7 +2014,12 @@ class Database:
         }
 
     def check_subscription_status(self, user_id: int) -> Tuple[bool, Optional[str]]:
-        """检查订阅状态"""
+        """
+        检查订阅状态（只读）
+
+        到期但尚未被 expire_overdue_subscriptions() 标记的订阅同样视为已过期，
+        状态字段由定时清理任务统一更新。
+        """
         subscription = self.get_user_subscription(user_id)
 
         if not subscription:
@@ -758,19 +2028,69 @@ class Database:
         end_date = datetime.fromisoformat(subscription['end_date'])
 
         if datetime.now() > end_date:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE user_subscriptions 
-                SET status = 'expired'
-                WHERE id = ?
-            ''', (subscription['id'],))
-            conn.commit()
-            conn.close()
             return False, "订阅已过期"
 
         return True, None
 
+    def expire_overdue_subscriptions(self, now: datetime = None,
+                                     chunk_size: int = EXPIRY_CHUNK_ROWS) -> List[int]:
+        """
+        批量过期所有已到期的订阅
+
+        每批 chunk_size 行一个 BEGIN IMMEDIATE 短事务，积压很多时也不会
+        长时间占用写锁让其他写入方等到 busy_timeout
+
+        Args:
+            now: 当前时间（默认 datetime.now()）
+            chunk_size: 每批过期的行数
+
+        Returns:
+            本次过期后不再有有效订阅的用户 ID 列表（用于停止服务等后续处理）
+        """
+        cutoff = (now or datetime.now()).isoformat(' ')
+
+        candidates = set()
+        expired_rows = 0
+        while True:
+            users = self._expire_subscription_chunk(cutoff, chunk_size)
+            candidates.update(users)
+            expired_rows += len(users)
+            if len(users) < chunk_size:
+                break
+
+        expired_users = self._users_without_active_subscription(candidates, cutoff)
+        for user_id in candidates:
+            self._invalidate_user_context(user_id)
+
+        if expired_rows:
+            logger.info(f"订阅过期清理: {expired_rows} 条订阅过期, {len(expired_users)} 个用户失去有效订阅")
+        return expired_users
+
+    def _expire_subscription_chunk(self, cutoff: str, chunk_size: int) -> List[int]:
+        """过期一批到期订阅，返回这批订阅的用户 ID"""
+        with self.transaction(immediate=True) as conn:
+            users = [row[0] for row in conn.execute(SQL_OVERDUE_SUBSCRIPTION_USERS, (cutoff, chunk_size))]
+            if users:
+                conn.execute(SQL_EXPIRE_SUBSCRIPTIONS, (cutoff, chunk_size))
+        return users
+
+    def _users_without_active_subscription(self, user_ids, cutoff: str) -> List[int]:
+        """从 user_ids 中去掉仍有其他有效订阅的用户"""
+        user_ids = sorted(user_ids)
+        still_active = set()
+        conn = self._get_connection()
+        try:
+            # SQLite 默认最多 999 个绑定参数
+            for start in range(0, len(user_ids), 900):
+                batch = user_ids[start:start + 900]
+                still_active.update(row[0] for row in conn.execute(
+                    SQL_USERS_WITH_ACTIVE_SUBSCRIPTION.format(placeholders=','.join('?' * len(batch))),
+                    (*batch, cutoff)
+                ))
+        finally:
+            conn.close()
+        return [user_id for user_id in user_ids if user_id not in still_active]
+
     def is_subscription_valid(self, user_id: int) -> Tuple[bool, Optional[str]]:
         """检查订阅是否有效"""
         return self.check_subscription_status(user_id)
@@ -786,53 +2106,123 @@ class Database:
         conn.close()
         return row[0] if row else 0.0
 
-    def add_balance(self, user_id: int, amount: float) -> bool:
-        """增加用户余额"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+    def add_balance(self, user_id: int, amount: float, reason: str = 'credit', ref: str = None) -> bool:
+        """增加用户余额（amount 为负且余额不足时返回 False）"""
+        with self.transaction(immediate=True) as conn:
+            new_balance = self._apply_balance_change(conn.cursor(), user_id, amount, reason, ref)
+        if new_balance is None:
+            return False
+        self._invalidate_user_context(user_id)
+        return True
 
-        cursor.execute('SELECT balance FROM user_balance WHERE user_id = ?', (user_id,))
-        balance_row = cursor.fetchone()
+    def deduct_balance(self, user_id: int, amount: float, reason: str = 'debit', ref: str = None) -> bool:
+        """扣除用户余额（余额不足时返回 False）"""
+        with self.transaction(immediate=True) as conn:
+            new_balance = self._apply_balance_change(conn.cursor(), user_id, -amount, reason, ref)
+        if new_balance is None:
+            return False
+        self._invalidate_user_context(user_id)
+        return True
 
-        if balance_row:
-            new_balance = balance_row[0] + amount
-            cursor.execute('''
-                UPDATE user_balance 
-                SET balance = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            ''', (new_balance, user_id))
-        else:
+    def credit_balances(self, credits: List[Tuple[int, float]], reason: str = 'bulk_credit') -> int:
+        """
+        批量增加余额（单个事务）
+
+        Args:
+            credits: [(user_id, amount), ...]
+            reason: 流水原因
+
+        Returns:
+            入账笔数
+        """
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            for user_id, amount in credits:
+                self._apply_balance_change(cursor, user_id, amount, reason)
+
+        for user_id, _ in credits:
+            self._invalidate_user_context(user_id)
+        return len(credits)
+
+    def _apply_balance_change(self, cursor, user_id: int, amount: float,
+                              reason: str, ref: str = None) -> Optional[float]:
+        """
+        变更余额并追加流水（内部方法，调用方负责事务，应使用 BEGIN IMMEDIATE）
+
+        扣款通过 WHERE balance + ? >= 0 在同一条 UPDATE 中检查余额，不存在读后写竞争。
+
+        Returns:
+            变更后余额；余额不足时返回 None 且不做任何修改
+        """
+        if amount >= 0:
             cursor.execute('''
                 INSERT INTO user_balance (user_id, balance)
                 VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    balance = balance + excluded.balance,
+                    updated_at = CURRENT_TIMESTAMP
             ''', (user_id, amount))
-
-        conn.commit()
-        conn.close()
-        return True
-
-    def deduct_balance(self, user_id: int, amount: float) -> bool:
-        """扣除用户余额"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        else:
+            cursor.execute('''
+                UPDATE user_balance
+                SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND balance + ? >= 0
+            ''', (amount, user_id, amount))
+            if cursor.rowcount == 0:
+                return None
 
         cursor.execute('SELECT balance FROM user_balance WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
+        new_balance = cursor.fetchone()[0]
 
-        if not row or row[0] < amount:
-            conn.close()
-            return False
+        cursor.execute('''
+            INSERT INTO balance_ledger (user_id, amount, balance_after, reason, ref)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, amount, new_balance, reason, ref))
+        return new_balance
 
-        new_balance = row[0] - amount
+    def get_balance_ledger(self, user_id: int, limit: int = 50) -> List[Dict]:
+        """获取用户余额流水"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
         cursor.execute('''
-            UPDATE user_balance 
-            SET balance = ?, updated_at = CURRENT_TIMESTAMP
+            SELECT id, amount, balance_after, reason, ref, created_at
+            FROM balance_ledger
             WHERE user_id = ?
-        ''', (new_balance, user_id))
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        rows = cursor.fetchall()
+        conn.close()
 
-        conn.commit()
+        return [
+            {
+                'id': row[0],
+                'amount': row[1],
+                'balance_after': row[2],
+                'reason': row[3],
+                'ref': row[4],
+                'created_at': row[5]
+            }
+            for row in rows
+        ]
+
+    def check_balance_ledger(self) -> List[int]:
+        """余额一致性检查：返回缓存余额与流水合计不一致的用户 ID"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT ub.user_id
+            FROM user_balance ub
+            LEFT JOIN (
+                SELECT user_id, SUM(amount) AS total
+                FROM balance_ledger
+                GROUP BY user_id
+            ) l ON l.user_id = ub.user_id
+            WHERE ABS(ub.balance - COALESCE(l.total, 0)) > 1e-6
+        ''')
+        rows = cursor.fetchall()
         conn.close()
-        return True
+        return [row[0] for row in rows]
 
     # ========== 充值记录 ==========
 
@@ -856,62 +2246,64 @@ class Database:
 
     def verify_recharge(self, record_id: int) -> bool:
         """验证并确认充值"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT user_id, amount, status
-            FROM recharge_records
-            WHERE id = ?
-        ''', (record_id,))
-
-        row = cursor.fetchone()
-        if not row or row[2] == 'completed':
-            conn.close()
-            return False
-
-        user_id, amount, _ = row
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, amount, status
+                FROM recharge_records
+                WHERE id = ?
+            ''', (record_id,))
 
-        cursor.execute('''
-            UPDATE recharge_records
-            SET status = 'completed', verified_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (record_id,))
+            row = cursor.fetchone()
+            if not row or row[2] == 'completed':
+                return False
 
-        cursor.execute('SELECT balance FROM user_balance WHERE user_id = ?', (user_id,))
-        balance_row = cursor.fetchone()
+            user_id, amount, _ = row
 
-        if balance_row:
-            new_balance = balance_row[0] + amount
-            cursor.execute('''
-                UPDATE user_balance 
-                SET balance = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            ''', (new_balance, user_id))
-        else:
             cursor.execute('''
-                INSERT INTO user_balance (user_id, balance)
-                VALUES (?, ?)
-            ''', (user_id, amount))
+                UPDATE recharge_records
+                SET status = 'completed', verified_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (record_id,))
 
-        conn.commit()
-        conn.close()
+            self._apply_balance_change(cursor, user_id, amount, 'recharge', f"recharge:{record_id}")
+
+        self._invalidate_user_context(user_id)
 
         self.log_operation(user_id, "verify_recharge", f"充值成功: {amount} USDT")
         return True
 
+    def get_processed_tx_hashes(self, user_id: int, tx_hashes: List[str]) -> set:
+        """
+        批量查询用户已入账的交易哈希（每批一次 IN 查询）
+
+        按 (user_id, tx_hash) 判断：同一笔交易给其他用户的入账不影响该用户。
+        """
+        processed = set()
+        if not tx_hashes:
+            return processed
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+
+        # SQLite 默认最多 999 个绑定参数
+        for start in range(0, len(tx_hashes), 900):
+            batch = tx_hashes[start:start + 900]
+            cursor.execute(
+                SQL_PROCESSED_TX_HASHES.format(placeholders=','.join('?' * len(batch))),
+                (user_id, *batch)
+            )
+            processed.update(row[0] for row in cursor.fetchall())
+
+        conn.close()
+        return processed
+
     def get_user_recharge_records(self, user_id: int, limit: int = 20) -> List[Dict]:
         """获取用户充值记录"""
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT id, amount, tx_hash, status, created_at, verified_at
-            FROM recharge_records
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        ''', (user_id, limit))
+        cursor.execute(SQL_USER_RECHARGE_RECORDS, (user_id, limit))
 
         rows = cursor.fetchall()
         conn.close()
@@ -928,6 +2320,163 @@ class Database:
             })
         return records
 
+    # ========== 充值结算队列 ==========
+
+    def enqueue_recharges(self, recharges: List[Dict]) -> int:
+        """
+        将检测到的充值加入结算队列（按 (tx_hash, user_id) 去重，重复入队会被忽略）
+
+        同一笔交易转给多个用户时，每个用户各入队一笔。
+
+        Args:
+            recharges: [{'user_id', 'address', 'amount', 'tx_hash', 'timestamp'}, ...]
+
+        Returns:
+            新入队笔数
+        """
+        if not recharges:
+            return 0
+
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO recharge_queue (tx_hash, user_id, address, amount, block_timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(r['tx_hash'], r['user_id'], r.get('address'), r['amount'], r.get('timestamp'))
+                  for r in recharges])
+            return conn.total_changes - before
+
+    def claim_recharges(self, limit: int = 10, stale_after: int = 300) -> List[Dict]:
+        """
+        领取待结算的充值并标记为 processing
+
+        处理中超过 stale_after 秒未完成的任务（worker 崩溃）会被重新领取。
+
+        Returns:
+            [{'id', 'tx_hash', 'user_id', 'amount', 'attempts'}, ...]
+        """
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, tx_hash, user_id, amount, attempts
+                FROM recharge_queue
+                WHERE status = 'pending'
+                   OR (status = 'processing' AND locked_at <= datetime('now', ?))
+                ORDER BY id
+                LIMIT ?
+            ''', (f'-{stale_after} seconds', limit))
+            rows = cursor.fetchall()
+
+            cursor.executemany('''
+                UPDATE recharge_queue
+                SET status = 'processing', attempts = attempts + 1,
+                    locked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [(row[0],) for row in rows])
+
+        return [
+            {'id': row[0], 'tx_hash': row[1], 'user_id': row[2], 'amount': row[3], 'attempts': row[4] + 1}
+            for row in rows
+        ]
+
+    def settle_recharge(self, tx_hash: str, user_id: int) -> Optional[Dict]:
+        """
+        在单个事务中结算队列中的一笔充值
+
+        充值记录、余额（含邀请码赠送）、邀请码赠送记录、邀请人奖励和队列状态一起提交，
+        任一步失败整体回滚；已结算或不在队列中的交易直接返回 None，重放安全。
+
+        Returns:
+            {'user_id', 'amount', 'bonus_amount', 'final_amount', 'record_id',
+             'inviter_id', 'reward_amount', 'queued_seconds'(入队到结算的秒数)} 或 None
+        """
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, user_id, amount, address, status,
+                       (julianday('now') - julianday(created_at)) * 86400
+                FROM recharge_queue WHERE tx_hash = ? AND user_id = ?
+            ''', (tx_hash, user_id))
+            row = cursor.fetchone()
+            if not row or row[4] == 'done':
+                return None
+
+            job_id, user_id, amount, address, _, queued_seconds = row
+
+            # 1. 邀请码赠送
+            discount_percent = self._invite_discount(cursor, user_id)
+            bonus_amount = amount * (discount_percent / 100)
+            final_amount = amount + bonus_amount
+
+            # 2. 充值记录 + 余额
+            cursor.execute('''
+                INSERT INTO recharge_records (user_id, amount, tx_hash, payment_address, status, verified_at)
+                VALUES (?, ?, ?, ?, 'completed', CURRENT_TIMESTAMP)
+            ''', (user_id, final_amount, tx_hash, address))
+            record_id = cursor.lastrowid
+            self._apply_balance_change(cursor, user_id, final_amount, 'recharge', f"recharge:{record_id}")
+
+            # 3. 邀请码赠送记录
+            if bonus_amount > 0:
+                cursor.execute('''
+                    UPDATE invite_code_usage SET discount_amount = ? WHERE user_id = ?
+                ''', (bonus_amount, user_id))
+
+            # 4. 邀请人奖励（按原始充值金额）
+            cursor.execute('SELECT inviter_user_id FROM user_invitations WHERE invitee_user_id = ?', (user_id,))
+            inviter = cursor.fetchone()
+            inviter_id = inviter[0] if inviter else None
+            reward_amount = 0.0
+            if inviter_id:
+                reward_amount = amount * INVITE_REWARD_RATE
+                self._apply_balance_change(cursor, inviter_id, reward_amount, 'invite_reward',
+                                           f"invitee:{user_id}")
+                self._insert_invite_reward(cursor, inviter_id, user_id, amount, reward_amount, record_id)
+
+            cursor.execute('''
+                UPDATE recharge_queue
+                SET status = 'done', recharge_record_id = ?, last_error = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (record_id, job_id))
+
+        self._invalidate_user_context(user_id)
+        self.log_operation(user_id, "verify_recharge", f"充值成功: {final_amount} USDT")
+        if inviter_id:
+            self._invalidate_user_context(inviter_id)
+            self.log_operation(inviter_id, "invite_reward",
+                               f"邀请奖励: {reward_amount} USDT from user {user_id}")
+
+        return {
+            'user_id': user_id,
+            'amount': amount,
+            'bonus_amount': bonus_amount,
+            'final_amount': final_amount,
+            'record_id': record_id,
+            'inviter_id': inviter_id,
+            'reward_amount': reward_amount,
+            'queued_seconds': queued_seconds,
+        }
+
+    def fail_recharge(self, tx_hash: str, user_id: int, error: str, max_attempts: int = 5):
+        """记录结算失败：未超过重试次数的放回队列，否则标记为 failed 等待人工处理"""
+        with self.transaction() as conn:
+            conn.execute('''
+                UPDATE recharge_queue
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    last_error = ?, locked_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE tx_hash = ? AND user_id = ? AND status != 'done'
+            ''', (max_attempts, error[:500], tx_hash, user_id))
+
+    def get_recharge_queue_stats(self) -> Dict[str, int]:
+        """结算队列各状态的任务数"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT status, COUNT(*) FROM recharge_queue GROUP BY status')
+        rows = cursor.fetchall()
+        conn.close()
+        return {row[0]: row[1] for row in rows}
+
     # ========== 邀请码管理 ==========
 
     def validate_invite_code(self, code: str, user_id: int) -> tuple:
@@ -993,40 +2542,39 @@ class Database:
                 INSERT INTO user_invitations (inviter_user_id, invitee_user_id, invite_code)
                 VALUES (?, ?, ?)
             ''', (owner_user_id, user_id, code))
+            self._bump_invite_stats(cursor, owner_user_id, invitees=1)
 
         conn.commit()
         conn.close()
+        self._invalidate_user_context(user_id)
 
         self.log_operation(user_id, "use_invite_code", f"使用邀请码: {code}")
         return True
 
     def create_user_invite_code(self, user_id: int) -> str:
-        """为用户创建邀请码"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT invite_code FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
+        """为用户创建邀请码（优先从预生成的邀请码池中取用）"""
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT invite_code FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
 
-        if row and row[0]:
-            conn.close()
-            return row[0]
+            if row and row[0]:
+                return row[0]
 
-        invite_code = f"USER{user_id}{uuid4().hex[:6].upper()}"
+            invite_code = self._pop_pooled_invite_code(cursor) or f"USER{user_id}{uuid4().hex[:6].upper()}"
 
-        cursor.execute('''
-            INSERT INTO invite_codes (code, owner_user_id, max_uses, discount_percent)
-            VALUES (?, ?, 0, 10.0)
-        ''', (invite_code, user_id))
+            cursor.execute('''
+                INSERT INTO invite_codes (code, owner_user_id, max_uses, discount_percent)
+                VALUES (?, ?, 0, 10.0)
+            ''', (invite_code, user_id))
 
-        cursor.execute('''
-            UPDATE users
-            SET invite_code = ?
-            WHERE user_id = ?
-        ''', (invite_code, user_id))
+            cursor.execute('''
+                UPDATE users
+                SET invite_code = ?
+                WHERE user_id = ?
+            ''', (invite_code, user_id))
 
-        conn.commit()
-        conn.close()
+        self._invalidate_user_context(user_id)
 
         self.log_operation(user_id, "create_invite_code", f"创建邀请码: {invite_code}")
         return invite_code
@@ -1048,37 +2596,54 @@ class Database:
     def record_invite_reward(self, inviter_user_id: int, invitee_user_id: int,
                            recharge_amount: float, reward_amount: float,
                            recharge_record_id: int = None) -> bool:
-        """记录邀请奖励"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        """
+        记录邀请奖励（不发放余额，发放由调用方负责）
 
+        奖励记录、邀请关系累计奖励和邀请统计在同一事务中写入。
+        """
+        with self.transaction(immediate=True) as conn:
+            self._insert_invite_reward(conn.cursor(), inviter_user_id, invitee_user_id,
+                                       recharge_amount, reward_amount, recharge_record_id)
+
+        self.log_operation(inviter_user_id, "invite_reward",
+                          f"邀请奖励: {reward_amount} USDT from user {invitee_user_id}")
+        return True
+
+    def _insert_invite_reward(self, cursor, inviter_user_id: int, invitee_user_id: int,
+                              recharge_amount: float, reward_amount: float,
+                              recharge_record_id: int = None):
+        """写入奖励记录并同步累计值（内部方法，调用方负责事务）"""
         cursor.execute('''
             INSERT INTO invite_rewards 
             (inviter_user_id, invitee_user_id, recharge_amount, reward_amount, recharge_record_id)
             VALUES (?, ?, ?, ?, ?)
         ''', (inviter_user_id, invitee_user_id, recharge_amount, reward_amount, recharge_record_id))
 
-        self.add_balance(inviter_user_id, reward_amount)
+        cursor.execute('''
+            UPDATE user_invitations
+            SET inviter_reward_total = inviter_reward_total + ?
+            WHERE inviter_user_id = ? AND invitee_user_id = ?
+        ''', (reward_amount, inviter_user_id, invitee_user_id))
 
-        conn.commit()
-        conn.close()
+        self._bump_invite_stats(cursor, inviter_user_id, reward=reward_amount)
 
-        self.log_operation(inviter_user_id, "invite_reward",
-                          f"邀请奖励: {reward_amount} USDT from user {invitee_user_id}")
-        return True
+    def _bump_invite_stats(self, cursor, inviter_user_id: int, invitees: int = 0, reward: float = 0.0):
+        """增量更新邀请统计（内部方法，调用方负责事务）"""
+        cursor.execute('''
+            INSERT INTO invite_stats (inviter_user_id, invitee_count, total_reward, last_reward_at)
+            VALUES (?, ?, ?, CASE WHEN ? > 0 THEN CURRENT_TIMESTAMP END)
+            ON CONFLICT(inviter_user_id) DO UPDATE SET
+                invitee_count = invitee_count + excluded.invitee_count,
+                total_reward = total_reward + excluded.total_reward,
+                last_reward_at = COALESCE(excluded.last_reward_at, last_reward_at)
+        ''', (inviter_user_id, invitees, reward, reward))
 
     def get_user_invite_rewards(self, user_id: int, limit: int = 20) -> List[Dict]:
         """获取用户邀请奖励记录"""
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT invitee_user_id, recharge_amount, reward_amount, created_at
-            FROM invite_rewards
-            WHERE inviter_user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        ''', (user_id, limit))
+        cursor.execute(SQL_USER_INVITE_REWARDS, (user_id, limit))
 
         rows = cursor.fetchall()
         conn.close()
@@ -1102,20 +2667,7 @@ class Database:
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT 
-                u.user_id,
-                u.name,
-                COUNT(ui.id) as invite_count,
-                COALESCE(SUM(ir.reward_amount), 0) as total_rewards
-            FROM users u
-            LEFT JOIN user_invitations ui ON u.user_id = ui.inviter_user_id
-            LEFT JOIN invite_rewards ir ON u.user_id = ir.inviter_user_id
-            GROUP BY u.user_id, u.name
-            HAVING invite_count > 0
-            ORDER BY invite_count DESC, total_rewards DESC
-            LIMIT ?
-        ''', (limit,))
+        cursor.execute(SQL_INVITE_LEADERBOARD, (limit,))
 
         rows = cursor.fetchall()
         conn.close()
@@ -1245,12 +2797,14 @@ class Database:
                         (inviter_user_id, invitee_user_id, invite_code)
                         VALUES (?, ?, ?)
                     ''', (inviter_user_id, user_id, code.upper()))
+                self._bump_invite_stats(cursor, inviter_user_id, invitees=1)
 
             # 为用户生成专属邀请码
             user_invite_code = self._generate_user_invite_code(cursor, user_id)
 
             conn.commit()
             conn.close()
+            self._invalidate_user_context(user_id)
 
             self.log_operation(user_id, "apply_invite_code",
                                f"使用邀请码: {code}, 折扣: {discount}%, 生成邀请码: {user_invite_code}")
@@ -1278,7 +2832,18 @@ class Database:
         if existing:
             return existing[0]
 
-        # 生成新邀请码
+        # 优先使用预生成的邀请码
+        code = self._pop_pooled_invite_code(cursor)
+        if code:
+            cursor.execute('''
+                    INSERT INTO invite_codes 
+                    (code, owner_user_id, max_uses, discount_percent, is_active)
+                    VALUES (?, ?, 0, 10.0, 1)
+                ''', (code, user_id))
+            logger.info(f"为用户 {user_id} 分配邀请码: {code}")
+            return code
+
+        # 邀请码池为空时随机生成
         max_attempts = 10
         for _ in range(max_attempts):
             random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
@@ -1310,11 +2875,7 @@ class Database:
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-                SELECT code FROM invite_codes 
-                WHERE owner_user_id = ? AND is_active = 1
-                LIMIT 1
-            ''', (user_id,))
+        cursor.execute(SQL_USER_INVITE_CODE, (user_id,))
 
         row = cursor.fetchone()
         conn.close()
@@ -1324,20 +2885,15 @@ class Database:
     def get_user_invite_discount(self, user_id: int) -> float:
         """获取用户的邀请码折扣百分比"""
         conn = self._get_connection()
-        cursor = conn.cursor()
+        discount = self._invite_discount(conn.cursor(), user_id)
+        conn.close()
+        return discount
 
-        cursor.execute('''
-                SELECT ic.discount_percent
-                FROM invite_code_usage icu
-                JOIN invite_codes ic ON icu.code_id = ic.id
-                WHERE icu.user_id = ?
-                ORDER BY icu.used_at DESC
-                LIMIT 1
-            ''', (user_id,))
+    def _invite_discount(self, cursor, user_id: int) -> float:
+        """查询用户最近使用的邀请码折扣百分比（内部方法，可在事务内调用）"""
+        cursor.execute(SQL_INVITE_DISCOUNT, (user_id,))
 
         row = cursor.fetchone()
-        conn.close()
-
         return row[0] if row else 0.0
 
     def record_invite_code_usage(self, user_id: int, original_amount: float, bonus_amount: float) -> bool:
@@ -1388,30 +2944,19 @@ class Database:
             return False, None, 0.0
 
         # 计算奖励（10%）
-        reward_amount = recharge_amount * 0.10
-
-        # 发放奖励
-        self.add_balance(inviter_id, reward_amount)
-
-        # 记录奖励
-        self.record_invite_reward(
-            inviter_user_id=inviter_id,
-            invitee_user_id=invitee_user_id,
-            recharge_amount=recharge_amount,
-            reward_amount=reward_amount,
-            recharge_record_id=recharge_record_id
-        )
+        reward_amount = recharge_amount * INVITE_REWARD_RATE
 
-        # 更新邀请关系表中的累计奖励
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-                UPDATE user_invitations
-                SET inviter_reward_total = inviter_reward_total + ?
-                WHERE inviter_user_id = ? AND invitee_user_id = ?
-            ''', (reward_amount, inviter_id, invitee_user_id))
-        conn.commit()
-        conn.close()
+        # 发放奖励并记录（同一事务）
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            self._apply_balance_change(cursor, inviter_id, reward_amount, 'invite_reward',
+                                       f"invitee:{invitee_user_id}")
+            self._insert_invite_reward(cursor, inviter_id, invitee_user_id,
+                                       recharge_amount, reward_amount, recharge_record_id)
+        self._invalidate_user_context(inviter_id)
+
+        self.log_operation(inviter_id, "invite_reward",
+                           f"邀请奖励: {reward_amount} USDT from user {invitee_user_id}")
 
         logger.info(
             f"邀请奖励已发放: 邀请人={inviter_id}, "
@@ -1438,50 +2983,23 @@ class Database:
         conn = self._get_connection()
         cursor = conn.cursor()
 
-        # 1. 获取我的邀请码
-        my_code = self.get_user_invite_code(user_id)
-
-        # 2. 统计我邀请的人数
-        cursor.execute('''
-                SELECT COUNT(*) FROM user_invitations 
-                WHERE inviter_user_id = ?
-            ''', (user_id,))
-        invitee_count = cursor.fetchone()[0]
+        cursor.execute(SQL_INVITE_STATS, (user_id,))
+        row = cursor.fetchone()
+        conn.close()
 
-        # 3. 统计累计奖励
-        cursor.execute('''
-                SELECT COALESCE(SUM(reward_amount), 0) FROM invite_rewards 
-                WHERE inviter_user_id = ?
-            ''', (user_id,))
-        total_reward = cursor.fetchone()[0]
+        my_code, invitee_count, total_reward = row[0], row[1], row[2]
 
-        # 4. 获取我的邀请人信息
-        cursor.execute('''
-                SELECT u.name, ui.invite_code, ui.inviter_reward_total, ui.created_at
-                FROM user_invitations ui
-                JOIN users u ON ui.inviter_user_id = u.user_id
-                WHERE ui.invitee_user_id = ?
-            ''', (user_id,))
-
-        inviter_row = cursor.fetchone()
         inviter_info = None
-        if inviter_row:
+        if row[3] is not None:
             inviter_info = {
-                'name': inviter_row[0],
-                'code': inviter_row[1],
-                'reward_contributed': inviter_row[2],
-                'joined_at': inviter_row[3]
+                'name': row[3],
+                'code': row[4],
+                'reward_contributed': row[5],
+                'joined_at': row[6]
             }
 
-        # 5. 检查是否使用过邀请码
-        cursor.execute('SELECT has_used_invite FROM users WHERE user_id = ?', (user_id,))
-        has_used_row = cursor.fetchone()
-        has_used_invite = bool(has_used_row[0]) if has_used_row else False
-
-        # 6. 获取我的折扣
-        my_discount = self.get_user_invite_discount(user_id)
-
-        conn.close()
+        has_used_invite = bool(row[7])
+        my_discount = row[8] if row[8] is not None else 0.0
 
         return {
             'my_code': my_code,
@@ -1492,6 +3010,45 @@ class Database:
             'my_discount': my_discount
         }
 
+    def rebuild_invite_stats(self) -> List[int]:
+        """
+        邀请统计一致性检查：从 user_invitations / invite_rewards 重建 invite_stats
+
+        Returns:
+            重建前统计与源数据不一致的邀请人 ID 列表
+        """
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DROP TABLE IF EXISTS temp.invite_stats_old')
+            cursor.execute(
+                'CREATE TEMP TABLE invite_stats_old AS '
+                'SELECT inviter_user_id, invitee_count, ROUND(total_reward, 6) AS total_reward '
+                'FROM invite_stats'
+            )
+            cursor.execute('DELETE FROM invite_stats')
+            cursor.execute(INVITE_STATS_REBUILD_SQL)
+            cursor.execute('''
+                SELECT inviter_user_id FROM (
+                    SELECT inviter_user_id, invitee_count, ROUND(total_reward, 6)
+                    FROM invite_stats
+                    EXCEPT
+                    SELECT inviter_user_id, invitee_count, total_reward FROM temp.invite_stats_old
+                )
+                UNION
+                SELECT inviter_user_id FROM (
+                    SELECT inviter_user_id, invitee_count, total_reward FROM temp.invite_stats_old
+                    EXCEPT
+                    SELECT inviter_user_id, invitee_count, ROUND(total_reward, 6)
+                    FROM invite_stats
+                )
+            ''')
+            drifted = [row[0] for row in cursor.fetchall()]
+            cursor.execute('DROP TABLE temp.invite_stats_old')
+
+        if drifted:
+            logger.warning(f"邀请统计不一致，已重建: {len(drifted)} 个邀请人 {drifted[:20]}")
+        return drifted
+
     def create_invite_code(
             self,
             code: str,
@@ -1513,6 +3070,8 @@ class Database:
 
             conn.commit()
             conn.close()
+            if owner_user_id:
+                self._invalidate_user_context(owner_user_id)
 
             logger.info(f"创建邀请码: {code}, 折扣: {discount_percent}%")
             return True, f"邀请码 {code} 创建成功"
@@ -1554,6 +3113,123 @@ class Database:
 
         return codes
 
+    # ========== 批量邀请码 ==========
+
+    def _insert_unique_codes(self, cursor, count: int, prefix: str, length: int, insert_sql: str,
+                             params, max_rounds: int = 10) -> List[str]:
+        """
+        生成 count 个唯一邀请码并写入（内部方法，调用方负责 BEGIN IMMEDIATE 事务）
+
+        候选码先用内存集合去重（每轮多生成一些以抵消冲突），再通过 executemany 写入临时表，
+        一次性剔除与 invite_codes / invite_code_pool 冲突的部分；不足的数量下一轮重新生成。
+
+        Args:
+            insert_sql: 从 temp.new_invite_codes(code) 写入目标表的 SQL
+            params: insert_sql 的参数
+        """
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS new_invite_codes (code TEXT PRIMARY KEY)')
+        cursor.execute('DELETE FROM temp.new_invite_codes')
+
+        space = len(INVITE_CODE_ALPHABET) ** length
+        accepted = 0
+        for _ in range(max_rounds):
+            missing = count - accepted
+            if missing <= 0:
+                break
+
+            candidates = set()
+            while len(candidates) < min(missing * 2 + 16, space):
+                candidates.add(prefix + ''.join(random.choices(INVITE_CODE_ALPHABET, k=length)))
+
+            cursor.executemany(
+                'INSERT OR IGNORE INTO temp.new_invite_codes (code) VALUES (?)',
+                ((code,) for code in candidates)
+            )
+            cursor.execute('''
+                DELETE FROM temp.new_invite_codes
+                WHERE code IN (SELECT code FROM invite_codes)
+                   OR code IN (SELECT code FROM invite_code_pool)
+            ''')
+            accepted = cursor.execute('SELECT COUNT(*) FROM temp.new_invite_codes').fetchone()[0]
+
+        cursor.execute('''
+            DELETE FROM temp.new_invite_codes
+            WHERE rowid NOT IN (SELECT rowid FROM temp.new_invite_codes ORDER BY rowid LIMIT ?)
+        ''', (count,))
+        codes = [row[0] for row in cursor.execute('SELECT code FROM temp.new_invite_codes')]
+        if len(codes) < count:
+            raise RuntimeError(f"邀请码空间不足: 需要 {count} 个，仅生成 {len(codes)} 个")
+
+        cursor.execute(insert_sql, params)
+        cursor.execute('DELETE FROM temp.new_invite_codes')
+        return codes
+
+    def generate_invite_codes(
+            self,
+            count: int,
+            prefix: str = "",
+            length: int = 8,
+            discount_percent: float = 10.0,
+            max_uses: int = 1
+    ) -> List[str]:
+        """
+        批量生成邀请码（管理员功能，用于推广活动预发放）
+
+        Args:
+            count: 数量
+            prefix: 邀请码前缀
+            length: 随机部分长度
+            discount_percent: 折扣百分比
+            max_uses: 最大使用次数（0 为不限）
+
+        Returns:
+            生成的邀请码列表
+        """
+        with self.transaction(immediate=True) as conn:
+            codes = self._insert_unique_codes(
+                conn.cursor(), count, prefix.upper(), length,
+                '''
+                    INSERT INTO invite_codes (code, max_uses, discount_percent, is_active)
+                    SELECT code, ?, ?, 1 FROM temp.new_invite_codes
+                ''',
+                (max_uses, discount_percent)
+            )
+
+        logger.info(f"批量生成邀请码: {len(codes)} 个, 前缀: {prefix or '-'}, 折扣: {discount_percent}%")
+        return codes
+
+    def refill_invite_code_pool(self, target: int = INVITE_CODE_POOL_SIZE) -> int:
+        """
+        补充用户邀请码池至 target 个
+
+        Returns:
+            新增数量
+        """
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            available = cursor.execute('SELECT COUNT(*) FROM invite_code_pool').fetchone()[0]
+            missing = target - available
+            if missing <= 0:
+                return 0
+
+            self._insert_unique_codes(
+                cursor, missing, "USER", 6,
+                'INSERT INTO invite_code_pool (code) SELECT code FROM temp.new_invite_codes',
+                ()
+            )
+
+        logger.info(f"邀请码池已补充 {missing} 个")
+        return missing
+
+    def _pop_pooled_invite_code(self, cursor) -> Optional[str]:
+        """从邀请码池取出一个邀请码（内部方法，调用方负责事务），池为空时返回 None"""
+        cursor.execute('SELECT id, code FROM invite_code_pool ORDER BY id LIMIT 1')
+        row = cursor.fetchone()
+        if not row:
+            return None
+        cursor.execute('DELETE FROM invite_code_pool WHERE id = ?', (row[0],))
+        return row[1]
+
     # ========== 补充：订阅相关表的创建 ==========
     # 注意：这部分需要添加到 create_tables() 方法中
 
@@ -1573,6 +3249,54 @@ class Database:
             ''')
 
 
+# ========== 异步门面 ==========
+
+class AsyncDatabase:
+    """
+    Database 的异步门面
+
+    与 Database 方法同名，所有调用都在专用的数据库线程池中执行并返回协程，
+    避免 SQLite 磁盘 IO 阻塞 Telegram 事件循环:
+
+        async_db = AsyncDatabase(db)
+        if await async_db.user_exists(user_id):
+            ...
+
+    其他同步调用（如 PaymentSystem 的方法）可以通过 run() 放到同一线程池执行。
+    多步事务请封装成同步函数后交给 run()，transaction() 不在异步接口中提供。
+    """
+
+    def __init__(self, db: Optional['Database'] = None, max_workers: int = 4):
+        self.db = db or Database()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db-worker')
+
+    async def run(self, func, *args, **kwargs):
+        """在数据库线程池中执行任意同步函数"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'transaction':
+            raise AttributeError(f"AsyncDatabase 不提供 {name}，请使用 run()")
+
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        # 缓存包装后的方法，后续访问不再经过 __getattr__
+        setattr(self, name, method)
+        return method
+
+    def shutdown(self, wait: bool = True):
+        """关闭数据库线程池"""
+        self._executor.shutdown(wait=wait)
+
+
 # ========== 使用说明 ==========
 """
 这些方法需要添加到 database_optimized.py 的 Database 类中。
@@ -1630,6 +3354,742 @@ def get_user_by_telegram_id(user_id: int) -> Optional[Dict]:
     return db.get_user_by_telegram_id(user_id)
 
 
+# ========== 性能测试 ==========
+
+def benchmark_connection_pool(db_file: str, iterations: int = 2000) -> Dict[str, Dict[str, float]]:
+    """
+    连接池微基准：对比每次新建连接（旧方式）与连接池的 ops/sec
+
+    测试方法: get_user_by_telegram_id, get_user_subscription
+
+    Returns:
+        {方法名: {'before': ops/sec, 'after': ops/sec}}
+    """
+    seed_db = Database(db_file)
+    seed_db.create_tables()
+    test_user_id = 900000001
+    if not seed_db.user_exists(test_user_id):
+        seed_db.insert_user(test_user_id, "benchmark")
+        seed_db.add_balance(test_user_id, 1000)
+        seed_db.create_subscription_flexible(test_user_id, 400)
+
+    results = {}
+    for method_name in ('get_user_by_telegram_id', 'get_user_subscription'):
+        results[method_name] = {}
+        for label, use_pool in (('before', False), ('after', True)):
+            method = getattr(Database(db_file, use_pool=use_pool), method_name)
+            method(test_user_id)  # 预热
+
+            started = time.perf_counter()
+            for _ in range(iterations):
+                method(test_user_id)
+            elapsed = time.perf_counter() - started
+
+            results[method_name][label] = iterations / elapsed if elapsed > 0 else float('inf')
+
+    return results
+
+
+def load_test_async_database(db_file: str, users: int = 500, rounds: int = 5) -> Dict[str, float]:
+    """
+    异步门面负载测试
+
+    模拟 users 个用户并发点击按钮，每次点击执行一组与 bot 处理器相同的查询
+    (user_exists → get_user_by_telegram_id → get_user_subscription → get_user_balance)，
+    同时用心跳任务测量事件循环的最大停顿。
+
+    Returns:
+        {'requests', 'p50_ms', 'p99_ms', 'max_ms', 'loop_lag_ms'}
+    """
+    seed_db = Database(db_file)
+    seed_db.create_tables()
+    with seed_db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, name, user_id) VALUES (?, ?, ?)',
+            ((f"load{uid}", f"user{uid}", uid) for uid in range(1, users + 1))
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO user_balance (user_id, balance) VALUES (?, 100)',
+            ((uid,) for uid in range(1, users + 1))
+        )
+
+    async def scenario() -> Tuple[List[float], float]:
+        async_db = AsyncDatabase(Database(db_file))
+        latencies = []
+        max_lag = 0.0
+        stop = asyncio.Event()
+
+        async def heartbeat():
+            nonlocal max_lag
+            interval = 0.005
+            while not stop.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(interval)
+                max_lag = max(max_lag, time.perf_counter() - started - interval)
+
+        async def simulated_user(uid: int):
+            for _ in range(rounds):
+                started = time.perf_counter()
+                if await async_db.user_exists(uid):
+                    await async_db.get_user_by_telegram_id(uid)
+                    await async_db.get_user_subscription(uid)
+                    await async_db.get_user_balance(uid)
+                latencies.append(time.perf_counter() - started)
+
+        beat = asyncio.create_task(heartbeat())
+        await asyncio.gather(*(simulated_user(uid) for uid in range(1, users + 1)))
+        stop.set()
+        await beat
+        async_db.shutdown()
+        return latencies, max_lag
+
+    latencies, loop_lag = asyncio.run(scenario())
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+        'max_ms': latencies[-1] * 1000,
+        'loop_lag_ms': loop_lag * 1000,
+    }
+
+
+def verify_hot_query_plans(db_file: str, rows: int = 100_000) -> Dict[str, List[str]]:
+    """
+    EXPLAIN QUERY PLAN 回归检查
+
+    向热点表写入 rows 行测试数据并执行 ANALYZE，之后检查所有热点查询，
+    任何查询退化为全表扫描时抛出 AssertionError。
+    """
+    db = Database(db_file)
+    db.create_tables()
+
+    with db.transaction() as conn:
+        user_ids = range(1, rows + 1)
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, name, user_id) VALUES (?, ?, ?)',
+            ((f"u{uid}", f"user{uid}", uid) for uid in user_ids)
+        )
+        conn.executemany('''
+            INSERT INTO user_subscriptions
+            (user_id, plan_id, tier_level, monthly_rate, payment_amount, actual_capital,
+             start_date, end_date, status)
+            VALUES (?, 1, 1, 1.0, 100, 10000, '2024-01-01', '2024-02-01', ?)
+        ''', ((uid, 'active' if uid % 3 else 'expired') for uid in user_ids))
+        conn.executemany(
+            'INSERT INTO recharge_records (user_id, amount, tx_hash, status) VALUES (?, 100, ?, ?)',
+            ((uid, f"tx{uid}", 'completed') for uid in user_ids)
+        )
+        conn.executemany(
+            'INSERT INTO invite_rewards (inviter_user_id, invitee_user_id, recharge_amount, reward_amount) '
+            'VALUES (?, ?, 100, 10)',
+            ((uid % 1000 + 1, uid) for uid in user_ids)
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO user_invitations (inviter_user_id, invitee_user_id, invite_code) '
+            'VALUES (?, ?, ?)',
+            ((uid % 1000 + 1, uid, f"USER{uid % 1000 + 1}") for uid in user_ids)
+        )
+        conn.executemany(
+            'INSERT INTO operation_logs (user_id, operation, details) VALUES (?, ?, ?)',
+            ((uid % 5000 + 1, 'benchmark', '') for uid in user_ids)
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO invite_codes (code, owner_user_id) VALUES (?, ?)',
+            ((f"USER{uid}", uid) for uid in user_ids)
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO invite_code_usage (code_id, user_id) VALUES (?, ?)',
+            ((uid % 1000 + 1, uid) for uid in user_ids)
+        )
+        conn.execute(INVITE_STATS_REBUILD_SQL)
+        conn.execute('ANALYZE')
+
+    scans = db.find_full_table_scans()
+    assert not scans, f"热点查询出现全表扫描: {scans}"
+    return scans
+
+
+def benchmark_expiry_sweep(db_file: str, rows: int = 1_000_000) -> Dict[str, float]:
+    """
+    订阅过期清理基准
+
+    写入 rows 条订阅（约 1/10 已到期），对比:
+    - lazy: 旧方式，逐用户读取订阅并单行 UPDATE（按到期用户数抽样后外推）
+    - sweep: expire_overdue_subscriptions() 分批过期，同时记录单批事务的最长耗时（写锁占用）
+
+    Returns:
+        {'rows', 'expired', 'lazy_sec', 'sweep_sec', 'chunks', 'max_chunk_ms'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+
+    now = datetime.now()
+    past = (now - timedelta(days=1)).isoformat(' ')
+    future = (now + timedelta(days=30)).isoformat(' ')
+    with db.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO user_subscriptions
+            (user_id, plan_id, tier_level, monthly_rate, payment_amount, actual_capital,
+             start_date, end_date, status)
+            VALUES (?, 1, 1, 1.0, 100, 10000, '2024-01-01', ?, 'active')
+        ''', ((uid, past if uid % 10 == 0 else future) for uid in range(1, rows + 1)))
+        conn.execute('ANALYZE')
+
+    overdue = rows // 10
+
+    # 旧方式：每个到期用户一次读取 + 一次单行 UPDATE（抽样 1000 个用户）
+    sample = min(1000, overdue)
+    started = time.perf_counter()
+    for uid in range(10, sample * 10 + 1, 10):
+        subscription = db.get_user_subscription(uid)
+        if subscription and datetime.fromisoformat(subscription['end_date']) < now:
+            conn = db._get_connection()
+            conn.execute("UPDATE user_subscriptions SET status = 'expired' WHERE id = ?",
+                         (subscription['id'],))
+            conn.commit()
+            conn.close()
+    lazy_sec = (time.perf_counter() - started) * overdue / sample if sample else 0.0
+
+    # 与 expire_overdue_subscriptions() 相同的步骤，逐批计时
+    cutoff = now.isoformat(' ')
+    candidates, chunk_times = set(), []
+    started = time.perf_counter()
+    while True:
+        chunk_started = time.perf_counter()
+        users = db._expire_subscription_chunk(cutoff, EXPIRY_CHUNK_ROWS)
+        chunk_times.append(time.perf_counter() - chunk_started)
+        candidates.update(users)
+        if len(users) < EXPIRY_CHUNK_ROWS:
+            break
+    expired_users = db._users_without_active_subscription(candidates, cutoff)
+    sweep_sec = time.perf_counter() - started
+
+    assert len(expired_users) == overdue - sample, (len(expired_users), overdue - sample)
+    assert db.expire_overdue_subscriptions(now) == []
+
+    return {
+        'rows': rows,
+        'expired': overdue,
+        'lazy_sec': lazy_sec,
+        'sweep_sec': sweep_sec,
+        'chunks': len(chunk_times),
+        'max_chunk_ms': max(chunk_times) * 1000,
+    }
+
+
+def verify_invite_stats(db_file: str, inviters: int = 1000, invitees_per_inviter: int = 20) -> Dict[str, float]:
+    """
+    邀请统计物化表检查
+
+    通过 apply_invite_code / process_invite_reward 写入邀请关系和奖励，检查:
+    - invite_stats 与源数据一致（rebuild_invite_stats 无差异）
+    - 排行榜人数与奖励没有 JOIN 扇出导致的放大
+    并对比旧的 JOIN 聚合排行榜与物化表排行榜的耗时。
+
+    Returns:
+        {'old_ms', 'new_ms'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+
+    invitee_id = inviters + 1
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, name, user_id) VALUES (?, ?, ?)',
+            ((f"inv{uid}", f"user{uid}", uid) for uid in range(1, inviters * (invitees_per_inviter + 1) + 1))
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO invite_codes (code, owner_user_id, max_uses, discount_percent) '
+            'VALUES (?, ?, 0, 10.0)',
+            ((f"USER{uid}", uid) for uid in range(1, inviters + 1))
+        )
+
+    # 少量用户走真实写入路径，其余批量写入源表后重建
+    for inviter in range(1, 4):
+        for _ in range(3):
+            success, _, message, _ = db.apply_invite_code(invitee_id, f"USER{inviter}")
+            assert success, message
+            db.process_invite_reward(invitee_id, 100.0)
+            db.process_invite_reward(invitee_id, 50.0)
+            invitee_id += 1
+
+    stats = db.get_invite_stats(1)
+    assert stats['invitee_count'] == 3 and abs(stats['total_reward'] - 45.0) < 1e-9, stats
+    assert db.get_user_balance(1) == 45.0
+    assert db.rebuild_invite_stats() == []
+
+    with db.transaction() as conn:
+        rows = [(uid % inviters + 1, uid) for uid in range(invitee_id, inviters * (invitees_per_inviter + 1) + 1)]
+        conn.executemany(
+            'INSERT OR IGNORE INTO user_invitations (inviter_user_id, invitee_user_id, invite_code) '
+            "VALUES (?, ?, 'BULK')", rows
+        )
+        conn.executemany(
+            'INSERT INTO invite_rewards (inviter_user_id, invitee_user_id, recharge_amount, reward_amount) '
+            'VALUES (?, ?, 100, 10)', rows
+        )
+    drifted = db.rebuild_invite_stats()
+    assert drifted and db.rebuild_invite_stats() == []
+
+    conn = db._get_connection()
+    started = time.perf_counter()
+    old_top = conn.execute('''
+        SELECT u.user_id, COUNT(ui.id) AS invite_count, COALESCE(SUM(ir.reward_amount), 0)
+        FROM users u
+        LEFT JOIN user_invitations ui ON u.user_id = ui.inviter_user_id
+        LEFT JOIN invite_rewards ir ON u.user_id = ir.inviter_user_id
+        GROUP BY u.user_id
+        HAVING invite_count > 0
+        ORDER BY invite_count DESC
+        LIMIT 10
+    ''').fetchall()
+    old_ms = (time.perf_counter() - started) * 1000
+    conn.close()
+
+    started = time.perf_counter()
+    leaderboard = db.get_invite_leaderboard(10)
+    new_ms = (time.perf_counter() - started) * 1000
+
+    top = leaderboard[0]
+    conn = db._get_connection()
+    true_count, true_reward = conn.execute(
+        'SELECT (SELECT COUNT(*) FROM user_invitations WHERE inviter_user_id = ?), '
+        '(SELECT SUM(reward_amount) FROM invite_rewards WHERE inviter_user_id = ?)',
+        (top['user_id'], top['user_id'])
+    ).fetchone()
+    conn.close()
+    assert top['invite_count'] == true_count and abs(top['total_rewards'] - true_reward) < 1e-6
+    assert old_top[0][1] > true_count, "旧排行榜应存在扇出放大"
+
+    return {'old_ms': old_ms, 'new_ms': new_ms}
+
+
+def benchmark_balance_ledger(db_file: str, threads: int = 8, ops_per_thread: int = 500,
+                             users: int = 20) -> Dict[str, float]:
+    """
+    余额并发基准
+
+    threads 个线程对 users 个用户并发执行 2:1 的充值/扣款混合操作，对比:
+    - legacy: 旧方式（先 SELECT 再按 Python 计算结果 UPDATE），统计丢失的更新
+    - ledger: add_balance / deduct_balance（单条 UPDATE + 流水）
+    以及 credit_balances 批量入账与逐笔 add_balance 的吞吐。
+
+    Returns:
+        {'legacy_ops', 'legacy_lost', 'ledger_ops', 'ledger_lost', 'bulk_ops', 'single_ops'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+    user_ids = list(range(1, users + 1))
+
+    def legacy_change(user_id: int, amount: float) -> bool:
+        conn = db._get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT balance FROM user_balance WHERE user_id = ?', (user_id,))
+        balance = cursor.fetchone()[0]
+        if balance + amount < 0:
+            conn.close()
+            return False
+        cursor.execute('UPDATE user_balance SET balance = ? WHERE user_id = ?', (balance + amount, user_id))
+        conn.commit()
+        conn.close()
+        return True
+
+    def ledger_change(user_id: int, amount: float) -> bool:
+        if amount >= 0:
+            return db.add_balance(user_id, amount)
+        return db.deduct_balance(user_id, -amount)
+
+    def run(change) -> Tuple[float, float]:
+        with db.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO user_balance (user_id, balance) VALUES (?, 0)',
+                ((uid,) for uid in user_ids)
+            )
+            conn.execute('DELETE FROM balance_ledger')
+
+        applied = [0.0] * threads
+
+        def worker(index: int):
+            for i in range(ops_per_thread):
+                user_id = user_ids[(index + i) % users]
+                amount = -5.0 if i % 3 == 2 else 10.0
+                if change(user_id, amount):
+                    applied[index] += amount
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        started = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        conn = db._get_connection()
+        total = conn.execute('SELECT SUM(balance) FROM user_balance').fetchone()[0]
+        conn.close()
+        return threads * ops_per_thread / elapsed, abs(sum(applied) - total)
+
+    legacy_ops, legacy_lost = run(legacy_change)
+    ledger_ops, ledger_lost = run(ledger_change)
+    assert ledger_lost < 1e-6, f"余额更新丢失: {ledger_lost}"
+    assert db.check_balance_ledger() == []
+
+    credits = [(uid, 1.0) for uid in range(1, 5001)]
+    started = time.perf_counter()
+    db.credit_balances(credits)
+    bulk_ops = len(credits) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for user_id, amount in credits[:1000]:
+        db.add_balance(user_id, amount)
+    single_ops = 1000 / (time.perf_counter() - started)
+
+    assert db.check_balance_ledger() == []
+    assert db.deduct_balance(1, 1e9) is False
+
+    return {
+        'legacy_ops': legacy_ops,
+        'legacy_lost': legacy_lost,
+        'ledger_ops': ledger_ops,
+        'ledger_lost': ledger_lost,
+        'bulk_ops': bulk_ops,
+        'single_ops': single_ops,
+    }
+
+
+def benchmark_recharge_queue(db_file: str, deposits: int = 2000, users: int = 500,
+                             workers: int = 4) -> Dict[str, float]:
+    """
+    充值结算队列检查
+
+    - deposits 笔充值分给 users 个用户（偶数用户有邀请人，user_id % 4 == 1 的用户使用过 10% 折扣邀请码），
+      全部入队两次，workers 个线程并发领取结算，校验每笔只入账一次、余额与流水一致
+    - 重放：再次入队并结算全部交易，不应产生任何变化
+    - 崩溃：结算事务中途抛出异常，不应留下充值记录或余额变化；领取后未完成的任务超时后可被重新领取
+
+    Returns:
+        {'settle_ops', 'duplicates_ignored', 'balance_total', 'expected_total'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+    inviter_id = 1
+    user_ids = list(range(100, 100 + users))
+
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO invite_codes (code, owner_user_id, discount_percent) VALUES ('BENCH10', ?, 10)",
+                     (inviter_id,))
+        code_id = conn.execute("SELECT id FROM invite_codes WHERE code = 'BENCH10'").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO user_invitations (inviter_user_id, invitee_user_id, invite_code) VALUES (?, ?, 'BENCH10')",
+            [(inviter_id, uid) for uid in user_ids if uid % 2 == 0]
+        )
+        conn.executemany('INSERT INTO invite_code_usage (code_id, user_id) VALUES (?, ?)',
+                         [(code_id, uid) for uid in user_ids if uid % 4 == 1])
+        # 邀请关系直接写入，同步一次统计
+        conn.execute(INVITE_STATS_REBUILD_SQL)
+
+    recharges = [
+        {'user_id': user_ids[i % users], 'address': f"T{user_ids[i % users]}", 'amount': float(100 + i % 7),
+         'tx_hash': f"tx{i:08d}", 'timestamp': i}
+        for i in range(deposits)
+    ]
+    expected_total = sum(
+        r['amount'] * (1.1 if r['user_id'] % 4 == 1 else 1.0)
+        + (r['amount'] * INVITE_REWARD_RATE if r['user_id'] % 2 == 0 else 0.0)
+        for r in recharges
+    )
+
+    def balance_total() -> float:
+        conn = db._get_connection()
+        total = conn.execute('SELECT COALESCE(SUM(balance), 0) FROM user_balance').fetchone()[0]
+        conn.close()
+        return total
+
+    def record_count() -> int:
+        conn = db._get_connection()
+        count = conn.execute('SELECT COUNT(*) FROM recharge_records').fetchone()[0]
+        conn.close()
+        return count
+
+    # 重复入队：第二次全部被 (tx_hash, user_id) 唯一约束忽略
+    assert db.enqueue_recharges(recharges) == deposits
+    duplicates_ignored = deposits - db.enqueue_recharges(recharges)
+
+    def worker():
+        while True:
+            jobs = db.claim_recharges(limit=10)
+            if not jobs:
+                return
+            for job in jobs:
+                db.settle_recharge(job['tx_hash'], job['user_id'])
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    settle_ops = deposits / (time.perf_counter() - started)
+
+    assert db.get_recharge_queue_stats() == {'done': deposits}
+    assert record_count() == deposits
+    assert abs(balance_total() - expected_total) < 1e-6, f"{balance_total()} != {expected_total}"
+    assert db.check_balance_ledger() == []
+    assert db.rebuild_invite_stats() == []
+
+    # 重放：重复入队 + 重复结算不产生任何变化
+    assert db.enqueue_recharges(recharges) == 0
+    assert all(db.settle_recharge(r['tx_hash'], r['user_id']) is None for r in recharges[:100])
+    assert record_count() == deposits
+    assert abs(balance_total() - expected_total) < 1e-6
+
+    # 崩溃：邀请奖励写入时抛出异常，整笔结算回滚
+    crash = {'user_id': user_ids[0], 'address': 'T0', 'amount': 50.0, 'tx_hash': 'tx_crash', 'timestamp': 0}
+    assert user_ids[0] % 2 == 0
+    db.enqueue_recharges([crash])
+    assert [job['tx_hash'] for job in db.claim_recharges()] == ['tx_crash']
+
+    insert_invite_reward = db._insert_invite_reward
+
+    def broken_insert(*args, **kwargs):
+        raise sqlite3.OperationalError("simulated crash")
+
+    db._insert_invite_reward = broken_insert
+    try:
+        db.settle_recharge('tx_crash', crash['user_id'])
+        raise AssertionError("结算应当失败")
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        db._insert_invite_reward = insert_invite_reward
+
+    assert record_count() == deposits
+    assert abs(balance_total() - expected_total) < 1e-6, "失败的结算不应留下余额变化"
+
+    # worker 崩溃后任务停留在 processing，超时后可被重新领取
+    assert db.claim_recharges() == []
+    reclaimed = db.claim_recharges(stale_after=0)
+    assert [job['tx_hash'] for job in reclaimed] == ['tx_crash'] and reclaimed[0]['attempts'] == 2
+    assert db.settle_recharge('tx_crash', crash['user_id'])['reward_amount'] == 50.0 * INVITE_REWARD_RATE
+    expected_total += 50.0 * (1 + INVITE_REWARD_RATE)
+
+    # 超过重试次数标记为 failed
+    db.enqueue_recharges([dict(crash, tx_hash='tx_failed')])
+    for _ in range(2):
+        db.claim_recharges()
+        db.fail_recharge('tx_failed', crash['user_id'], 'rpc error', max_attempts=2)
+    assert db.get_recharge_queue_stats()['failed'] == 1
+    assert db.claim_recharges() == []
+
+    # 一笔交易同时转给两个受监控地址：两个用户各入账一次
+    batch = [
+        {'user_id': uid, 'address': f"T{uid}", 'amount': 20.0, 'tx_hash': 'tx_batch', 'timestamp': 0}
+        for uid in user_ids[1:3]
+    ]
+    assert db.enqueue_recharges(batch) == 2
+    assert db.enqueue_recharges(batch) == 0
+    assert all(db.get_processed_tx_hashes(r['user_id'], ['tx_batch']) == set() for r in batch)
+    for job in db.claim_recharges():
+        assert db.settle_recharge(job['tx_hash'], job['user_id']) is not None
+    assert all(db.get_processed_tx_hashes(r['user_id'], ['tx_batch']) == {'tx_batch'} for r in batch)
+    expected_total += sum(
+        r['amount'] * (1.1 if r['user_id'] % 4 == 1 else 1.0)
+        + (r['amount'] * INVITE_REWARD_RATE if r['user_id'] % 2 == 0 else 0.0)
+        for r in batch
+    )
+    assert abs(balance_total() - expected_total) < 1e-6
+
+    return {
+        'settle_ops': settle_ops,
+        'duplicates_ignored': duplicates_ignored,
+        'balance_total': balance_total(),
+        'expected_total': expected_total,
+    }
+
+
+def benchmark_operation_logs(db_file: str, count: int = 20000, months: int = 6) -> Dict[str, float]:
+    """
+    操作日志写入与归档检查
+
+    - 对比逐条提交（旧方式）与批量写入器的 log_operation 吞吐
+    - 写入跨 months 个月的历史日志，归档 30 天前的记录，检查主库行数、
+      归档文件以及 query_operation_logs 跨文件查询结果
+
+    Returns:
+        {'direct_ops', 'buffered_ops', 'archived', 'main_rows', 'size_before_kb', 'size_after_kb'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+
+    conn = db._get_connection()
+    started = time.perf_counter()
+    for i in range(count // 10):
+        conn.execute(
+            'INSERT INTO operation_logs (user_id, operation, details) VALUES (?, ?, ?)',
+            (i % 100, 'benchmark', 'direct')
+        )
+        conn.commit()
+    direct_ops = (count // 10) / (time.perf_counter() - started)
+    conn.execute("DELETE FROM operation_logs")
+    conn.commit()
+    conn.close()
+
+    started = time.perf_counter()
+    for i in range(count):
+        db.log_operation(i % 100, 'benchmark', 'buffered')
+    db.flush_operation_logs()
+    buffered_ops = count / (time.perf_counter() - started)
+
+    # 历史日志：每天 50 条，覆盖 months 个月
+    now = time.time()
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO operation_logs (user_id, operation, details, timestamp) VALUES (?, ?, ?, ?)',
+            ((n % 100, 'history', str(day),
+              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - day * 86400 - n)))
+             # n 从 1 开始：恰好等于截止秒的记录会在下一秒的第二次归档中才被归档
+             for day in range(1, months * 30 + 1) for n in range(1, 51))
+        )
+        total_rows = conn.execute('SELECT COUNT(*) FROM operation_logs').fetchone()[0]
+
+    conn = db._get_connection()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    conn.close()
+    size_before = os.path.getsize(db_file)
+    archived = db.archive_operation_logs(days=30)
+    assert db.archive_operation_logs(days=30) == {}
+    size_after = os.path.getsize(db_file)
+    assert size_after < size_before, (size_before, size_after)
+
+    conn = db._get_connection()
+    main_rows = conn.execute('SELECT COUNT(*) FROM operation_logs').fetchone()[0]
+    oldest = conn.execute('SELECT MIN(timestamp) FROM operation_logs').fetchone()[0]
+    conn.close()
+
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - 30 * 86400))
+    assert oldest >= cutoff and main_rows + sum(archived.values()) == total_rows
+    assert len(glob.glob(os.path.join(db._archive_dir(), 'operation_logs_*.db'))) == len(archived)
+
+    user_history = [row for row in db.query_operation_logs(user_id=7, limit=100000)
+                    if row['operation'] == 'history']
+    assert len(user_history) == months * 30
+    window = db.query_operation_logs(
+        since=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - 90 * 86400)),
+        until=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - 60 * 86400)),
+        limit=100000
+    )
+    assert len(window) == 30 * 50, len(window)
+
+    return {
+        'direct_ops': direct_ops,
+        'buffered_ops': buffered_ops,
+        'archived': sum(archived.values()),
+        'main_rows': main_rows,
+        'size_before_kb': size_before / 1024,
+        'size_after_kb': size_after / 1024,
+    }
+
+
+def benchmark_invite_codes(db_file: str, count: int = 20000, users: int = 1000) -> Dict[str, float]:
+    """
+    批量邀请码基准
+
+    - 旧方式：逐个随机生成 → SELECT 检查 → INSERT 并提交（抽样 2000 个后外推）
+    - generate_invite_codes: 内存去重 + executemany 一次写入
+    - 邀请码池：refill_invite_code_pool 后为 users 个用户 create_user_invite_code
+
+    Returns:
+        {'loop_sec', 'bulk_sec', 'pool_ops'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+
+    sample = 2000
+    conn = db._get_connection()
+    started = time.perf_counter()
+    for _ in range(sample):
+        code = "OLD" + ''.join(random.choices(INVITE_CODE_ALPHABET, k=8))
+        if not conn.execute('SELECT 1 FROM invite_codes WHERE code = ?', (code,)).fetchone():
+            conn.execute('INSERT INTO invite_codes (code, max_uses, discount_percent) VALUES (?, 1, 10.0)', (code,))
+            conn.commit()
+    loop_sec = (time.perf_counter() - started) * count / sample
+    conn.close()
+
+    started = time.perf_counter()
+    codes = db.generate_invite_codes(count, prefix="CAMP")
+    bulk_sec = time.perf_counter() - started
+
+    conn = db._get_connection()
+    stored = conn.execute("SELECT COUNT(DISTINCT code) FROM invite_codes WHERE code LIKE 'CAMP%'").fetchone()[0]
+    conn.close()
+    assert len(set(codes)) == count == stored
+
+    # 极小的码空间也能通过重试凑满且不冲突
+    tiny = db.generate_invite_codes(30, prefix="T", length=1)
+    tiny += db.generate_invite_codes(2, prefix="T", length=1)
+    assert len(set(tiny)) == 32
+
+    assert db.refill_invite_code_pool(users) == users
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, name, user_id) VALUES (?, ?, ?)',
+            ((f"code{uid}", f"user{uid}", uid) for uid in range(1, users + 1))
+        )
+
+    started = time.perf_counter()
+    for uid in range(1, users + 1):
+        db.create_user_invite_code(uid)
+    pool_ops = users / (time.perf_counter() - started)
+
+    conn = db._get_connection()
+    remaining = conn.execute('SELECT COUNT(*) FROM invite_code_pool').fetchone()[0]
+    conn.close()
+    assert remaining == 0
+    assert db.refill_invite_code_pool(10) == 10
+
+    return {'loop_sec': loop_sec, 'bulk_sec': bulk_sec, 'pool_ops': pool_ops}
+
+
+def benchmark_plan_cache(db_file: str, iterations: int = 20000) -> Dict[str, float]:
+    """
+    套餐缓存基准：对比 SQL 查询与缓存 + bisect 的档位匹配，并校验两者结果一致
+
+    Returns:
+        {'sql_ops', 'cached_ops'}
+    """
+    db = Database(db_file)
+    db.create_tables()
+    payments = [50 + (i * 37) % 3500 for i in range(iterations)]
+
+    conn = db._get_connection()
+    sql = '''
+        SELECT id FROM subscription_plans
+        WHERE min_payment_30days <= ?
+        ORDER BY tier_level DESC
+        LIMIT 1
+    '''
+    started = time.perf_counter()
+    expected = [conn.execute(sql, (payment,)).fetchone() for payment in payments]
+    sql_ops = iterations / (time.perf_counter() - started)
+    conn.close()
+
+    db.get_tier_by_payment(0)  # 预热加载
+    started = time.perf_counter()
+    tiers = [db.get_tier_by_payment(payment) for payment in payments]
+    cached_ops = iterations / (time.perf_counter() - started)
+
+    for row, tier in zip(expected, tiers):
+        assert (row[0] if row else None) == (tier['id'] if tier else None)
+    assert db.get_plan_by_id(expected[-1][0])['id'] == expected[-1][0]
+
+    return {'sql_ops': sql_ops, 'cached_ops': cached_ops}
+
+
 # ========== 测试代码 ==========
 
 if __name__ == "__main__":
@@ -1694,6 +4154,128 @@ if __name__ == "__main__":
         print(f"   标准额度: {plan['standard_capital']:,} USDT")
         print(f"   {plan['description']}")
 
+    # 连接池性能对比
+    print("\n" + "=" * 70)
+    print("测试: 连接池性能 (ops/sec)")
+    print("=" * 70)
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench = benchmark_connection_pool(os.path.join(tmp_dir, "bench.db"))
+        for name, result in bench.items():
+            speedup = result['after'] / result['before'] if result['before'] else 0
+            print(f"{name:28s} | 新建连接 {result['before']:10,.0f} | "
+                  f"连接池 {result['after']:10,.0f} | 提升 {speedup:.1f}x")
+        close_database(os.path.join(tmp_dir, "bench.db"))
+
+    # 异步门面负载测试
+    print("\n" + "=" * 70)
+    print("测试: 异步门面负载 (500 并发用户)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        load_db = os.path.join(tmp_dir, "load.db")
+        load = load_test_async_database(load_db)
+        print(f"请求数 {load['requests']} | p50 {load['p50_ms']:.1f}ms | p99 {load['p99_ms']:.1f}ms | "
+              f"最大 {load['max_ms']:.1f}ms | 事件循环最大停顿 {load['loop_lag_ms']:.1f}ms")
+        close_database(load_db)
+
+    # 热点查询执行计划检查
+    print("\n" + "=" * 70)
+    print("测试: 热点查询执行计划 (100k 行)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plan_db = os.path.join(tmp_dir, "plans.db")
+        verify_hot_query_plans(plan_db)
+        print(f"✅ {len(HOT_QUERIES)} 个热点查询均使用索引 | 结构版本 v{Database(plan_db).get_schema_version()}")
+        close_database(plan_db)
+
+    # 订阅过期批量清理
+    print("\n" + "=" * 70)
+    print("测试: 订阅过期批量清理 (1M 行)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sweep_db = os.path.join(tmp_dir, "sweep.db")
+        sweep = benchmark_expiry_sweep(sweep_db)
+        print(f"订阅 {sweep['rows']:,} 条 | 到期 {sweep['expired']:,} 条 | "
+              f"逐条过期(外推) {sweep['lazy_sec']:.2f}s | 批量清理 {sweep['sweep_sec']:.2f}s "
+              f"({sweep['chunks']} 批, 单批最长 {sweep['max_chunk_ms']:.0f}ms)")
+        close_database(sweep_db)
+
+    # 邀请统计物化表
+    print("\n" + "=" * 70)
+    print("测试: 邀请统计物化表")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        invite_db = os.path.join(tmp_dir, "invite.db")
+        invite = verify_invite_stats(invite_db)
+        print(f"✅ 统计一致 | 排行榜 JOIN 聚合 {invite['old_ms']:.1f}ms → 物化表 {invite['new_ms']:.2f}ms")
+        close_database(invite_db)
+
+    # 余额并发
+    print("\n" + "=" * 70)
+    print("测试: 余额并发充值/扣款 (8 线程)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ledger_db = os.path.join(tmp_dir, "ledger.db")
+        ledger = benchmark_balance_ledger(ledger_db)
+        print(f"旧方式 {ledger['legacy_ops']:8,.0f} ops/s 丢失 {ledger['legacy_lost']:.2f} USDT | "
+              f"流水 {ledger['ledger_ops']:8,.0f} ops/s 丢失 {ledger['ledger_lost']:.2f} USDT")
+        print(f"批量入账 {ledger['bulk_ops']:10,.0f} ops/s | 逐笔入账 {ledger['single_ops']:10,.0f} ops/s")
+        close_database(ledger_db)
+
+    # 充值结算队列
+    print("\n" + "=" * 70)
+    print("测试: 充值结算队列 (2000 笔, 4 个 worker)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_db = os.path.join(tmp_dir, "queue.db")
+        queue = benchmark_recharge_queue(queue_db)
+        print(f"结算 {queue['settle_ops']:,.0f} 笔/s | 重复入队忽略 {queue['duplicates_ignored']} 笔 | "
+              f"✅ 余额合计 {queue['balance_total']:,.2f} = 预期 {queue['expected_total']:,.2f}")
+        close_database(queue_db)
+
+    # 操作日志批量写入与归档
+    print("\n" + "=" * 70)
+    print("测试: 操作日志批量写入与按月归档")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_db = os.path.join(tmp_dir, "logs.db")
+        logs = benchmark_operation_logs(log_db)
+        print(f"逐条提交 {logs['direct_ops']:10,.0f} ops/s | 批量写入 {logs['buffered_ops']:10,.0f} ops/s")
+        print(f"✅ 归档 {logs['archived']:,} 条 | 主库保留 {logs['main_rows']:,} 条 | "
+              f"主库文件 {logs['size_before_kb']:,.0f}KB → {logs['size_after_kb']:,.0f}KB")
+        close_database(log_db)
+
+    # 批量邀请码
+    print("\n" + "=" * 70)
+    print("测试: 批量生成邀请码 (20k) 与邀请码池")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        code_db = os.path.join(tmp_dir, "codes.db")
+        codes = benchmark_invite_codes(code_db)
+        print(f"逐个生成(外推) {codes['loop_sec']:.2f}s | 批量生成 {codes['bulk_sec']:.2f}s | "
+              f"邀请码池分配 {codes['pool_ops']:,.0f} 用户/s")
+        close_database(code_db)
+
+    # 套餐缓存
+    print("\n" + "=" * 70)
+    print("测试: 套餐缓存档位匹配 (ops/sec)")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plan_cache_db = os.path.join(tmp_dir, "plans.db")
+        plan_bench = benchmark_plan_cache(plan_cache_db)
+        print(f"SQL 查询 {plan_bench['sql_ops']:12,.0f} | 缓存 + bisect {plan_bench['cached_ops']:12,.0f}")
+        close_database(plan_cache_db)
+
     print("\n" + "=" * 70)
     print("所有测试完成!")
     print("=" * 70)
\ No newline at end of file
@@ -0,0 +1,692 @@
+"""
+fake_trongrid.py - 本地模拟 TronGrid 服务
+功能：
+1. 模拟 /v1/accounts/{address}/transactions/trc20 接口（固定延迟 + 每秒请求配额）
+2. 模拟 /v1/contracts/{contract}/events 接口（按区块时间过滤 + fingerprint 分页）
+3. 对比顺序轮询与 TronGridScanner 并发扫描 10k 地址的耗时
+4. 对比逐地址轮询与合约事件扫描的请求数，并校验检查点续扫
+5. 校验逐地址增量游标（翻页、只拉取新转账）与批量查重
+6. 充值地址预生成与 LRU 缓存基准
+7. 自适应轮询调度模拟（请求数与检测延迟）
+8. /metrics 指标导出校验
+
+运行: python fake_trongrid.py
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left, bisect_right
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from tronpy.keys import to_base58check_address, to_hex_address
+
+from database import Database, close_database
+from payment_system import (AddressCache, PaymentSystem, PollScheduler, TronGridScanner,
+                            start_metrics_server)
+
+USDT_CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+CHAIN_START_MS = 1700000000000
+BLOCK_INTERVAL_MS = 3000
+
+
+def fake_address(index: int) -> str:
+    """生成确定性的测试地址（合法的 base58check 格式，无对应私钥）"""
+    return to_base58check_address('41' + hashlib.sha256(str(index).encode()).hexdigest()[:40])
+
+
+def fake_transfers(address: str, count: int = None) -> List[Dict]:
+    """每个地址确定性地生成 count（默认 0~2）笔 USDT 转入，按时间升序"""
+    seed = int(hashlib.sha256(address.encode()).hexdigest(), 16)
+    transfers = []
+    for n in range(seed % 3 if count is None else count):
+        transfers.append({
+            'transaction_id': hashlib.sha256(f"{address}:{n}".encode()).hexdigest(),
+            'token_info': {'symbol': 'USDT', 'address': USDT_CONTRACT, 'decimals': 6},
+            'block_timestamp': 1700000000000 + n * 3000,
+            'from': fake_address(-1),
+            'to': address,
+            'type': 'Transfer',
+            'value': str((seed % 1000 + 100) * 1_000_000),
+        })
+    return transfers
+
+
+def fake_transfer_events(addresses: List[str], blocks: int, noise_per_block: int = 0) -> List[Dict]:
+    """
+    生成 USDT 合约 Transfer 事件流（按区块时间升序）
+
+    addresses 中每个地址的 fake_transfers 分布到确定性的区块上（交易哈希与逐地址接口一致），
+    另外每个区块附加 noise_per_block 笔与监控地址无关的转账。
+    地址按 TronGrid 事件格式输出为 0x 开头的 hex。
+    """
+    def hex_address(address: str) -> str:
+        return '0x' + to_hex_address(address)[2:]
+
+    def event(tx_hash: str, block: int, sender: str, receiver: str, value: str) -> Dict:
+        return {
+            'transaction_id': tx_hash,
+            'block_number': block,
+            'block_timestamp': CHAIN_START_MS + block * BLOCK_INTERVAL_MS,
+            'contract_address': USDT_CONTRACT,
+            'event_name': 'Transfer',
+            'event_index': 0,
+            'result': {'from': hex_address(sender), 'to': hex_address(receiver), 'value': value},
+        }
+
+    events = []
+    sender = fake_address(-1)
+
+    for address in addresses:
+        for transfer in fake_transfers(address):
+            block = int(transfer['transaction_id'][:8], 16) % blocks
+            events.append(event(transfer['transaction_id'], block, sender, address, transfer['value']))
+
+    for block in range(blocks):
+        for n in range(noise_per_block):
+            tx_hash = hashlib.sha256(f"noise:{block}:{n}".encode()).hexdigest()
+            events.append(event(tx_hash, block, sender, fake_address(-2 - n), '1000000'))
+
+    events.sort(key=lambda e: e['block_timestamp'])
+    return events
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 并发扫描会同时建立数百个连接
+
+
+class FakeTronGrid:
+    """
+    本地模拟 TronGrid
+
+    latency: 每个请求的固定延迟（秒）
+    rate_limit: 每秒请求配额（按自然秒计数，超出返回 429），0 为不限
+    events: 合约事件接口返回的 Transfer 事件（按区块时间升序，见 fake_transfer_events）
+    transfer_counts: 指定部分地址的转入笔数（默认 0~2 笔，见 fake_transfers）
+    """
+
+    def __init__(self, latency: float = 0.1, rate_limit: int = 0, port: int = 0,
+                 events: List[Dict] = None, transfer_counts: Dict[str, int] = None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.events = events or []
+        self._event_times = [e['block_timestamp'] for e in self.events]
+        self.transfer_counts = transfer_counts or {}
+        self.served_transfers = 0
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._window = 0
+        self._window_count = 0
+        self._server = _Server(('127.0.0.1', port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> 'FakeTronGrid':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _allow(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            if not self.rate_limit:
+                return True
+            window = int(time.time())
+            if window != self._window:
+                self._window, self._window_count = window, 0
+            self._window_count += 1
+            if self._window_count > self.rate_limit:
+                self.throttled += 1
+                return False
+            return True
+
+    def _transfers_page(self, address: str, params: Dict[str, List[str]]) -> Dict:
+        """按 min_timestamp（含）过滤地址转入，默认最新在前，fingerprint 为下一页的偏移量"""
+        transfers = fake_transfers(address, self.transfer_counts.get(address))
+        min_timestamp = int(params.get('min_timestamp', ['0'])[0])
+        transfers = [t for t in transfers if t['block_timestamp'] >= min_timestamp]
+        if params.get('order_by', [''])[0] != 'block_timestamp,asc':
+            transfers.reverse()
+
+        offset = int(params.get('fingerprint', ['0'])[0])
+        limit = int(params.get('limit', ['20'])[0])
+        page = transfers[offset:offset + limit]
+        with self._lock:
+            self.served_transfers += len(page)
+
+        meta = {'page_size': len(page)}
+        if offset + limit < len(transfers):
+            meta['fingerprint'] = str(offset + limit)
+        return {'data': page, 'success': True, 'meta': meta}
+
+    def _events_page(self, params: Dict[str, List[str]]) -> Dict:
+        """按 min/max_block_timestamp（含端点）过滤事件，fingerprint 为下一页的偏移量"""
+        low = bisect_left(self._event_times, int(params.get('min_block_timestamp', ['0'])[0]))
+        high = bisect_right(self._event_times, int(params.get('max_block_timestamp', [str(2 ** 63)])[0]))
+        offset = low + int(params.get('fingerprint', ['0'])[0])
+        limit = int(params.get('limit', ['20'])[0])
+
+        page = self.events[offset:min(offset + limit, high)]
+        meta = {'page_size': len(page)}
+        if offset + limit < high:
+            meta['fingerprint'] = str(offset + limit - low)
+        return {'data': page, 'success': True, 'meta': meta}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # keep-alive 下避免响应头/体分包触发 40ms 延迟确认
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, payload: Dict):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if not fake._allow():
+                    self._send(429, {'success': False, 'error': 'rate limit exceeded'})
+                    return
+
+                time.sleep(fake.latency)
+                parsed = urlparse(self.path)
+                parts = parsed.path.strip('/').split('/')
+                params = parse_qs(parsed.query)
+
+                # /v1/accounts/{address}/transactions/trc20
+                if len(parts) == 5 and parts[:2] == ['v1', 'accounts'] and parts[3:] == ['transactions', 'trc20']:
+                    self._send(200, fake._transfers_page(parts[2], params))
+                    return
+
+                # /v1/contracts/{contract}/events
+                if len(parts) == 4 and parts[:2] == ['v1', 'contracts'] and parts[3] == 'events':
+                    self._send(200, fake._events_page(params))
+                    return
+
+                self._send(404, {'success': False, 'error': 'not found'})
+
+        return Handler
+
+
+def benchmark_scan(addresses: int = 10000, latency: float = 0.1, rate_limit: int = 1000,
+                   sequential_sample: int = 100) -> Dict[str, float]:
+    """
+    扫描基准
+
+    - sequential: 旧方式（逐个地址 requests.get），抽样后外推到全部地址
+    - concurrent: TronGridScanner（令牌桶速率 = 服务端配额）
+
+    Returns:
+        {'sequential_sec', 'concurrent_sec', 'expected_sec', 'throttled', 'found'}
+    """
+    server = FakeTronGrid(latency=latency, rate_limit=rate_limit).start()
+    targets = {user_id: fake_address(user_id) for user_id in range(1, addresses + 1)}
+
+    try:
+        started = time.perf_counter()
+        for user_id in range(1, sequential_sample + 1):
+            requests.get(
+                f"{server.url}/v1/accounts/{targets[user_id]}/transactions/trc20",
+                params={'limit': 50, 'contract_address': USDT_CONTRACT},
+                timeout=10
+            ).json()
+        sequential_sec = (time.perf_counter() - started) * addresses / sequential_sample
+
+        async def sweep():
+            async with TronGridScanner(server.url, USDT_CONTRACT, rate_limit=rate_limit,
+                                       concurrency=int(rate_limit * latency * 2) + 1) as scanner:
+                started = time.perf_counter()
+                results = await scanner.scan(targets)
+                return time.perf_counter() - started, results, scanner
+
+        # 等到新的自然秒再开始，避免与顺序测试共享服务端计数窗口
+        time.sleep(1 - time.time() % 1)
+        concurrent_sec, results, scanner = asyncio.run(sweep())
+
+        assert len(results) == addresses, f"{addresses - len(results)} 个地址扫描失败"
+        found = sum(len(transfers) for transfers in results.values())
+        assert found == sum(len(fake_transfers(address)) for address in targets.values())
+
+        return {
+            'sequential_sec': sequential_sec,
+            'concurrent_sec': concurrent_sec,
+            'expected_sec': addresses / rate_limit,
+            'throttled': server.throttled,
+            'found': found,
+        }
+    finally:
+        server.stop()
+
+
+def benchmark_events(users: int = 2000, blocks: int = 1200, noise_per_block: int = 30,
+                     latency: float = 0.05, rate_limit: int = 200) -> Dict[str, float]:
+    """
+    合约事件扫描基准
+
+    - address: 逐地址轮询一轮所需的请求数（= 用户数）
+    - events: 扫描 blocks 个区块的合约事件所需的请求数（与用户数无关）
+    扫描分两次完成（模拟中途重启），校验检查点续扫不重复请求、充值全部入账且不重复。
+
+    Returns:
+        {'address_requests', 'event_requests', 'resume_requests', 'events_sec', 'recharges'}
+    """
+    addresses = {user_id: fake_address(user_id) for user_id in range(1, users + 1)}
+    events = fake_transfer_events(list(addresses.values()), blocks, noise_per_block)
+    expected = sum(len(fake_transfers(address)) for address in addresses.values())
+    server = FakeTronGrid(latency=latency, rate_limit=rate_limit, events=events).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='events_bench_')
+    db_file = os.path.join(tmpdir, 'events.db')
+    payment = PaymentSystem(master_private_key='01' * 32)
+    payment.db = Database(db_file)
+    payment.db.create_tables()
+    payment.event_confirm_delay_ms = 0
+
+    try:
+        with payment.db.transaction() as conn:
+            conn.executemany('INSERT INTO user_payment_addresses (user_id, address) VALUES (?, ?)',
+                             list(addresses.items()))
+        payment.db.save_chain_checkpoint(payment.event_checkpoint_name, 0, CHAIN_START_MS - 1)
+
+        chain_end = CHAIN_START_MS + blocks * BLOCK_INTERVAL_MS
+
+        async def scan():
+            async with TronGridScanner(server.url, USDT_CONTRACT, rate_limit=rate_limit,
+                                       concurrency=8) as scanner:
+                started = time.perf_counter()
+                # 第一次只扫到一半（模拟进程在中途重启），第二次从检查点继续
+                await payment.scan_contract_events(scanner, now_ms=(CHAIN_START_MS + chain_end) // 2)
+                await payment.scan_contract_events(scanner, now_ms=chain_end)
+                elapsed = time.perf_counter() - started
+
+                requests_before = scanner.requests
+                await payment.scan_contract_events(scanner, now_ms=chain_end)
+                return elapsed, scanner.requests, scanner.requests - requests_before
+
+        events_sec, event_requests, resume_requests = asyncio.run(scan())
+        assert payment.settle_pending_recharges() == expected
+
+        conn = payment.db._get_connection()
+        recharges, distinct = conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT tx_hash) FROM recharge_records'
+        ).fetchone()
+        conn.close()
+
+        assert recharges == distinct == expected, f"充值入账 {recharges}/{distinct}，应为 {expected}"
+        assert resume_requests == 0, "检查点之后没有新区块，不应再发请求"
+        checkpoint = payment.db.get_chain_checkpoint(payment.event_checkpoint_name)
+        assert checkpoint['block_timestamp'] == chain_end
+        assert checkpoint['block_number'] == events[-1]['block_number']
+
+        return {
+            'address_requests': users,
+            'event_requests': event_requests,
+            'resume_requests': resume_requests,
+            'events_sec': events_sec,
+            'recharges': recharges,
+        }
+    finally:
+        server.stop()
+        close_database(db_file)
+
+
+def benchmark_address_cursors(users: int = 500, busy_transfers: int = 120,
+                              latency: float = 0.02, rate_limit: int = 200) -> Dict[str, float]:
+    """
+    逐地址增量游标检查
+
+    用户 1 的地址有 busy_transfers 笔转入（需要翻页），其余地址 0~2 笔。连续扫描两轮：
+    第一轮全部入队并结算，第二轮只返回游标所在的最后一笔转账，不应产生新充值。
+    另外对比旧的逐笔查重（每笔一次连接 + 查询）与 IN 批量查重。
+
+    Returns:
+        {'first_requests', 'first_transfers', 'second_transfers', 'recharges',
+         'per_tx_check_ms', 'batch_check_ms'}
+    """
+    addresses = {user_id: fake_address(user_id) for user_id in range(1, users + 1)}
+    transfer_counts = {addresses[1]: busy_transfers}
+    expected = sum(len(fake_transfers(address, transfer_counts.get(address))) for address in addresses.values())
+    server = FakeTronGrid(latency=latency, rate_limit=rate_limit, transfer_counts=transfer_counts).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='cursor_bench_')
+    db_file = os.path.join(tmpdir, 'cursors.db')
+    payment = PaymentSystem(master_private_key='01' * 32)
+    payment.db = Database(db_file)
+    payment.db.create_tables()
+
+    try:
+        with payment.db.transaction() as conn:
+            conn.executemany('INSERT INTO user_payment_addresses (user_id, address) VALUES (?, ?)',
+                             list(addresses.items()))
+
+        async def sweep():
+            async with TronGridScanner(server.url, USDT_CONTRACT, rate_limit=rate_limit,
+                                       concurrency=16) as scanner:
+                first = await payment.scan_addresses(scanner)
+                first_requests, first_transfers = scanner.requests, server.served_transfers
+                second = await payment.scan_addresses(scanner)
+                return first['enqueued'], second['enqueued'], first_requests, first_transfers
+
+        first, second, first_requests, first_transfers = asyncio.run(sweep())
+        assert payment.settle_pending_recharges() == expected
+        second_transfers = server.served_transfers - first_transfers
+
+        assert first == expected, f"第一轮入账 {first} 笔，应为 {expected}"
+        assert second == 0, "第二轮不应有新充值"
+        pages = -(-busy_transfers // 50)
+        assert first_requests == users + pages - 1, "转入超过一页的地址应继续翻页"
+        senders = sum(1 for address in addresses.values()
+                      if fake_transfers(address, transfer_counts.get(address)))
+        assert second_transfers == senders, "第二轮每个地址只应返回游标所在的一笔"
+
+        # 查重对比：用户 1 的全部转账均已入账
+        transactions = [{'tx_hash': t['transaction_id']}
+                        for t in fake_transfers(addresses[1], busy_transfers)]
+
+        started = time.perf_counter()
+        for tx in transactions:
+            conn = payment.db._get_connection()
+            conn.execute('SELECT id FROM recharge_records WHERE user_id = ? AND tx_hash = ?',
+                         (1, tx['tx_hash'])).fetchone()
+            conn.close()
+        per_tx_check_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        processed = payment.db.get_processed_tx_hashes(1, [tx['tx_hash'] for tx in transactions])
+        batch_check_ms = (time.perf_counter() - started) * 1000
+        assert len(processed) == busy_transfers
+
+        return {
+            'first_requests': first_requests,
+            'first_transfers': first_transfers,
+            'second_transfers': second_transfers,
+            'recharges': first,
+            'per_tx_check_ms': per_tx_check_ms,
+            'batch_check_ms': batch_check_ms,
+        }
+    finally:
+        server.stop()
+        close_database(db_file)
+
+
+def benchmark_address_pool(users: int = 5000, lookups: int = 20000) -> Dict[str, float]:
+    """
+    充值地址预生成与缓存基准
+
+    - on_demand: 旧方式，首次查询时逐个派生 + 查库 + 写库
+    - pregenerate: 后台批量派生并批量写库
+    - lookup: get_user_address 热路径（旧方式每次查库，新方式命中 LRU 缓存）
+    校验两种方式生成的地址一致。
+
+    Returns:
+        {'on_demand_ops', 'pregenerate_ops', 'db_lookup_ops', 'cached_lookup_ops'}
+    """
+    tmpdir = tempfile.mkdtemp(prefix='address_bench_')
+    db_file = os.path.join(tmpdir, 'addresses.db')
+    payment = PaymentSystem(master_private_key='01' * 32)
+    payment.db = Database(db_file)
+    payment.db.create_tables()
+
+    try:
+        with payment.db.transaction() as conn:
+            conn.executemany('INSERT INTO users (id, name, user_id) VALUES (?, ?, ?)',
+                             [(f"u{uid}", f"user{uid}", uid) for uid in range(1, users + 1)])
+
+        # 旧方式：每个用户首次查询时派生（只测 1/5 的用户）
+        sample = users // 5
+        started = time.perf_counter()
+        for user_id in range(1, sample + 1):
+            payment.generate_user_address(user_id)
+        on_demand_ops = sample / (time.perf_counter() - started)
+        on_demand = {uid: payment.db.get_user_address(uid) for uid in range(1, sample + 1)}
+
+        payment.address_cache = AddressCache()
+        started = time.perf_counter()
+        generated = payment.pregenerate_addresses()
+        pregenerate_ops = generated / (time.perf_counter() - started)
+
+        assert generated == users - sample
+        assert payment.db.get_users_without_payment_address() == []
+        # 确定性派生：两种方式的地址必须一致
+        assert all(payment._derive_key(uid).public_key.to_base58check_address() == address
+                   for uid, address in on_demand.items())
+
+        user_ids = [(i * 7919) % users + 1 for i in range(lookups)]
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            payment.db.get_user_address(user_id)
+        db_lookup_ops = lookups / (time.perf_counter() - started)
+
+        payment.warm_address_cache()
+        started = time.perf_counter()
+        for user_id in user_ids:
+            payment.get_user_address(user_id)
+        cached_lookup_ops = lookups / (time.perf_counter() - started)
+        assert payment.address_cache.misses == 0
+
+        return {
+            'on_demand_ops': on_demand_ops,
+            'pregenerate_ops': pregenerate_ops,
+            'db_lookup_ops': db_lookup_ops,
+            'cached_lookup_ops': cached_lookup_ops,
+        }
+    finally:
+        close_database(db_file)
+
+
+def benchmark_poll_scheduler(users: int = 10000, hours: float = 6, hot_users: int = 100,
+                             cold_deposits: int = 100, seed: int = 7) -> Dict[str, float]:
+    """
+    自适应轮询调度模拟（虚拟时钟，不发请求）
+
+    hot_users 个用户查看充值地址 1~3 分钟后转账，另有 cold_deposits 笔充值随机落在沉睡地址上。
+    对比固定 30 秒轮询与 PollScheduler 的请求数和检测延迟。
+
+    Returns:
+        {'fixed_requests', 'adaptive_requests', 'hot_latency', 'cold_latency', 'max_scan_lag', 'queue_depth'}
+    """
+    rng = random.Random(seed)
+    duration = int(hours * 3600)
+    scheduler = PollScheduler(base_interval=30, hot_interval=5, max_interval=1800)
+    scheduler.sync(range(users), 0.0)
+
+    sampled = rng.sample(range(users), hot_users + cold_deposits)
+    hot = set(sampled[:hot_users])
+    deposits = {}  # user_id -> 到账时间
+    views = {}     # 查看时间 -> [user_id]
+    for user_id in sampled:
+        # 留出最长退避间隔，保证模拟结束前所有充值都能被检测到
+        arrived = rng.randrange(600, duration - 2 * int(scheduler.max_interval))
+        if user_id in hot:
+            views.setdefault(arrived - rng.randint(60, 180), []).append(user_id)
+        deposits[user_id] = arrived
+
+    requests_sent = 0
+    latency = {'hot': [], 'cold': []}
+    max_scan_lag = 0.0
+    queue_depth = None
+
+    for now in range(duration):
+        for user_id in views.get(now, ()):
+            scheduler.set_hot({user_id: now + 1800}, now)
+
+        due = scheduler.pop_due(now)
+        requests_sent += len(due)
+        for user_id in due:
+            arrived = deposits.get(user_id)
+            found = arrived is not None and arrived <= now
+            if found:
+                latency['hot' if user_id in hot else 'cold'].append(now - arrived)
+                del deposits[user_id]
+            scheduler.complete(user_id, found, now)
+
+        if now % 60 == 0:
+            stats = scheduler.stats(now + 0.5)
+            max_scan_lag = max(max_scan_lag, stats['scan_lag'])
+            if now == duration // 2:
+                queue_depth = stats['queue_depth']
+
+    assert not deposits, f"{len(deposits)} 笔充值未被检测到"
+
+    return {
+        'fixed_requests': users * duration // 30,
+        'adaptive_requests': requests_sent,
+        'hot_latency': sum(latency['hot']) / len(latency['hot']),
+        'cold_latency': sum(latency['cold']) / len(latency['cold']),
+        'max_scan_lag': max_scan_lag,
+        'queue_depth': queue_depth,
+    }
+
+
+def benchmark_metrics(users: int = 300, latency: float = 0.01, server_quota: int = 100,
+                      client_rate: int = 150) -> Dict[str, float]:
+    """
+    指标导出检查
+
+    客户端速率高于服务端配额，产生 429；扫描 + 结算后抓取 /metrics，
+    校验请求数、入账数、队列积压与扫描器/数据库一致。
+
+    Returns:
+        {'requests', 'throttled', 'credited', 'metric_lines'}
+    """
+    addresses = {user_id: fake_address(user_id) for user_id in range(1, users + 1)}
+    expected = sum(len(fake_transfers(address)) for address in addresses.values())
+    server = FakeTronGrid(latency=latency, rate_limit=server_quota).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='metrics_bench_')
+    db_file = os.path.join(tmpdir, 'metrics.db')
+    payment = PaymentSystem(master_private_key='01' * 32)
+    payment.db = Database(db_file)
+    payment.db.create_tables()
+    metrics_server = start_metrics_server(payment.metrics, 0)
+
+    try:
+        with payment.db.transaction() as conn:
+            conn.executemany('INSERT INTO user_payment_addresses (user_id, address) VALUES (?, ?)',
+                             list(addresses.items()))
+
+        async def sweep():
+            async with TronGridScanner(server.url, USDT_CONTRACT, rate_limit=client_rate,
+                                       concurrency=16, metrics=payment.metrics) as scanner:
+                started = time.monotonic()
+                outcome = await payment.scan_addresses(scanner)
+                payment.metrics.observe_sweep(time.monotonic() - started, len(outcome['scanned']))
+                return scanner
+
+        time.sleep(1 - time.time() % 1)
+        scanner = asyncio.run(sweep())
+        assert payment.settle_pending_recharges() == expected
+
+        body = requests.get(f"http://127.0.0.1:{metrics_server.server_address[1]}/metrics", timeout=5).text
+        samples = {}
+        for line in body.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+
+        requests_total = sum(v for k, v in samples.items() if k.startswith('payment_trongrid_requests_total'))
+        assert requests_total == scanner.requests
+        assert samples['payment_trongrid_requests_total{status="429"}'] == scanner.throttled > 0
+        assert samples['payment_trongrid_request_seconds_count'] == scanner.requests
+        assert samples['payment_deposits_detected_total'] == expected
+        assert samples['payment_deposits_credited_total'] == expected
+        assert samples['payment_detection_to_credit_seconds_count'] == expected
+        assert samples['payment_recharge_queue{status="done"}'] == expected
+        assert samples['payment_addresses_scanned_total'] == users
+
+        return {
+            'requests': scanner.requests,
+            'throttled': scanner.throttled,
+            'credited': int(samples['payment_deposits_credited_total']),
+            'metric_lines': len(body.splitlines()),
+        }
+    finally:
+        metrics_server.shutdown()
+        server.stop()
+        close_database(db_file)
+
+
+if __name__ == "__main__":
+    print("=" * 70)
+    print("测试: TronGrid 扫描 10k 地址 (延迟 100ms, 配额 1000 req/s)")
+    print("=" * 70)
+
+    result = benchmark_scan()
+    print(f"顺序轮询(外推) {result['sequential_sec']:8.1f}s")
+    print(f"并发扫描       {result['concurrent_sec']:8.1f}s (配额下限 {result['expected_sec']:.1f}s)")
+    print(f"429 次数 {result['throttled']} | 检测到转账 {result['found']} 笔")
+
+    print()
+    print("=" * 70)
+    print("测试: 合约事件扫描 (2000 用户, 1200 区块, 每区块 30 笔无关转账)")
+    print("=" * 70)
+
+    result = benchmark_events()
+    print(f"逐地址轮询 每轮 {result['address_requests']} 次请求")
+    print(f"事件扫描   共 {result['event_requests']} 次请求, 耗时 {result['events_sec']:.1f}s, "
+          f"入账 {result['recharges']} 笔")
+    print(f"检查点续扫 {result['resume_requests']} 次请求")
+
+    print()
+    print("=" * 70)
+    print("测试: 逐地址增量游标 (500 地址, 其中 1 个地址 120 笔转入)")
+    print("=" * 70)
+
+    result = benchmark_address_cursors()
+    print(f"第一轮 {result['first_requests']} 次请求, 返回 {result['first_transfers']} 笔, "
+          f"入账 {result['recharges']} 笔")
+    print(f"第二轮 返回 {result['second_transfers']} 笔 (仅游标所在转账)")
+    print(f"查重 120 笔: 逐笔 {result['per_tx_check_ms']:.2f}ms | IN 批量 {result['batch_check_ms']:.2f}ms")
+
+    print()
+    print("=" * 70)
+    print("测试: 充值地址预生成与缓存 (5000 用户)")
+    print("=" * 70)
+
+    result = benchmark_address_pool()
+    print(f"按需生成 {result['on_demand_ops']:10,.0f} 个/s | 批量预生成 {result['pregenerate_ops']:10,.0f} 个/s")
+    print(f"查询地址 查库 {result['db_lookup_ops']:10,.0f} ops/s | LRU 缓存 {result['cached_lookup_ops']:10,.0f} ops/s")
+
+    print()
+    print("=" * 70)
+    print("测试: 自适应轮询调度模拟 (10k 地址, 6 小时)")
+    print("=" * 70)
+
+    result = benchmark_poll_scheduler()
+    print(f"固定 30s 轮询 {result['fixed_requests']:,} 次请求 | 自适应 {result['adaptive_requests']:,} 次请求")
+    print(f"检测延迟: 查看地址后转账 {result['hot_latency']:.1f}s | 沉睡地址 {result['cold_latency']:.0f}s")
+    print(f"队列 {result['queue_depth']} | 最大扫描延迟 {result['max_scan_lag']:.1f}s")
+
+    print()
+    print("=" * 70)
+    print("测试: /metrics 指标导出 (300 地址, 客户端速率高于服务端配额)")
+    print("=" * 70)
+
+    result = benchmark_metrics()
+    print(f"✅ 请求 {result['requests']} 次 (429 {result['throttled']} 次) | 入账 {result['credited']} 笔 | "
+          f"指标 {result['metric_lines']} 行")
@@ -8,16 +8,611 @@ payment_system.py - 独立支付系统模块
 
 import logging
 import asyncio
+import heapq
+import threading
+import time
+import httpx
 import requests
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Optional, Dict, List, Tuple
 from datetime import datetime, timedelta
 from tronpy import Tron
-from tronpy.keys import PrivateKey
+from tronpy.keys import PrivateKey, to_base58check_address
 from database import Database
 import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx 默认为每个请求输出一条 INFO 日志，扫描时会占用大量 CPU，请求情况改由 PaymentMetrics 统计
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+_log_counts = {}
+_log_counts_lock = threading.Lock()
+
+
+def log_sampled(level: int, event: str, every: int = 100, **fields):
+    """
+    采样输出结构化日志：同一事件只输出第 1 次及之后每 every 次
+
+        log_sampled(logging.WARNING, 'trongrid_request_failed', path=path, status=429)
+        # event=trongrid_request_failed count=1 path=... status=429
+    """
+    # 结算 worker 在线程池中调用，计数的读-改-写需要加锁
+    with _log_counts_lock:
+        count = _log_counts.get(event, 0) + 1
+        _log_counts[event] = count
+    if every > 1 and count % every != 1:
+        return
+    logger.log(level, "event=%s count=%d %s", event, count,
+               " ".join(f"{key}={value}" for key, value in fields.items()))
+
+
+class _Histogram:
+    """累积分桶直方图（Prometheus histogram 语义）"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class PaymentMetrics:
+    """
+    支付系统指标
+
+    由扫描器、监控循环和结算 worker 更新（线程安全），render() 输出 Prometheus 文本格式，
+    通过 start_metrics_server 提供 /metrics。队列积压等按需读取的值用 register_gauge 注册。
+    """
+
+    REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SWEEP_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    CREDIT_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # 状态 -> 次数（2xx / 429 / 4xx / 5xx / error）
+        self.request_latency = _Histogram(self.REQUEST_BUCKETS)
+        self.sweep_duration = _Histogram(self.SWEEP_BUCKETS)
+        self.credit_latency = _Histogram(self.CREDIT_BUCKETS)
+        self.addresses_scanned = 0
+        self.addresses_per_second = 0.0
+        self.deposits_detected = 0
+        self.deposits_credited = 0
+        self.credit_failures = 0
+        self._gauges = []  # (name, help, func)
+
+    def observe_request(self, status: str, seconds: float):
+        """记录一次 TronGrid 请求（每次重试单独计数）"""
+        with self._lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.request_latency.observe(seconds)
+
+    def observe_sweep(self, seconds: float, addresses: int):
+        """记录一轮扫描的耗时和扫描地址数"""
+        with self._lock:
+            self.sweep_duration.observe(seconds)
+            self.addresses_scanned += addresses
+            if seconds > 0:
+                self.addresses_per_second = addresses / seconds
+
+    def record_detected(self, count: int):
+        with self._lock:
+            self.deposits_detected += count
+
+    def observe_credit(self, queued_seconds: float):
+        """记录一笔充值入账，queued_seconds 为检测入队到入账的耗时"""
+        with self._lock:
+            self.deposits_credited += 1
+            self.credit_latency.observe(queued_seconds)
+
+    def record_credit_failure(self):
+        with self._lock:
+            self.credit_failures += 1
+
+    def register_gauge(self, name: str, help_text: str, func):
+        """
+        注册抓取时计算的指标
+
+        func 返回数值，或 {(标签名, 标签值): 数值} 形式的多序列
+        """
+        self._gauges.append((name, help_text, func))
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        with self._lock:
+            lines = [
+                '# HELP payment_trongrid_requests_total TronGrid requests by result',
+                '# TYPE payment_trongrid_requests_total counter',
+            ]
+            lines += [f'payment_trongrid_requests_total{{status="{status}"}} {count}'
+                      for status, count in sorted(self.requests.items())]
+            lines += [
+                '# HELP payment_trongrid_request_seconds TronGrid request latency',
+                '# TYPE payment_trongrid_request_seconds histogram',
+                *self.request_latency.render('payment_trongrid_request_seconds'),
+                '# HELP payment_sweep_seconds Duration of one monitor sweep',
+                '# TYPE payment_sweep_seconds histogram',
+                *self.sweep_duration.render('payment_sweep_seconds'),
+                '# HELP payment_addresses_scanned_total Addresses scanned',
+                '# TYPE payment_addresses_scanned_total counter',
+                f'payment_addresses_scanned_total {self.addresses_scanned}',
+                '# HELP payment_addresses_per_second Scan throughput of the last sweep',
+                '# TYPE payment_addresses_per_second gauge',
+                f'payment_addresses_per_second {self.addresses_per_second}',
+                '# HELP payment_deposits_detected_total Deposits enqueued for settlement',
+                '# TYPE payment_deposits_detected_total counter',
+                f'payment_deposits_detected_total {self.deposits_detected}',
+                '# HELP payment_deposits_credited_total Deposits credited',
+                '# TYPE payment_deposits_credited_total counter',
+                f'payment_deposits_credited_total {self.deposits_credited}',
+                '# HELP payment_credit_failures_total Failed settlement attempts',
+                '# TYPE payment_credit_failures_total counter',
+                f'payment_credit_failures_total {self.credit_failures}',
+                '# HELP payment_detection_to_credit_seconds Time from detection to credit',
+                '# TYPE payment_detection_to_credit_seconds histogram',
+                *self.credit_latency.render('payment_detection_to_credit_seconds'),
+            ]
+
+        for name, help_text, func in self._gauges:
+            try:
+                value = func()
+            except Exception as e:
+                log_sampled(logging.WARNING, 'metrics_gauge_failed', name=name, error=e)
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+            if isinstance(value, dict):
+                lines += [f'{name}{{{label}="{label_value}"}} {v}' for (label, label_value), v in value.items()]
+            else:
+                lines.append(f'{name} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(metrics: PaymentMetrics, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """在后台线程启动 /metrics HTTP 服务（port 为 0 时自动分配端口）"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='payment-metrics', daemon=True).start()
+    logger.info(f"[INFO] 📈 指标服务: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class TokenBucket:
+    """
+    异步令牌桶限流器
+
+    rate: 每秒令牌数（对应 TronGrid 每个 API Key 的 QPS 配额）
+    capacity: 桶容量（允许的突发请求数），默认 1 即均匀发送
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """获取一个令牌，不足时等待（按调用顺序排队）"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TronGridScanner:
+    """
+    并发 TronGrid 充值扫描器
+
+    共享一个 keep-alive 的 httpx.AsyncClient，用信号量限制并发连接数，
+    用令牌桶把请求速率限制在 API Key 配额内。一轮扫描的耗时取决于速率限制，
+    而不是 单次延迟 × 用户数。
+
+        async with TronGridScanner(url, contract, api_key) as scanner:
+            results = await scanner.scan({user_id: address, ...})
+    """
+
+    def __init__(self, base_url: str, usdt_contract: str, api_key: str = "",
+                 rate_limit: float = 15, concurrency: int = 32, timeout: float = 10,
+                 max_retries: int = 3, metrics: 'PaymentMetrics' = None):
+        self.base_url = base_url.rstrip('/')
+        self.metrics = metrics
+        self.usdt_contract = usdt_contract
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = TokenBucket(rate_limit)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+
+        # 统计
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+
+    async def __aenter__(self):
+        headers = {'TRON-PRO-API-KEY': self.api_key} if self.api_key else {}
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_json(self, path: str, params: Dict) -> Optional[Dict]:
+        """限流 + 并发控制的 GET 请求，429/5xx 退避重试，失败返回 None"""
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire()
+                self.requests += 1
+                started = time.monotonic()
+                try:
+                    response = await self._client.get(path, params=params)
+                except httpx.HTTPError as e:
+                    self._observe('error', started)
+                    log_sampled(logging.WARNING, 'trongrid_request_error', path=path, error=repr(e))
+                else:
+                    status = response.status_code
+                    self._observe('429' if status == 429 else f"{status // 100}xx", started)
+                    if status == 200:
+                        return response.json()
+                    if status == 429:
+                        self.throttled += 1
+                    elif status < 500:
+                        log_sampled(logging.ERROR, 'trongrid_request_rejected', every=1,
+                                    path=path, status=status, body=response.text[:200])
+                        break
+                    else:
+                        log_sampled(logging.WARNING, 'trongrid_server_error', path=path, status=status)
+
+                if attempt < self.max_retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+
+        self.errors += 1
+        return None
+
+    def _observe(self, status: str, started: float):
+        if self.metrics is not None:
+            self.metrics.observe_request(status, time.monotonic() - started)
+
+    async def fetch_received_transfers(self, address: str, min_timestamp: int = 0,
+                                       page_size: int = 50) -> Optional[List[Dict]]:
+        """
+        获取地址在 min_timestamp（毫秒，含）之后收到的 USDT 转账
+
+        按区块时间升序返回，超过一页时按 fingerprint 继续翻页；请求失败返回 None
+        """
+        params = {
+            'limit': page_size,
+            'contract_address': self.usdt_contract,
+            'only_to': 'true',
+            'min_timestamp': min_timestamp,
+            'order_by': 'block_timestamp,asc',
+        }
+        transactions = []
+
+        while True:
+            data = await self.get_json(f"/v1/accounts/{address}/transactions/trc20", params)
+            if data is None:
+                return None
+
+            transactions.extend(data.get('data', []))
+
+            fingerprint = data.get('meta', {}).get('fingerprint')
+            if not fingerprint:
+                return parse_received_transfers(address, transactions)
+            params = {**params, 'fingerprint': fingerprint}
+
+    async def scan(self, addresses: Dict[int, str], cursors: Dict[str, int] = None) -> Dict[int, List[Dict]]:
+        """
+        并发扫描所有地址
+
+        Args:
+            addresses: {user_id: address}
+            cursors: {address: 已处理的最新转账时间(毫秒)}，只拉取该时间之后的转账
+
+        Returns:
+            {user_id: 收到的转账列表}（请求失败的地址不在结果中）
+        """
+        cursors = cursors or {}
+
+        async def scan_one(user_id: int, address: str):
+            return user_id, await self.fetch_received_transfers(address, cursors.get(address, 0))
+
+        results = await asyncio.gather(*(scan_one(uid, addr) for uid, addr in addresses.items()))
+        return {user_id: transfers for user_id, transfers in results if transfers is not None}
+
+    async def fetch_transfer_events(self, min_timestamp: int, max_timestamp: int,
+                                    page_size: int = 200) -> Optional[List[Dict]]:
+        """
+        按区块时间范围分页拉取 USDT 合约的全部 Transfer 事件（含端点，毫秒）
+
+        Returns:
+            按区块时间升序的事件列表，任一页请求失败返回 None
+        """
+        params = {
+            'event_name': 'Transfer',
+            'only_confirmed': 'true',
+            'min_block_timestamp': min_timestamp,
+            'max_block_timestamp': max_timestamp,
+            'order_by': 'block_timestamp,asc',
+            'limit': page_size,
+        }
+        events = []
+
+        while True:
+            data = await self.get_json(f"/v1/contracts/{self.usdt_contract}/events", params)
+            if data is None:
+                return None
+
+            events.extend(data.get('data', []))
+
+            fingerprint = data.get('meta', {}).get('fingerprint')
+            if not fingerprint:
+                return events
+            params = {**params, 'fingerprint': fingerprint}
+
+
+def parse_received_transfers(address: str, transactions: List[Dict]) -> List[Dict]:
+    """从 TronGrid TRC20 交易列表中提取转入 address 的 USDT 转账"""
+    received_txs = []
+
+    for tx in transactions:
+        if tx.get('to') == address:
+            received_txs.append({
+                'tx_hash': tx.get('transaction_id'),
+                'from': tx.get('from'),
+                'to': tx.get('to'),
+                'amount': int(tx.get('value', 0)) / 1_000_000,  # USDT 6位小数
+                'timestamp': tx.get('block_timestamp'),
+                'confirmed': True
+            })
+
+    return received_txs
+
+
+def _event_address(value: str) -> str:
+    """事件参数中的地址为 0x 开头的 hex，统一转换为 base58"""
+    if value and not value.startswith('T'):
+        return to_base58check_address(value)
+    return value
+
+
+def match_transfer_events(events: List[Dict], watched: Dict[str, int]) -> Dict[int, List[Dict]]:
+    """
+    用地址哈希表匹配 Transfer 事件的收款方
+
+    Args:
+        events: TronGrid 合约事件列表
+        watched: {address: user_id}
+
+    Returns:
+        {user_id: 收到的转账列表}（格式同 parse_received_transfers）
+    """
+    matches = {}
+
+    for event in events:
+        result = event.get('result', {})
+        to_address = _event_address(result.get('to', ''))
+        user_id = watched.get(to_address)
+        if user_id is None:
+            continue
+
+        matches.setdefault(user_id, []).append({
+            'tx_hash': event.get('transaction_id'),
+            'from': _event_address(result.get('from', '')),
+            'to': to_address,
+            'amount': int(result.get('value', 0)) / 1_000_000,  # USDT 6位小数
+            'timestamp': event.get('block_timestamp'),
+            'block_number': event.get('block_number'),
+            'confirmed': True
+        })
+
+    return matches
+
+
+class AddressCache:
+    """
+    user_id → 充值地址的 LRU 缓存
+
+    地址由主私钥和 user_id 确定性派生，分配后不会变化，因此只按容量淘汰、不设过期时间。
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            address = self._data.get(user_id)
+            if address is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return address
+
+    def update(self, addresses: Dict[int, str]):
+        with self._lock:
+            for user_id, address in addresses.items():
+                self._data[user_id] = address
+                self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def put(self, user_id: int, address: str):
+        self.update({user_id: address})
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class PollScheduler:
+    """
+    充值地址自适应轮询调度
+
+    - hot: 最近查看过充值地址或订阅即将到期的用户，每 hot_interval 秒轮询
+    - normal: 新地址或刚检测到充值的地址，每 base_interval 秒轮询
+    - dormant: 连续没有新充值的地址，间隔每次翻倍，最长 max_interval 秒
+
+    按到期时间维护小顶堆，重新调度时旧的堆条目通过 due 比对惰性丢弃。
+    """
+
+    def __init__(self, base_interval: float = 30, hot_interval: float = 5, max_interval: float = 1800):
+        self.base_interval = base_interval
+        self.hot_interval = hot_interval
+        self.max_interval = max_interval
+        self._heap = []
+        self._entries = {}  # user_id -> {'interval', 'due', 'hot_until'}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _schedule(self, user_id: int, due: float):
+        self._entries[user_id]['due'] = due
+        heapq.heappush(self._heap, (due, user_id))
+
+    def sync(self, user_ids, now: float):
+        """同步需要监控的用户：新地址立即轮询，已删除的地址移出调度"""
+        user_ids = set(user_ids)
+        for user_id in user_ids - self._entries.keys():
+            self._entries[user_id] = {'interval': self.base_interval, 'due': now, 'hot_until': 0.0}
+            self._schedule(user_id, now)
+        for user_id in self._entries.keys() - user_ids:
+            del self._entries[user_id]
+
+    def set_hot(self, hints: Dict[int, float], now: float):
+        """应用高频轮询提示 {user_id: hot_until}，新变为 hot 的地址提前到 hot_interval 内轮询"""
+        for user_id, hot_until in hints.items():
+            entry = self._entries.get(user_id)
+            if entry is None or hot_until <= now:
+                continue
+            entry['hot_until'] = max(entry['hot_until'], hot_until)
+            if entry['due'] is not None and entry['due'] > now + self.hot_interval:
+                self._schedule(user_id, now)
+
+    def pop_due(self, now: float, limit: int = None) -> List[int]:
+        """取出所有已到期的地址（按到期时间先后）"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            scheduled, user_id = heapq.heappop(self._heap)
+            entry = self._entries.get(user_id)
+            if entry is None or entry['due'] != scheduled:
+                continue  # 已删除或已重新调度
+            entry['due'] = None
+            due.append(user_id)
+        return due
+
+    def complete(self, user_id: int, found: bool, now: float):
+        """记录一次轮询结果：有新充值时恢复基础间隔，否则退避"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if found:
+            entry['interval'] = self.base_interval
+        else:
+            entry['interval'] = min(entry['interval'] * 2, self.max_interval)
+
+        interval = self.hot_interval if entry['hot_until'] > now else entry['interval']
+        self._schedule(user_id, now + interval)
+
+    def retry(self, user_id: int, now: float):
+        """轮询失败：不改变退避间隔，基础间隔后重试"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._schedule(user_id, now + min(entry['interval'], self.base_interval))
+
+    def next_due(self) -> Optional[float]:
+        """最近的到期时间（可能是已失效的堆条目，只用于决定休眠时长）"""
+        return self._heap[0][0] if self._heap else None
+
+    def stats(self, now: float) -> Dict:
+        """
+        调度指标
+
+        Returns:
+            {'tracked', 'queue_depth': {'hot', 'normal', 'dormant'}, 'overdue', 'scan_lag'}
+            scan_lag 为最早到期但尚未轮询的地址已超期的秒数
+        """
+        depth = {'hot': 0, 'normal': 0, 'dormant': 0}
+        overdue = 0
+        oldest_due = None
+
+        for entry in self._entries.values():
+            if entry['hot_until'] > now:
+                depth['hot'] += 1
+            elif entry['interval'] > self.base_interval:
+                depth['dormant'] += 1
+            else:
+                depth['normal'] += 1
+
+            due = entry['due']
+            if due is not None and due <= now:
+                overdue += 1
+                oldest_due = due if oldest_due is None else min(oldest_due, due)
+
+        return {
+            'tracked': len(self._entries),
+            'queue_depth': depth,
+            'overdue': overdue,
+            'scan_lag': now - oldest_due if oldest_due is not None else 0.0,
+        }
 
 
 class PaymentSystem:
@@ -63,6 +658,59 @@ class PaymentSystem:
         # 监控间隔（秒）
         self.monitor_interval = 30
 
+        # 逐地址轮询调度：hot 地址间隔、dormant 最大退避间隔、地址列表和轮询提示的刷新间隔（秒）
+        self.poll_scheduler = PollScheduler(
+            base_interval=self.monitor_interval,
+            hot_interval=float(os.getenv("POLL_HOT_INTERVAL", "5")),
+            max_interval=float(os.getenv("POLL_MAX_INTERVAL", "1800")),
+        )
+        self.poll_hint_interval = 5
+        self.address_refresh_interval = 60
+        self.poll_metrics = {}
+
+        # TronGrid 请求配额（每秒请求数）和并发连接数
+        self.trongrid_rate_limit = float(os.getenv("TRONGRID_RATE_LIMIT", "15"))
+        self.trongrid_concurrency = int(os.getenv("TRONGRID_CONCURRENCY", "32"))
+
+        # 充值检测方式: 'address' 逐地址轮询 / 'events' 扫描合约 Transfer 事件
+        self.deposit_detection = os.getenv("DEPOSIT_DETECTION", "address")
+        # 事件扫描: 每个请求窗口（毫秒）、确认延迟（毫秒）、首次运行回溯时长（毫秒）
+        self.event_window_ms = 60_000
+        self.event_confirm_delay_ms = 60_000
+        self.event_initial_lookback_ms = 24 * 3600 * 1000
+        self.event_checkpoint_name = f"usdt_transfer_events:{network}"
+
+        # 充值结算 worker 数量、每次领取的任务数、队列为空时的轮询间隔（秒）、最大重试次数
+        self.recharge_workers = int(os.getenv("RECHARGE_WORKERS", "4"))
+        self.recharge_batch_size = 10
+        self.recharge_poll_interval = 1.0
+        self.recharge_max_attempts = 5
+
+        # 充值地址 LRU 缓存，以及后台预生成地址的批大小和间隔（秒）
+        self.address_cache = AddressCache(int(os.getenv("ADDRESS_CACHE_SIZE", "100000")))
+        self.address_pregenerate_batch = 500
+        self.address_pregenerate_interval = 60
+
+        # 指标（PAYMENT_METRICS_PORT 非 0 时在本机提供 /metrics）
+        self.metrics = PaymentMetrics()
+        self.metrics_port = int(os.getenv("PAYMENT_METRICS_PORT", "0"))
+        self.metrics.register_gauge(
+            'payment_recharge_queue', 'Recharge settlement queue size by status',
+            lambda: {('status', status): count for status, count in self.db.get_recharge_queue_stats().items()}
+        )
+        self.metrics.register_gauge(
+            'payment_poll_queue_depth', 'Addresses per polling tier',
+            lambda: {('tier', tier): n for tier, n in self.poll_metrics.get('queue_depth', {}).items()}
+        )
+        self.metrics.register_gauge(
+            'payment_poll_scan_lag_seconds', 'How overdue the oldest due address is',
+            lambda: self.poll_metrics.get('scan_lag', 0.0)
+        )
+
+        # 订阅过期清理间隔（秒）及过期事件监听器
+        self.expiry_sweep_interval = 60
+        self.expiry_listeners = []
+
         logger.info(f"[INFO] 支付系统初始化完成 - 网络: {network}")
 
     def _generate_master_key(self) -> str:
@@ -98,11 +746,65 @@ class PaymentSystem:
 
         # 保存到数据库
         self.db.save_user_payment_address(user_id, address)
+        self.address_cache.put(user_id, address)
 
         logger.info(f"[INFO] 为用户 {user_id} 生成地址: {address}")
 
         return address
 
+    def pregenerate_addresses(self, batch_size: int = None) -> int:
+        """
+        为尚未分配地址的注册用户批量派生并保存充值地址，同时写入缓存
+
+        Returns:
+            新生成的地址数
+        """
+        batch_size = batch_size or self.address_pregenerate_batch
+        generated = 0
+
+        while True:
+            user_ids = self.db.get_users_without_payment_address(batch_size)
+            if not user_ids:
+                break
+
+            addresses = {
+                user_id: self._derive_key(user_id).public_key.to_base58check_address()
+                for user_id in user_ids
+            }
+            generated += self.db.save_user_payment_addresses(addresses)
+            self.address_cache.update(addresses)
+
+            if len(user_ids) < batch_size:
+                break
+
+        return generated
+
+    def warm_address_cache(self) -> int:
+        """把已分配的地址一次性加载到缓存，返回加载数量"""
+        addresses = self.db.get_all_payment_addresses()
+        self.address_cache.update(addresses)
+        return len(addresses)
+
+    async def address_pregenerate_loop(self):
+        """后台预生成地址：启动时预热缓存，之后定期为新注册用户派生地址"""
+        loop = asyncio.get_running_loop()
+
+        try:
+            loaded = await loop.run_in_executor(None, self.warm_address_cache)
+            logger.info(f"[INFO] 充值地址缓存已加载 {loaded} 个")
+        except Exception as e:
+            logger.error(f"[ERROR] 加载充值地址缓存失败: {e}")
+
+        while True:
+            try:
+                generated = await loop.run_in_executor(None, self.pregenerate_addresses)
+                if generated:
+                    logger.info(f"[INFO] 预生成充值地址 {generated} 个")
+            except Exception as e:
+                logger.error(f"[ERROR] 预生成充值地址异常: {e}")
+
+            await asyncio.sleep(self.address_pregenerate_interval)
+
     def _derive_key(self, user_id: int) -> PrivateKey:
         """
         派生子密钥（确定性生成）
@@ -133,24 +835,30 @@ class PaymentSystem:
         Returns:
             地址或 None
         """
-        # 先从数据库查询
+        # 先查缓存（预生成的地址已在缓存中），再查数据库
+        address = self.address_cache.get(user_id)
+        if address:
+            return address
+
         address = self.db.get_user_address(user_id)
 
         if address:
+            self.address_cache.put(user_id, address)
             return address
 
         # 如果不存在，自动生成
         return self.generate_user_address(user_id)
 
-    def check_address_balance(self, address: str) -> Tuple[float, List[Dict]]:
+    def check_address_balance(self, address: str, min_timestamp: int = 0) -> Tuple[float, List[Dict]]:
         """
         检查地址的 USDT 余额和交易记录
 
         Args:
             address: TRC20 地址
+            min_timestamp: 只查询该时间（毫秒，含）之后的转账
 
         Returns:
-            (余额, 交易列表)
+            (收到的总金额, 交易列表)
         """
         try:
             # 使用 TronGrid API 查询 TRC20 交易
@@ -162,50 +870,32 @@ class PaymentSystem:
 
             params = {
                 'limit': 50,
-                'contract_address': self.usdt_contract
+                'contract_address': self.usdt_contract,
+                'only_to': 'true',
+                'min_timestamp': min_timestamp,
+                'order_by': 'block_timestamp,asc',
             }
+            transactions = []
 
-            print("=" * 60)
-            print("🔍 调试信息：")
-            print(f"URL: {url}")
-            print(f"Contract: {self.usdt_contract}")
-            print(f"Headers: {headers}")
-            print(f"Params: {params}")
-            from urllib.parse import urlencode
-            full_url = f"{url}?{urlencode(params)}"
-            print(f"完整URL: {full_url}")
-            print("=" * 60)
-
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            print(f"状态码: {response.status_code}")
-            print(f"响应: {response.json()}")
-
-            if response.status_code != 200:
-                logger.error(f"[ERROR] 查询余额失败: {response.text}")
-                return 0.0, []
-
-            data = response.json()
-            logger.error(f"[ERROR] 查询余额失败: {response}")
-            transactions = data.get('data', [])
+            # 超过一页时按 fingerprint 翻页
+            while True:
+                response = requests.get(url, headers=headers, params=params, timeout=10)
+
+                if response.status_code != 200:
+                    logger.error(f"[ERROR] 查询余额失败: {response.text}")
+                    return 0.0, []
+
+                data = response.json()
+                transactions.extend(data.get('data', []))
+
+                fingerprint = data.get('meta', {}).get('fingerprint')
+                if not fingerprint:
+                    break
+                params['fingerprint'] = fingerprint
 
             # 计算余额（接收的金额）
-            balance = 0.0
-            received_txs = []
-
-            for tx in transactions:
-                if tx.get('to') == address:
-                    # 接收的交易
-                    amount = int(tx.get('value', 0)) / 1_000_000  # USDT 6位小数
-                    balance += amount
-
-                    received_txs.append({
-                        'tx_hash': tx.get('transaction_id'),
-                        'from': tx.get('from'),
-                        'to': tx.get('to'),
-                        'amount': amount,
-                        'timestamp': tx.get('block_timestamp'),
-                        'confirmed': True
-                    })
+            received_txs = parse_received_transfers(address, transactions)
+            balance = sum(tx['amount'] for tx in received_txs)
 
             return balance, received_txs
 
@@ -228,40 +918,39 @@ class PaymentSystem:
         if not address:
             return None
 
-        # 获取交易记录
-        _, transactions = self.check_address_balance(address)
+        # 获取游标之后的交易记录（游标由 monitor_all_users 在入账后推进）
+        cursor = self.db.get_address_cursors([address]).get(address, 0)
+        _, transactions = self.check_address_balance(address, cursor)
 
-        if not transactions:
-            return None
+        new_recharges = self.find_new_recharges(user_id, address, transactions)
+        return new_recharges[0] if new_recharges else None
+
+    def find_new_recharges(self, user_id: int, address: str, transactions: List[Dict]) -> List[Dict]:
+        """
+        从转账列表中找出尚未入账的充值
 
-        # 检查是否有未处理的充值
+        Returns:
+            新充值信息列表
+        """
+        # 一次 IN 查询找出已处理的交易
+        processed = self.db.get_processed_tx_hashes(user_id, [tx['tx_hash'] for tx in transactions])
+
+        new_recharges = []
         for tx in transactions:
-            tx_hash = tx['tx_hash']
-
-            # 检查数据库中是否已处理此交易
-            conn = self.db._get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id FROM recharge_records 
-                WHERE user_id = ? AND tx_hash = ?
-            ''', (user_id, tx_hash))
-
-            if cursor.fetchone():
-                conn.close()
+            if tx['tx_hash'] in processed:
                 continue  # 已处理，跳过
 
-            conn.close()
-
             # 新充值！
-            return {
+            processed.add(tx['tx_hash'])
+            new_recharges.append({
                 'user_id': user_id,
                 'address': address,
                 'amount': tx['amount'],
-                'tx_hash': tx_hash,
+                'tx_hash': tx['tx_hash'],
                 'timestamp': tx['timestamp']
-            }
+            })
 
-        return None
+        return new_recharges
 
     def auto_subscribe_if_possible(self, user_id: int) -> Tuple[bool, str]:
         """尝试自动订阅（支持灵活订阅）"""
@@ -307,108 +996,309 @@ class PaymentSystem:
 
     def process_new_recharge(self, recharge_info: dict) -> bool:
         """
-        处理新充值 - 包含邀请码折扣和邀请奖励
+        处理新充值 - 入队后立即结算（结算逻辑见 settle_queued_recharge）
+        """
+        self.db.enqueue_recharges([recharge_info])
+        return self.settle_queued_recharge(recharge_info['tx_hash'], recharge_info['user_id'])
+
+    def settle_queued_recharge(self, tx_hash: str, user_id: int) -> bool:
+        """
+        结算队列中的一笔充值 - 包含邀请码赠送和邀请奖励
+
+        入账部分在 Database.settle_recharge 的单个事务中完成，重复结算会被忽略；
+        自动订阅在提交之后执行（失败不影响已入账的余额）。
         """
         try:
-            user_id = recharge_info['user_id']
-            original_amount = recharge_info['amount']
-            tx_hash = recharge_info['tx_hash']
-
-            # ⭐ 1. 检查用户是否有邀请码折扣
-            discount_percent = self.db.get_user_invite_discount(user_id)
-
-            # 计算实际到账金额
-            if discount_percent > 0:
-                bonus_amount = original_amount * (discount_percent / 100)
-                final_amount = original_amount + bonus_amount
-
-                logger.info(f"[充值] 💰 用户 {user_id} 使用邀请码优惠")
-                logger.info(f"[充值] 充值: {original_amount} USDT")
-                logger.info(f"[充值] 赠送: {bonus_amount:.2f} USDT ({discount_percent}%)")
-                logger.info(f"[充值] 到账: {final_amount:.2f} USDT")
-            else:
-                bonus_amount = 0
-                final_amount = original_amount
-
-            # ⭐ 2. 创建充值记录
-            record_id = self.db.create_recharge_record(
-                user_id=user_id,
-                amount=final_amount,  # 使用包含赠送的金额
-                tx_hash=tx_hash,
-                payment_address=recharge_info['address']
-            )
+            result = self.db.settle_recharge(tx_hash, user_id)
+        except Exception as e:
+            logger.error(f"[充值] ❌ 结算失败 {tx_hash} (用户 {user_id}): {e}")
+            self.metrics.record_credit_failure()
+            self.db.fail_recharge(tx_hash, user_id, str(e), self.recharge_max_attempts)
+            return False
 
-            # ⭐ 3. 确认充值
-            success = self.db.verify_recharge(record_id)
+        if result is None:
+            return False
 
-            if success:
-                logger.info(f"[充值] ✅ 用户 {user_id} 充值成功: {final_amount:.2f} USDT")
+        self.metrics.observe_credit(result['queued_seconds'])
 
-                # ⭐ 4. 记录邀请码使用
-                if bonus_amount > 0:
-                    self.db.record_invite_code_usage(user_id, original_amount, bonus_amount)
+        if result['bonus_amount'] > 0:
+            logger.info(f"[充值] 💰 用户 {user_id} 使用邀请码优惠")
+            logger.info(f"[充值] 充值: {result['amount']} USDT")
+            logger.info(f"[充值] 赠送: {result['bonus_amount']:.2f} USDT")
+        logger.info(f"[充值] ✅ 用户 {user_id} 充值成功: {result['final_amount']:.2f} USDT")
 
-                # ⭐ 5. 处理邀请奖励 - 给邀请人发奖励
-                has_inviter, inviter_id, reward_amount = self.db.process_invite_reward(
-                    invitee_user_id=user_id,
-                    recharge_amount=original_amount,  # 基于原始充值金额计算
-                    recharge_record_id=record_id
-                )
+        if result['inviter_id']:
+            logger.info(f"[邀请奖励] ✅ 邀请人 {result['inviter_id']} 获得 {result['reward_amount']:.2f} USDT")
 
-                if has_inviter:
-                    logger.info(f"[邀请奖励] ✅ 邀请人 {inviter_id} 获得 {reward_amount:.2f} USDT")
+        # 尝试自动订阅
+        self.auto_subscribe_if_possible(user_id)
+        return True
 
-                # ⭐ 6. 尝试自动订阅
-                self.auto_subscribe_if_possible(user_id)
+    def settle_pending_recharges(self) -> int:
+        """同步结算队列中的全部待处理充值（运维补单用），返回结算成功笔数"""
+        settled = 0
+        while True:
+            jobs = self.db.claim_recharges(self.recharge_batch_size)
+            if not jobs:
+                return settled
+            settled += sum(1 for job in jobs if self.settle_queued_recharge(job['tx_hash'], job['user_id']))
 
-                return True
-            else:
-                logger.error(f"[充值] ❌ 充值确认失败")
-                return False
+    async def recharge_worker(self, worker_id: int):
+        """结算 worker：从队列领取充值并逐笔结算"""
+        loop = asyncio.get_running_loop()
 
-        except Exception as e:
-            logger.error(f"[充值] ❌ 处理充值失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return False
+        while True:
+            try:
+                jobs = await loop.run_in_executor(None, self.db.claim_recharges, self.recharge_batch_size)
+                for job in jobs:
+                    await loop.run_in_executor(None, self.settle_queued_recharge, job['tx_hash'], job['user_id'])
+            except Exception as e:
+                logger.error(f"[ERROR] 结算 worker {worker_id} 异常: {e}")
+                jobs = []
+
+            if not jobs:
+                await asyncio.sleep(self.recharge_poll_interval)
+
+    async def run_recharge_workers(self):
+        """启动 recharge_workers 个结算 worker"""
+        logger.info(f"[INFO] 💳 启动 {self.recharge_workers} 个充值结算 worker")
+        await asyncio.gather(*(self.recharge_worker(i) for i in range(self.recharge_workers)))
+
+    async def scan_addresses(self, scanner: TronGridScanner, addresses: Dict[int, str] = None) -> Dict:
+        """
+        逐地址扫描：只拉取各地址游标之后的转账，入队后推进游标
+
+        Args:
+            addresses: 要扫描的 {user_id: address}，默认全部地址
+
+        Returns:
+            {'scanned': 请求成功的用户, 'active': 有新充值的用户, 'enqueued': 新入队笔数}
+        """
+        loop = asyncio.get_running_loop()
+
+        if addresses is None:
+            addresses = await loop.run_in_executor(None, self.db.get_all_payment_addresses)
+        cursors = await loop.run_in_executor(None, self.db.get_address_cursors, list(addresses.values()))
+
+        results = await scanner.scan(addresses, cursors)
+        matches = {user_id: transfers for user_id, transfers in results.items() if transfers}
+
+        # 入队后即可推进游标，结算由 recharge_worker 完成
+        enqueued, active_users = await self._enqueue_matched_transfers(matches, addresses)
+        await loop.run_in_executor(None, self.db.save_address_cursors, {
+            addresses[user_id]: max(tx['timestamp'] for tx in transfers)
+            for user_id, transfers in matches.items()
+        })
+
+        return {'scanned': set(results), 'active': active_users, 'enqueued': enqueued}
 
     async def monitor_all_users(self):
-        """监控所有用户的充值地址"""
+        """
+        监控所有用户的充值地址
+
+        按 PollScheduler 自适应调度：到期的地址并发扫描（TronGridScanner），
+        根据是否有新充值调整下次轮询时间。
+        """
         logger.info("[INFO] 🔍 开始监控所有用户充值...")
+        loop = asyncio.get_running_loop()
+        scheduler = self.poll_scheduler
+        addresses = {}
+        next_refresh = next_hints = 0.0
+
+        async with TronGridScanner(
+                self.trongrid_url, self.usdt_contract, self.trongrid_api_key,
+                rate_limit=self.trongrid_rate_limit, concurrency=self.trongrid_concurrency,
+                metrics=self.metrics
+        ) as scanner:
+            while True:
+                now = time.time()
+                try:
+                    if now >= next_refresh:
+                        addresses = await loop.run_in_executor(None, self.db.get_all_payment_addresses)
+                        scheduler.sync(addresses, now)
+                        next_refresh = now + self.address_refresh_interval
+
+                    if now >= next_hints:
+                        hints = await loop.run_in_executor(None, self.db.get_address_watch_hints)
+                        scheduler.set_hot(hints, now)
+                        next_hints = now + self.poll_hint_interval
+
+                    self.poll_metrics = scheduler.stats(now)
+                    due = scheduler.pop_due(now)
+
+                    if due:
+                        started = time.monotonic()
+                        outcome = await self.scan_addresses(scanner, {uid: addresses[uid] for uid in due})
+
+                        self.metrics.observe_sweep(time.monotonic() - started, len(outcome['scanned']))
+
+                        finished = time.time()
+                        for user_id in due:
+                            if user_id in outcome['scanned']:
+                                scheduler.complete(user_id, user_id in outcome['active'], finished)
+                            else:
+                                scheduler.retry(user_id, finished)
+
+                        logger.info(
+                            f"[INFO] 扫描 {len(outcome['scanned'])}/{len(due)} 个地址, "
+                            f"新充值 {outcome['enqueued']} 笔, 耗时 {time.monotonic() - started:.1f}s | "
+                            f"队列 {self.poll_metrics['queue_depth']}, 延迟 {self.poll_metrics['scan_lag']:.1f}s"
+                        )
+
+                except Exception as e:
+                    logger.error(f"[ERROR] 监控异常: {e}")
+
+                # 休眠到下一个地址到期或下一次刷新
+                wake_at = min(t for t in (scheduler.next_due(), next_refresh, next_hints) if t is not None)
+                await asyncio.sleep(min(max(0.0, wake_at - time.time()), self.monitor_interval))
+
+    async def _enqueue_matched_transfers(self, matches: Dict[int, List[Dict]],
+                                         addresses: Dict[int, str]) -> Tuple[int, set]:
+        """
+        对扫描到的转账去重并加入结算队列
 
-        while True:
-            try:
-                # 从数据库获取所有地址
-                addresses = self.db.get_all_payment_addresses()
+        Returns:
+            (新入队笔数, 有新充值的用户)
+        """
+        loop = asyncio.get_running_loop()
+        new_recharges = []
+
+        for user_id, transfers in matches.items():
+            new_recharges.extend(await loop.run_in_executor(
+                None, self.find_new_recharges, user_id, addresses[user_id], transfers
+            ))
+
+        for new_recharge in new_recharges:
+            logger.info(f"[INFO] 检测到新充值: 用户 {new_recharge['user_id']}, 金额 {new_recharge['amount']}")
+
+        enqueued = await loop.run_in_executor(None, self.db.enqueue_recharges, new_recharges)
+        self.metrics.record_detected(enqueued)
+        return enqueued, {r['user_id'] for r in new_recharges}
+
+    async def scan_contract_events(self, scanner: TronGridScanner, now_ms: int = None) -> int:
+        """
+        从检查点扫描到当前已确认区块，匹配所有充值地址并加入结算队列
+
+        每个时间窗口入队后立即保存检查点，中途失败或重启时从最后一个完整窗口继续。
+
+        Returns:
+            新入队的充值笔数
+        """
+        loop = asyncio.get_running_loop()
+
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        head = now_ms - self.event_confirm_delay_ms
+
+        checkpoint = await loop.run_in_executor(None, self.db.get_chain_checkpoint, self.event_checkpoint_name)
+        if checkpoint:
+            block_number, cursor = checkpoint['block_number'], checkpoint['block_timestamp']
+        else:
+            block_number, cursor = 0, head - self.event_initial_lookback_ms
+
+        addresses = await loop.run_in_executor(None, self.db.get_all_payment_addresses)
+        watched = {address: user_id for user_id, address in addresses.items()}
+        processed = 0
+        started = time.monotonic()
+
+        while cursor < head:
+            window_end = min(cursor + self.event_window_ms, head)
+
+            events = await scanner.fetch_transfer_events(cursor + 1, window_end)
+            if events is None:
+                logger.warning(f"[WARN] 事件扫描中断，下次从 {cursor} 继续")
+                break
+
+            enqueued, _ = await self._enqueue_matched_transfers(match_transfer_events(events, watched), addresses)
+            processed += enqueued
+
+            if events:
+                block_number = max(block_number, max(e.get('block_number') or 0 for e in events))
+            cursor = window_end
+            await loop.run_in_executor(
+                None, self.db.save_chain_checkpoint, self.event_checkpoint_name, block_number, cursor
+            )
 
-                if addresses:
-                    logger.info(f"[INFO] 监控 {len(addresses)} 个地址")
+        self.metrics.observe_sweep(time.monotonic() - started, len(addresses))
+        return processed
+
+    async def monitor_contract_events(self):
+        """按区块窗口扫描 USDT 合约 Transfer 事件检测充值（请求数与区块数相关，与用户数无关）"""
+        logger.info("[INFO] 🔍 开始扫描 USDT 合约事件...")
+
+        async with TronGridScanner(
+                self.trongrid_url, self.usdt_contract, self.trongrid_api_key,
+                rate_limit=self.trongrid_rate_limit, concurrency=self.trongrid_concurrency,
+                metrics=self.metrics
+        ) as scanner:
+            while True:
+                started = time.monotonic()
+                try:
+                    requests_before = scanner.requests
+                    processed = await self.scan_contract_events(scanner)
+                    logger.info(f"[INFO] 事件扫描完成: 新充值 {processed} 笔, "
+                                f"请求 {scanner.requests - requests_before} 次, "
+                                f"耗时 {time.monotonic() - started:.1f}s")
+                except Exception as e:
+                    logger.error(f"[ERROR] 事件扫描异常: {e}")
+
+                await asyncio.sleep(max(0.0, self.monitor_interval - (time.monotonic() - started)))
+
+    # ========== 订阅过期清理 ==========
+
+    def add_expiry_listener(self, callback):
+        """
+        注册订阅过期监听器
 
-                for user_id, address in addresses.items():
-                    # 监控此用户
-                    new_recharge = self.monitor_user_address(user_id)
+        Args:
+            callback: callback(user_ids: List[int])，在线程池中调用，可执行阻塞操作
+        """
+        self.expiry_listeners.append(callback)
+
+    def sweep_expired_subscriptions(self) -> List[int]:
+        """批量过期到期订阅并通知监听器，返回失去有效订阅的用户"""
+        expired_users = self.db.expire_overdue_subscriptions()
 
-                    if new_recharge:
-                        logger.info(f"[INFO] 检测到新充值: 用户 {user_id}, 金额 {new_recharge['amount']}")
+        if expired_users:
+            for callback in self.expiry_listeners:
+                try:
+                    callback(expired_users)
+                except Exception as e:
+                    logger.error(f"[ERROR] 订阅过期监听器异常: {e}")
 
-                        # 处理充值
-                        if self.process_new_recharge(new_recharge):
-                            logger.info(f"[INFO] 充值处理成功: 用户 {user_id}")
-                            # TODO: 这里可以发送 Telegram 通知
+        return expired_users
 
-                # 等待下一次检查
-                await asyncio.sleep(self.monitor_interval)
+    async def expiry_sweep_loop(self):
+        """
+        定时清理过期订阅
 
+        由 bot 进程启动（过期事件需要停止 Swarm 服务），独立运行的支付监控进程不执行清理，
+        避免订阅在没有监听器的进程中被标记过期而丢失事件。
+        """
+        logger.info("[INFO] ⏰ 订阅过期清理任务启动")
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                expired_users = await loop.run_in_executor(None, self.sweep_expired_subscriptions)
+                if expired_users:
+                    logger.info(f"[INFO] {len(expired_users)} 个用户订阅已过期")
             except Exception as e:
-                logger.error(f"[ERROR] 监控异常: {e}")
-                await asyncio.sleep(self.monitor_interval)
+                logger.error(f"[ERROR] 订阅过期清理异常: {e}")
+
+            await asyncio.sleep(self.expiry_sweep_interval)
 
     async def start(self):
         """启动支付系统"""
         logger.info("[INFO] 💰 支付系统启动中...")
 
+        if self.metrics_port:
+            start_metrics_server(self.metrics, self.metrics_port)
+
         try:
-            await self.monitor_all_users()
+            # 检测只负责入队，结算 worker 独立运行
+            monitor = self.monitor_contract_events() if self.deposit_detection == 'events' else self.monitor_all_users()
+            await asyncio.gather(monitor, self.run_recharge_workers())
         except KeyboardInterrupt:
             logger.info("[INFO] 🛑 支付系统停止")
         except Exception as e:
@@ -409,7 +409,7 @@ class SwarmManager:
             print(f"[INFO] 🌐 节点 IP: {node_ip}")
 
             # 5. 配置目录挂载
-            from docker.types import Mount, Resources, RestartPolicy, EndpointSpec
+            from docker.types import DriverConfig, Mount, Resources, RestartPolicy, EndpointSpec
 
             config_dir = f"{user_dir}/config"
             logs_dir = f"{user_dir}/logs"
@@ -431,6 +431,13 @@ class SwarmManager:
                     target='/freqtrade/custom_database',
                     source=db_dir,
                     type='bind'
+                ),
+                # 节点本地 tmpfs 卷，同一节点的所有容器共享一份趋势缓存
+                Mount(
+                    target='/freqtrade/trend_cache',
+                    source='easymoney_trend_cache',
+                    type='volume',
+                    driver_config=DriverConfig('local', {'type': 'tmpfs', 'device': 'tmpfs'})
                 )
             ]
 
@@ -476,6 +483,7 @@ class SwarmManager:
                     f'GROUP_OFFSET_MINUTES={group_offset_minutes}',
                     f'PROCESS_THROTTLE_SECS={process_throttle_secs}',
 
+                    'TREND_SHARED_CACHE=/freqtrade/trend_cache/trends.bin',
                     'CONFIG_TEMPLATE=/freqtrade/custom_config/config.json',
                     'CONFIG_RUNTIME=/freqtrade/runtime_config.json'
                 ]
@@ -490,6 +498,7 @@ class SwarmManager:
                     f'GROUP_OFFSET_MINUTES={group_offset_minutes}',
                     f'PROCESS_THROTTLE_SECS={process_throttle_secs}'   ,
 
+                    'TREND_SHARED_CACHE=/freqtrade/trend_cache/trends.bin',
                     'CONFIG_TEMPLATE=/freqtrade/custom_config/config.json',
                     'CONFIG_RUNTIME=/freqtrade/runtime_config.json'
                 ]
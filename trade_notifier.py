@@ -12,7 +12,7 @@ from datetime import datetime, timedelta
 from typing import Dict, Set, Optional
 from telegram import Bot
 from freqtrade_api_client import FreqtradeAPIClient
-from database import Database
+from database import AsyncDatabase
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,7 +25,7 @@ class ImprovedTradeNotifier:
         """初始化通知器"""
         self.bot = Bot(token=bot_token)
         self.api_client = FreqtradeAPIClient()
-        self.db = Database()
+        self.db = AsyncDatabase()
 
         # 记录已通知的开仓交易
         self.notified_open_trades: Dict[int, Set[int]] = {}
@@ -305,7 +305,7 @@ class ImprovedTradeNotifier:
 
         while True:
             try:
-                active_users = self.db.get_running_users()
+                active_users = await self.db.get_running_users()
 
                 if not active_users:
                     logger.info("[INFO] 当前没有激活用户")
@@ -4,23 +4,150 @@ trend_client.py - 趋势服务客户端
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional, Dict, Any
+import fcntl
+import json
 import logging
+import mmap
+import os
+import struct
+import threading
+import time
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 
+class SharedTrendCache:
+    """
+    节点内共享的趋势矩阵缓存（内存映射文件）
+
+    同一主机上的所有客户端映射同一个文件：持有文件锁的一个进程负责刷新，
+    其余进程直接读共享内存，不发请求也不走系统调用。写入使用序列锁，
+    读者发现序列号为奇数或前后不一致时重读
+    """
+
+    HEADER = struct.Struct('<8sQQd')  # magic, seq, length, updated_at
+    MAGIC = b'EMTREND1'
+
+    def __init__(self, path: str, size: int = 1 << 20):
+        self.path = path
+        self.size = size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._lock_fd = None
+        # 本进程已解析的版本，序列号不变时直接复用
+        self._seq = None
+        self._data = None
+        self._updated_at = 0.0
+
+    def read(self, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        读取趋势矩阵
+
+        Args:
+            max_age: 最长允许的数据年龄（秒），超过视为无效
+
+        Returns:
+            /api/trends 的响应；没有数据或数据过期时返回 None
+        """
+        for _ in range(10):
+            magic, seq, length, updated_at = self.HEADER.unpack_from(self._mm, 0)
+            if magic != self.MAGIC:
+                return None
+            if seq == self._seq:
+                # 304 只刷新更新时间，不改序列号
+                self._updated_at = updated_at
+                break
+            if seq & 1:
+                time.sleep(0)
+                continue
+            body = self._mm[self.HEADER.size:self.HEADER.size + length]
+            if self.HEADER.unpack_from(self._mm, 0)[1] != seq:
+                continue
+            self._seq, self._data, self._updated_at = seq, json.loads(body), updated_at
+            break
+
+        if self._data is None:
+            return None
+        if max_age is not None and time.time() - self._updated_at > max_age:
+            return None
+        return self._data
+
+    def write(self, data: Dict[str, Any]):
+        """写入趋势矩阵（仅刷新者调用）"""
+        magic, seq, _, _ = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            seq = 0
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(body) > self.size - self.HEADER.size:
+            raise ValueError(f"趋势矩阵 {len(body)} 字节超过共享缓存容量 {self.size}")
+        length = len(body)
+
+        # 奇数序列号表示写入中（上一个刷新者中途退出时可能已是奇数）
+        writing = seq + 1 if seq % 2 == 0 else seq + 2
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, writing, length, 0.0)
+        self._mm[self.HEADER.size:self.HEADER.size + length] = body
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, writing + 1, length, time.time())
+
+    def touch(self):
+        """
+        只刷新更新时间（服务端返回 304 时，仅刷新者调用）
+
+        序列号不变，读者继续使用已解析的数据，不会重新解析
+        """
+        magic, seq, length, _ = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC or seq & 1:
+            return
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, seq, length, time.time())
+
+    def acquire_refresher(self, stop: threading.Event, poll: float = 1.0) -> bool:
+        """
+        等待成为本节点的刷新者；进程退出或 close() 时文件锁释放，由下一个等待者接替
+
+        Returns:
+            成为刷新者返回 True，等待期间 stop 被设置返回 False
+        """
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._lock_fd = fd
+                return True
+            except BlockingIOError:
+                if stop.wait(poll):
+                    os.close(fd)
+                    return False
+
+    def close(self):
+        """释放刷新者文件锁并解除内存映射"""
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        if not self._mm.closed:
+            self._mm.close()
+
+
 class TrendServiceClient:
     """趋势服务客户端"""
 
-    def __init__(self, base_url: str = "http://localhost:5000", timeout: int = 5):
+    def __init__(self, base_url: str = "http://localhost:5000", timeout: int = 5,
+                 shared_cache: Optional[str] = None, shared_refresh_interval: int = 15):
         """
         初始化客户端
 
         Args:
             base_url: 趋势服务的基础 URL
             timeout: 请求超时时间（秒）
+            shared_cache: 节点共享缓存文件路径（默认读 TREND_SHARED_CACHE），为空则不共享
+            shared_refresh_interval: 刷新者轮询 /api/trends 的间隔（秒）
         """
         self.base_url = base_url.rstrip('/')
         self.timeout = timeout
@@ -29,14 +156,54 @@ class TrendServiceClient:
             'timestamp': None,
             'cache_time': None
         }
+        # 趋势矩阵缓存（/api/trends），所有交易对共用一次请求
+        self._matrix_cache = {
+            'data': None,
+            'cache_time': None
+        }
         self._cache_ttl = 300  # 缓存5分钟
 
+        # 长连接复用，避免每次请求重新建立 TCP 连接
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        # 后台刷新：缓存年龄达到 TTL 的 80% 时提前续期；过期后先返回旧值再后台刷新
+        self._refresh_ahead = 0.8
+        self._refresh_kinds = set()  # 被读取过的缓存: 'trend' / 'trends'
+        self._refresh_locks = {'trend': threading.Lock(), 'trends': threading.Lock()}
+        self._refresher = None
+        self._refresher_stop = threading.Event()
+
+        # 推送订阅（/api/trends/stream）；连接断开期间回退到按 TTL 轮询
+        self._stream_thread = None
+        self._stream_stop = threading.Event()
+        self._stream_connected = False
+        self._stream_heartbeat = 15
+
+        # 节点共享缓存：所有客户端读同一块共享内存，只有一个刷新者访问服务
+        shared_cache = shared_cache or os.getenv('TREND_SHARED_CACHE')
+        self._shared = None
+        self._shared_refresh_interval = shared_refresh_interval
+        self._shared_thread = None
+        self._shared_stop = threading.Event()
+        if shared_cache:
+            try:
+                self._shared = SharedTrendCache(shared_cache)
+                self._shared_thread = threading.Thread(target=self._shared_refresh_loop,
+                                                       name='trend-shared-refresh', daemon=True)
+                self._shared_thread.start()
+            except OSError as e:
+                logger.warning(f"共享趋势缓存不可用，使用进程内缓存: {e}")
+                self._shared = None
+
     def _make_request(self, endpoint: str, method: str = 'GET', **kwargs) -> Optional[Dict]:
         """发送HTTP请求"""
         url = f"{self.base_url}{endpoint}"
 
         try:
-            response = requests.request(
+            response = self._session.request(
                 method=method,
                 url=url,
                 timeout=self.timeout,
@@ -59,22 +226,35 @@ class TrendServiceClient:
             logger.error(f"请求异常: {e}")
             return None
 
-    def get_trend(self, use_cache: bool = True) -> Optional[int]:
+    def get_trend(self, use_cache: bool = True, symbol: Optional[str] = None,
+                  timeframe: Optional[str] = None) -> Optional[int]:
         """
         获取当前趋势信号
 
         Args:
             use_cache: 是否使用缓存
+            symbol: 交易对 (如 ETHUSDT)，为空则使用服务的默认交易对
+            timeframe: 周期 (如 4h)，为空则使用服务的默认周期
 
         Returns:
             1 (上涨) 或 -1 (下跌)，失败返回 None
         """
-        # 检查缓存
-        if use_cache and self._is_cache_valid():
-            logger.debug("使用缓存的趋势数据")
+        if symbol is not None or timeframe is not None or self._shared is not None:
+            return self._get_matrix_trend(symbol, timeframe, use_cache)
+
+        # 有缓存时从不阻塞：过期则返回旧值并在后台刷新（stale-while-revalidate）
+        if use_cache:
+            self._keep_fresh('trend')
+        if use_cache and self._cache['trend'] is not None:
+            if not self._is_cache_valid():
+                logger.debug("趋势缓存已过期，返回旧值并后台刷新")
+                self._refresh_async('trend')
             return self._cache['trend']
 
-        # 请求新数据
+        return self._fetch_trend()
+
+    def _fetch_trend(self) -> Optional[int]:
+        """请求 /api/trend 并更新缓存；失败时返回旧缓存"""
         data = self._make_request('/api/trend')
 
         if data and 'trend' in data:
@@ -94,6 +274,238 @@ class TrendServiceClient:
         logger.error("获取趋势失败且无缓存")
         return None
 
+    def get_trends(self, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        获取整个趋势矩阵（一次请求覆盖所有交易对和周期）
+
+        Returns:
+            /api/trends 的响应: {'default', 'symbols', 'timeframes', 'trends', 'last_update'}
+        """
+        if use_cache and self._shared is not None:
+            data = self._shared.read(max_age=self._cache_ttl)
+            if data is not None:
+                return data
+            # 共享缓存还没有数据或刷新者失联：只做一次性回退，不登记后台续期，
+            # 否则每个容器都会常驻轮询服务
+            if self._matrix_cache['data'] is not None:
+                if not self._is_matrix_cache_valid():
+                    self._refresh_async('trends')
+                return self._matrix_cache['data']
+            return self._fetch_trends()
+
+        if use_cache:
+            self._keep_fresh('trends')
+        if use_cache and self._matrix_cache['data'] is not None:
+            if not self._is_matrix_cache_valid():
+                logger.debug("趋势矩阵缓存已过期，返回旧值并后台刷新")
+                self._refresh_async('trends')
+            return self._matrix_cache['data']
+
+        return self._fetch_trends()
+
+    def _fetch_trends(self) -> Optional[Dict[str, Any]]:
+        """请求 /api/trends 并更新缓存；失败时返回旧缓存"""
+        data = self._make_request('/api/trends')
+
+        if data and 'trends' in data:
+            self._matrix_cache['data'] = data
+            self._matrix_cache['cache_time'] = datetime.now()
+            logger.info(f"获取趋势矩阵成功: {len(data['trends'])} 个交易对 (更新时间: {data.get('last_update')})")
+            return data
+
+        if self._matrix_cache['data'] is not None:
+            logger.warning("请求趋势矩阵失败，使用缓存数据")
+            return self._matrix_cache['data']
+
+        logger.error("获取趋势矩阵失败且无缓存")
+        return None
+
+    def _refresh(self, kind: str):
+        """刷新一种缓存；同一时间每种缓存只有一个请求在进行"""
+        lock = self._refresh_locks[kind]
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            if kind == 'trend':
+                self._fetch_trend()
+            else:
+                self._fetch_trends()
+        finally:
+            lock.release()
+
+    def _refresh_async(self, kind: str):
+        if self._refresh_locks[kind].locked():
+            return
+        threading.Thread(target=self._refresh, args=(kind,), name=f'trend-refresh-{kind}', daemon=True).start()
+
+    def _keep_fresh(self, kind: str):
+        """登记需要续期的缓存，并确保后台刷新线程在运行"""
+        self._refresh_kinds.add(kind)
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresher_loop, name='trend-refresher', daemon=True)
+            self._refresher.start()
+
+    def _refresher_loop(self):
+        """在缓存过期前续期（推送连接存活时缓存一直是新的，不会发请求）"""
+        interval = max(1.0, self._cache_ttl * (1 - self._refresh_ahead) / 2)
+        while not self._refresher_stop.wait(interval):
+            for kind in list(self._refresh_kinds):
+                cache_time = (self._cache if kind == 'trend' else self._matrix_cache)['cache_time']
+                if cache_time is None or \
+                        (datetime.now() - cache_time).total_seconds() >= self._cache_ttl * self._refresh_ahead:
+                    self._refresh(kind)
+
+    def _get_matrix_trend(self, symbol: Optional[str], timeframe: Optional[str],
+                          use_cache: bool) -> Optional[int]:
+        """从趋势矩阵中查找；服务未跟踪该交易对时回退到默认趋势"""
+        data = self.get_trends(use_cache=use_cache)
+        if data is None:
+            return None
+
+        default = data.get('default', {})
+        symbol = (symbol or default.get('symbol', '')).upper().replace('/', '')
+        timeframe = timeframe or default.get('timeframe')
+
+        entry = data['trends'].get(symbol, {}).get(timeframe)
+        if entry is None:
+            logger.debug(f"趋势服务未提供 {symbol} {timeframe}，使用默认趋势")
+            entry = data['trends'].get(default.get('symbol'), {}).get(default.get('timeframe'))
+
+        return entry['trend'] if entry else None
+
+    def _shared_refresh_loop(self):
+        """等待成为刷新者，然后按间隔带 ETag 拉取 /api/trends 写入共享缓存，直到 close()"""
+        shared, stop = self._shared, self._shared_stop
+        if not shared.acquire_refresher(stop):
+            return
+        logger.info(f"本进程成为趋势共享缓存刷新者: {shared.path}")
+
+        session = requests.Session()
+        etag = None
+        try:
+            while not stop.is_set():
+                try:
+                    headers = {'If-None-Match': etag} if etag else {}
+                    response = session.get(f"{self.base_url}/api/trends", headers=headers, timeout=self.timeout)
+                    if response.status_code == 304:
+                        shared.touch()
+                    elif response.status_code == 200:
+                        shared.write(response.json())
+                        etag = response.headers.get('ETag')
+                    else:
+                        logger.warning(f"刷新共享缓存失败: {response.status_code}")
+                except Exception as e:
+                    if not stop.is_set():
+                        logger.warning(f"刷新共享缓存异常: {e}")
+                stop.wait(self._shared_refresh_interval)
+        finally:
+            session.close()
+
+    def subscribe(self, heartbeat: int = 15) -> 'TrendServiceClient':
+        """
+        订阅趋势推送
+
+        后台线程保持与 /api/trends/stream 的连接，收到推送时更新缓存；
+        连接正常时缓存始终有效，断开后按 TTL 轮询并自动重连
+
+        Args:
+            heartbeat: 服务端心跳间隔（秒），超过两个心跳没有数据视为断开
+        """
+        if self._stream_thread is not None and self._stream_thread.is_alive():
+            return self
+
+        self._stream_heartbeat = heartbeat
+        # 每次订阅使用新的停止事件，避免旧线程被重新唤醒
+        self._stream_stop = threading.Event()
+        self._stream_thread = threading.Thread(target=self._stream_loop, args=(self._stream_stop,),
+                                               name='trend-stream', daemon=True)
+        self._stream_thread.start()
+        return self
+
+    def unsubscribe(self):
+        """停止推送订阅，恢复轮询"""
+        self._stream_stop.set()
+        self._stream_connected = False
+        self._stream_thread = None
+
+    def _stream_loop(self, stop: threading.Event):
+        """保持推送连接，断开后指数退避重连"""
+        backoff = 1
+        while not stop.is_set():
+            try:
+                with requests.get(f"{self.base_url}/api/trends/stream", stream=True,
+                                  timeout=(self.timeout, self._stream_heartbeat * 2)) as response:
+                    response.raise_for_status()
+                    backoff = 1
+                    self._read_stream(response, stop)
+            except Exception as e:
+                if not stop.is_set():
+                    logger.warning(f"趋势推送连接断开，回退到轮询: {e}")
+
+            self._stream_connected = False
+            stop.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _read_stream(self, response, stop: threading.Event):
+        """解析 SSE 消息并更新缓存"""
+        event, data = None, []
+        response.encoding = 'utf-8'
+        # chunk_size=None: 按服务端发送的分块读取，消息到达即处理
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if stop.is_set():
+                return
+            if line:
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+                elif line.startswith(':'):
+                    # 心跳，连接仍然有效
+                    self._touch_caches()
+                continue
+
+            if data:
+                self._on_stream_event(event, json.loads('\n'.join(data)))
+            event, data = None, []
+
+    def _on_stream_event(self, event: Optional[str], payload: Dict[str, Any]):
+        if event == 'snapshot':
+            self._matrix_cache['data'] = payload
+            default = payload.get('default', {})
+            entry = payload['trends'].get(default.get('symbol'), {}).get(default.get('timeframe'))
+            if entry is not None:
+                self._set_default_cache(entry)
+            self._stream_connected = True
+            self._touch_caches()
+            logger.info(f"趋势推送已连接: {len(payload['trends'])} 个交易对")
+            return
+
+        if event != 'trend' or self._matrix_cache['data'] is None:
+            return
+
+        data = self._matrix_cache['data']
+        symbol, timeframe = payload.pop('symbol'), payload.pop('timeframe')
+        previous = payload.pop('previous', None)
+        data['trends'].setdefault(symbol, {})[timeframe] = payload
+        data['last_update'] = payload.get('last_update')
+        default = data.get('default', {})
+        if (symbol, timeframe) == (default.get('symbol'), default.get('timeframe')):
+            self._set_default_cache(payload)
+        self._touch_caches()
+        logger.info(f"趋势变化推送: {symbol} {timeframe} {previous} -> {payload['trend']}")
+
+    def _set_default_cache(self, entry: Dict[str, Any]):
+        self._cache['trend'] = entry['trend']
+        self._cache['timestamp'] = entry.get('timestamp')
+
+    def _touch_caches(self):
+        """推送连接存活时刷新缓存时间"""
+        now = datetime.now()
+        if self._cache['trend'] is not None:
+            self._cache['cache_time'] = now
+        if self._matrix_cache['data'] is not None:
+            self._matrix_cache['cache_time'] = now
+
     def get_trend_detail(self) -> Optional[Dict[str, Any]]:
         """
         获取详细的趋势信息
@@ -103,17 +515,24 @@ class TrendServiceClient:
         """
         return self._make_request('/api/trend')
 
-    def get_history(self, limit: int = 10) -> Optional[list]:
+    def get_history(self, limit: int = 10, symbol: Optional[str] = None, timeframe: Optional[str] = None,
+                    start: Optional[Any] = None, end: Optional[Any] = None) -> Optional[list]:
         """
         获取历史趋势数据
 
         Args:
             limit: 返回的数据条数
+            symbol: 交易对，为空则使用服务的默认交易对
+            timeframe: 周期，为空则使用服务的默认周期
+            start: 起始时间（毫秒时间戳或 ISO 时间），返回从 start 开始的 limit 条
+            end: 结束时间（不含），返回 end 之前的最后 limit 条
 
         Returns:
             历史数据列表
         """
-        data = self._make_request('/api/trend/history', params={'limit': limit})
+        params = {'limit': limit, 'symbol': symbol, 'tf': timeframe, 'start': start, 'end': end}
+        data = self._make_request('/api/trend/history',
+                                  params={k: v for k, v in params.items() if v is not None})
 
         if data and 'data' in data:
             return data['data']
@@ -137,6 +556,27 @@ class TrendServiceClient:
         elapsed = (datetime.now() - self._cache['cache_time']).total_seconds()
         return elapsed < self._cache_ttl
 
+    def _is_matrix_cache_valid(self) -> bool:
+        """检查趋势矩阵缓存是否有效"""
+        if self._matrix_cache['cache_time'] is None:
+            return False
+
+        elapsed = (datetime.now() - self._matrix_cache['cache_time']).total_seconds()
+        return elapsed < self._cache_ttl
+
+    def close(self):
+        """停止后台线程，关闭连接池，释放共享缓存（刷新者身份交给其他进程）"""
+        self._refresher_stop.set()
+        self.unsubscribe()
+        self._session.close()
+
+        shared, self._shared = self._shared, None
+        if shared is not None:
+            self._shared_stop.set()
+            # 刷新线程可能正在请求中，最多等待一个请求超时
+            self._shared_thread.join(self.timeout + 1)
+            shared.close()
+
     def clear_cache(self):
         """清除缓存"""
         self._cache = {
@@ -144,6 +584,10 @@ class TrendServiceClient:
             'timestamp': None,
             'cache_time': None
         }
+        self._matrix_cache = {
+            'data': None,
+            'cache_time': None
+        }
         logger.info("缓存已清除")
 
 
@@ -159,4 +603,7 @@ def get_trend(service_url: str = "http://localhost:5000") -> Optional[int]:
         1 (上涨) 或 -1 (下跌)，失败返回 None
     """
     client = TrendServiceClient(service_url)
-    return client.get_trend()
\ No newline at end of file
+    try:
+        return client.get_trend()
+    finally:
+        client.close()
\ No newline at end of file
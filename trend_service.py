@@ -1,19 +1,33 @@
 """
 trend_service.py - 趋势数据服务（使用币安原生MACD）
-直接从币安获取 MACD 指标，避免自己计算与币安不一致
+MACD 参数与币安一致；指标状态增量维护，每次更新只拉取新 K 线
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from apscheduler.schedulers.background import BackgroundScheduler
-import ccxt
 import requests
+import numpy as np
 import pandas as pd
+import asyncio
+import hashlib
+import json
 import logging
-from datetime import datetime
-from threading import Lock
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock, Thread
 import os
+import sys
+import time
+from urllib.parse import parse_qs
 
+from candle_store import CandleStore, read_ohlcv_csv
+
+# histogram 绝对阈值，按 BTC 价格标定
 MIN_DIFF_THRESHOLD = float(os.getenv("MIN_DIFF_THRESHOLD", "200"))
+# 未单独配置阈值的交易对使用相对阈值 |hist| / close（BTC 约 10 万时 200 ≈ 0.2%）
+MIN_DIFF_RATIO = float(os.getenv("MIN_DIFF_RATIO", "0.002"))
 
 # 配置日志
 logging.basicConfig(
@@ -33,110 +47,265 @@ app = Flask(__name__)
 EXCHANGE_ID = 'binance'
 SYMBOL = 'BTCUSDT'  # 币安格式不用斜杠
 TIMEFRAME = '1d'
-LOOKBACK = 40
 UPDATE_INTERVAL_HOURS = 8
 
+# 首次启动（本地无 K 线）时拉取的根数（超过 KLINE_LIMIT 时分页），也是重启时回放的根数；EMA 早已收敛
+SEED_CANDLES = int(os.getenv('TREND_SEED_CANDLES', '1000'))
+# 币安 K 线接口单次最多返回 1000 根
+KLINE_LIMIT = 1000
+# 每个 交易对/周期 保留用于 /api/trend/history 的最近记录数
+HISTORY_ROWS = 10
+# /api/trend/history 从本地 K 线存储读取时单次最多返回的行数
+HISTORY_MAX_ROWS = int(os.getenv('TREND_HISTORY_MAX_ROWS', '5000'))
+# 按范围计算历史 MACD 时向前多取的 K 线数，使 EMA 收敛
+HISTORY_WARMUP = 500
+
+
+def _normalize_symbol(symbol):
+    """统一交易对格式: btc/usdt、BTC-USDT、BTC_USDT -> BTCUSDT"""
+    return symbol.upper().replace('/', '').replace('-', '').replace('_', '')
+
+
+def _parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# 趋势矩阵: 交易对 × 周期，逗号分隔；第一个交易对/周期作为 /api/trend 的默认值
+SYMBOLS = [_normalize_symbol(s) for s in _parse_list(os.getenv('TREND_SYMBOLS', SYMBOL))]
+TIMEFRAMES = _parse_list(os.getenv('TREND_TIMEFRAMES', TIMEFRAME))
+
+# 币安 K 线周期（区分大小写: 1m 是分钟、1M 是月）；1s 每秒轮询会触发限频，不支持
+BINANCE_INTERVALS = ('1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h',
+                     '1d', '3d', '1w', '1M')
+_invalid_timeframes = [tf for tf in TIMEFRAMES if tf not in BINANCE_INTERVALS]
+if _invalid_timeframes:
+    raise ValueError(f"TREND_TIMEFRAMES 包含不支持的周期 {_invalid_timeframes}，"
+                     f"可选: {', '.join(BINANCE_INTERVALS)}")
+
+SYMBOL = SYMBOLS[0]
+TIMEFRAME = TIMEFRAMES[0]
+
+# 按交易对的 histogram 绝对阈值: BTCUSDT:200,ETHUSDT:8；未列出的交易对按相对阈值
+TREND_THRESHOLDS = {
+    _normalize_symbol(symbol): float(value)
+    for symbol, value in (item.split(':') for item in _parse_list(
+        os.getenv('TREND_THRESHOLDS', f'BTCUSDT:{MIN_DIFF_THRESHOLD}')))
+}
+
+
+def diff_threshold(symbol, close):
+    """交易对的 histogram 阈值；close 可以是标量或数组（相对阈值逐根计算）"""
+    if symbol in TREND_THRESHOLDS:
+        return TREND_THRESHOLDS[symbol]
+    return MIN_DIFF_RATIO * np.asarray(close, dtype=float)
+
+
+# 并发拉取的线程数（币安 K 线接口按 IP 限频，过大没有意义）
+FETCH_WORKERS = int(os.getenv('TREND_FETCH_WORKERS', '8'))
+
+# 推送通道心跳间隔（秒），客户端据此判断连接是否存活
+STREAM_HEARTBEAT = int(os.getenv('TREND_STREAM_HEARTBEAT', '15'))
+
 # 币安技术指标 API
 BINANCE_API_BASE = "https://api.binance.com"
 
-# 数据存储（线程安全）
-trend_data = {
-    'last_update': None,
-    'trend': None,
-    'macd': None,
-    'signal': None,
-    'diff': None,
-    'timestamp': None,
-    'raw_data': None
-}
+
+def _empty_trend():
+    return {
+        'last_update': None,
+        'trend': None,
+        'macd': None,
+        'signal': None,
+        'diff': None,
+        'timestamp': None,
+        'raw_data': None
+    }
+
+
+# 数据存储（线程安全）: {(symbol, timeframe): trend_data}
+trend_matrix = {(s, tf): _empty_trend() for s in SYMBOLS for tf in TIMEFRAMES}
 data_lock = Lock()
 
+# 本地 K 线存储
+candle_store = CandleStore(os.getenv('TREND_DATA_DIR', 'trend_data'))
 
-def fetch_binance_macd(symbol=SYMBOL, interval='1d', limit=40):
+
+def fetch_klines(symbol, interval, start_time=None, limit=KLINE_LIMIT, end_time=None):
     """
-    从币安直接获取 MACD 数据
+    从币安获取 K 线
 
     参数:
         symbol: 交易对符号 (如 BTCUSDT)
         interval: K线周期 (1m, 5m, 15m, 1h, 4h, 1d, 1w)
-        limit: 获取数量
+        start_time: 起始开盘时间 (ms)，为空则取最近 limit 根
+        limit: 获取数量（不超过 KLINE_LIMIT）
+        end_time: 最晚开盘时间 (ms)，向前翻页时使用
 
-    返回: DataFrame with columns [timestamp, macd, signal, hist]
+    返回: [[open_time, open, high, low, close, volume, close_time, ...], ...]
     """
-    try:
-        # 方法 1: 使用币安 UIKlines API (推荐)
-        url = f"{BINANCE_API_BASE}/api/v3/uiKlines"
-        params = {
-            'symbol': symbol,
-            'interval': interval,
-            'limit': limit
-        }
+    params = {
+        'symbol': symbol,
+        'interval': interval,
+        'limit': limit
+    }
+    if start_time is not None:
+        params['startTime'] = start_time
+    if end_time is not None:
+        params['endTime'] = end_time
+
+    response = requests.get(f"{BINANCE_API_BASE}/api/v3/klines", params=params, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_recent_klines(symbol, interval, count):
+    """获取最近 count 根 K 线；超过单次上限 KLINE_LIMIT 时用 endTime 向前翻页"""
+    pages = []
+    end_time = None
+    while count > 0:
+        limit = min(count, KLINE_LIMIT)
+        page = fetch_klines(symbol, interval, limit=limit, end_time=end_time)
+        if page:
+            pages.append(page)
+        # 不足一页说明已到交易对上市时间
+        if len(page) < limit:
+            break
+        count -= len(page)
+        end_time = int(page[0][0]) - 1
+    return [k for page in reversed(pages) for k in page]
+
+
+class MacdState:
+    """
+    MACD 增量状态
 
-        logger.info(f"正在从币安获取 {symbol} {interval} K线数据...")
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
+    只保存最后的 EMA12/EMA26/Signal，每根新收盘 K 线 O(1) 更新；
+    与 pandas ewm(adjust=False) 的递推完全相同
+    """
 
-        klines = response.json()
+    def __init__(self, fast=12, slow=26, signal=9):
+        self.alpha_fast = 2 / (fast + 1)
+        self.alpha_slow = 2 / (slow + 1)
+        self.alpha_signal = 2 / (signal + 1)
+        self.ema_fast = None
+        self.ema_slow = None
+        self.signal = None
+        self.hist = None        # 最后一根已收盘 K 线的 histogram
+        self.open_time = None   # 最后一根已收盘 K 线的开盘时间 (ms)
+
+    def _step(self, close):
+        if self.ema_fast is None:
+            return close, close, 0.0
+        ema_fast = self.ema_fast + self.alpha_fast * (close - self.ema_fast)
+        ema_slow = self.ema_slow + self.alpha_slow * (close - self.ema_slow)
+        signal = self.signal + self.alpha_signal * (ema_fast - ema_slow - self.signal)
+        return ema_fast, ema_slow, signal
+
+    def peek(self, close):
+        """用未收盘 K 线试算 (macd, signal, hist)，不改变状态"""
+        ema_fast, ema_slow, signal = self._step(close)
+        macd = ema_fast - ema_slow
+        return macd, signal, macd - signal
+
+    def update(self, open_time, close):
+        """推进一根已收盘 K 线，返回 (macd, signal, hist)"""
+        self.ema_fast, self.ema_slow, self.signal = self._step(close)
+        self.open_time = open_time
+        macd = self.ema_fast - self.ema_slow
+        self.hist = macd - self.signal
+        return macd, self.signal, self.hist
+
+
+class TrendState:
+    """单个 交易对/周期 的指标状态和最近记录"""
+
+    def __init__(self, symbol, timeframe):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.macd = MacdState()
+        self.recent = deque(maxlen=HISTORY_ROWS)
+        self.lock = Lock()
+        self.seeded = False
+
+    def _row(self, candle, macd, signal, hist, prev_hist):
+        open_time, open_, high, low, close, volume = candle[:6]
+        diff_change = hist - prev_hist if prev_hist is not None else float('nan')
+        return {
+            'timestamp': datetime.fromtimestamp(int(open_time) / 1000, timezone.utc).replace(tzinfo=None).isoformat(),
+            'open': float(open_),
+            'high': float(high),
+            'low': float(low),
+            'close': float(close),
+            'volume': float(volume),
+            'macd': macd,
+            'signal': signal,
+            'hist': hist,
+            'diff': hist,
+            'diff_change': diff_change,
+            'trend': classify_trend(hist, diff_change, diff_threshold(self.symbol, float(close)))
+        }
 
-        # 解析K线数据
-        df = pd.DataFrame(klines, columns=[
-            'timestamp', 'open', 'high', 'low', 'close', 'volume',
-            'close_time', 'quote_volume', 'trades', 'taker_buy_base',
-            'taker_buy_quote', 'ignore'
-        ])
+    def apply(self, candle):
+        """推进一根已收盘 K 线: (open_time, open, high, low, close, volume)"""
+        prev_hist = self.macd.hist
+        macd, signal, hist = self.macd.update(int(candle[0]), float(candle[4]))
+        row = self._row(candle, macd, signal, hist, prev_hist)
+        self.recent.append(row)
+        return row
 
-        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-        df['close'] = df['close'].astype(float)
+    def preview(self, candle):
+        """未收盘 K 线的试算记录，不改变状态"""
+        macd, signal, hist = self.macd.peek(float(candle[4]))
+        return self._row(candle, macd, signal, hist, self.macd.hist)
 
-        # 获取 MACD 技术指标
-        macd_data = fetch_binance_technical_indicator(symbol, interval, limit)
 
-        if macd_data is not None and len(macd_data) > 0:
-            # 合并 MACD 数据
-            df = df.merge(macd_data, on='timestamp', how='left')
-        else:
-            logger.warning("⚠️ 未能从币安获取MACD，将使用 TA-Lib 计算")
-            df = calculate_macd_fallback(df)
+trend_states = {key: TrendState(*key) for key in trend_matrix}
 
-        return df
 
-    except Exception as e:
-        logger.error(f"❌ 获取币安数据失败: {e}")
-        raise
+def seed_trend_state(state):
+    """启动时从本地 K 线存储回放，恢复指标状态"""
+    candles = candle_store.tail(state.symbol, state.timeframe, SEED_CANDLES)
+    for candle in candles.tolist():
+        state.apply(candle)
+    state.seeded = True
+    if len(candles):
+        logger.info(f"📂 {state.symbol} {state.timeframe} 从本地回放 {len(candles)} 根 K 线")
 
 
-def fetch_binance_technical_indicator(symbol, interval, limit):
+def sync_trend_state(state):
     """
-    方法 2: 使用币安技术指标 API 获取 MACD
+    拉取新 K 线并推进指标状态（正常情况下只有一次请求）
 
-    注意: 币安官方可能没有直接的 MACD API，这里提供备选方案
+    返回: 最新一条记录（未收盘 K 线的试算值，没有则为最后一根已收盘 K 线）
     """
-    try:
-        # 币安没有直接的技术指标API，我们使用第三方或自己计算
-        # 这里使用 ccxt 获取数据后用 TA-Lib 计算（与币安最接近的参数）
-
-        exchange = ccxt.binance()
+    if not state.seeded:
+        seed_trend_state(state)
 
-        # 获取 K线数据
-        ohlcv = exchange.fetch_ohlcv(
-            symbol.replace('USDT', '/USDT'),  # BTCUSDT -> BTC/USDT
-            interval,
-            limit=limit + 26  # 多获取一些数据以计算 MACD
-        )
+    live = None
+    while True:
+        if state.macd.open_time is None:
+            klines = fetch_recent_klines(state.symbol, state.timeframe, SEED_CANDLES)
+        else:
+            klines = fetch_klines(state.symbol, state.timeframe, start_time=state.macd.open_time + 1)
 
-        df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-        df['close'] = df['close'].astype(float)
+        now_ms = int(time.time() * 1000)
+        closed = [k for k in klines if int(k[6]) < now_ms and (
+            state.macd.open_time is None or int(k[0]) > state.macd.open_time)]
+        candle_store.append(state.symbol, state.timeframe, [
+            (int(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])) for k in closed
+        ])
+        for k in closed:
+            state.apply(k)
 
-        # 使用币安相同的 MACD 参数计算
-        df = calculate_binance_style_macd(df)
+        if klines and int(klines[-1][6]) >= now_ms:
+            live = state.preview(klines[-1])
+        # 停机较久时一页追不完，继续翻页
+        if len(klines) < KLINE_LIMIT or live is not None:
+            break
 
-        # 只返回请求的数量
-        return df.tail(limit)[['timestamp', 'macd', 'signal', 'hist']].reset_index(drop=True)
-
-    except Exception as e:
-        logger.error(f"获取技术指标失败: {e}")
-        return None
+    if live is None and not state.recent:
+        raise ValueError("没有可用的 K 线数据")
+    return live or state.recent[-1]
 
 
 def calculate_binance_style_macd(df, fast=12, slow=26, signal=9):
@@ -149,8 +318,6 @@ def calculate_binance_style_macd(df, fast=12, slow=26, signal=9):
     Histogram = MACD Line - Signal Line
     """
     try:
-        import numpy as np
-
         df = df.copy()
         close = df['close'].astype(float)
 
@@ -174,185 +341,942 @@ def calculate_binance_style_macd(df, fast=12, slow=26, signal=9):
         raise
 
 
-def calculate_macd_fallback(df):
-    """备用方案：使用 TA-Lib 计算（如果币安API失败）"""
-    try:
-        import talib
+def classify_trend(diff, diff_change, threshold=MIN_DIFF_THRESHOLD):
+    """根据 histogram 及其变化量判断趋势: 1 上涨, -1 下跌, 0 震荡"""
+    # 如果 diff 太小，认为没有明确趋势
+    if abs(diff) < threshold:
+        return 0
 
-        df = df.copy()
-        df['macd'], df['signal'], df['hist'] = talib.MACD(
-            df['close'].astype(float),
-            fastperiod=12,
-            slowperiod=26,
-            signalperiod=9
-        )
-        return df
-    except ImportError:
-        logger.error("TA-Lib 未安装，无法计算 MACD")
-        raise
+    # diff > 0 且在增长 -> 上涨趋势
+    if diff > 0 and diff_change > 0:
+        return 1
+
+    # diff < 0 且在减小 -> 下跌趋势
+    if diff < 0 and diff_change < 0:
+        return -1
+
+    # 其他情况 -> 震荡
+    return 0
+
+
+def classify_trend_array(diff, diff_change, threshold=MIN_DIFF_THRESHOLD):
+    """
+    classify_trend 的向量化版本，逐元素判断，语义完全相同（NaN 视为震荡）
+
+    参数:
+        diff: histogram 数组（任意形状）
+        diff_change: 与 diff 同形状的变化量数组
+        threshold: 标量，或可广播到 diff 形状的阈值数组
+
+    返回: int64 数组，1 上涨 / -1 下跌 / 0 震荡
+    """
+    diff = np.asarray(diff, dtype=float)
+    diff_change = np.asarray(diff_change, dtype=float)
+    with np.errstate(invalid='ignore'):
+        strong = ~(np.abs(diff) < threshold)
+        up = strong & (diff > 0) & (diff_change > 0)
+        down = strong & (diff < 0) & (diff_change < 0)
+    return np.select([up, down], [1, -1], 0)
+
+
+def classify_trend_matrix(hist, threshold=MIN_DIFF_THRESHOLD):
+    """
+    批量计算多个交易对的趋势
+
+    参数:
+        hist: 二维 histogram 数组，行是交易对、列是按时间排列的 K 线
+        threshold: 标量、每个交易对一行的列向量，或与 hist 同形状的数组
+
+    返回: 同形状的趋势数组；每行第一列没有变化量，按震荡处理
+    """
+    hist = np.asarray(hist, dtype=float)
+    diff_change = np.full_like(hist, np.nan)
+    diff_change[..., 1:] = np.diff(hist, axis=-1)
+    return classify_trend_array(hist, diff_change, threshold)
 
 
-def calculate_trend_from_macd(df):
+def calculate_trend_from_macd(df, threshold=MIN_DIFF_THRESHOLD):
     """根据 MACD histogram 计算趋势"""
     df = df.copy()
     df['diff'] = df['hist']
     df['diff_change'] = df['diff'].diff()
+    df['trend'] = classify_trend_array(df['diff'].to_numpy(), df['diff_change'].to_numpy(), threshold)
+    return df
 
-    def get_trend(row):
-        # 如果 diff 太小，认为没有明确趋势
-        if abs(row['diff']) < MIN_DIFF_THRESHOLD:
-            return 0
 
-        # diff > 0 且在增长 -> 上涨趋势
-        if row['diff'] > 0 and row['diff_change'] > 0:
-            return 1
+def benchmark_trend_classification(rows=1_000_000, symbols=100):
+    """
+    对比逐行 DataFrame.apply 与向量化实现，断言结果完全一致
 
-        # diff < 0 且在减小 -> 下跌趋势
-        if row['diff'] < 0 and row['diff_change'] < 0:
-            return -1
+    数据中刻意包含 NaN、0 和恰好等于阈值的 histogram
+    """
+    rng = np.random.default_rng(7)
+    hist = rng.normal(0, MIN_DIFF_THRESHOLD * 2, rows)
+    hist[rng.random(rows) < 0.01] = np.nan
+    hist[rng.random(rows) < 0.01] = 0.0
+    hist[rng.random(rows) < 0.01] = MIN_DIFF_THRESHOLD
+    hist[rng.random(rows) < 0.01] = -MIN_DIFF_THRESHOLD
+    df = pd.DataFrame({'hist': hist})
+
+    # 原实现：每行一次 Python 调用
+    started = time.perf_counter()
+    expected = df.assign(diff=df['hist'], diff_change=df['hist'].diff())
+    expected = expected.apply(lambda row: classify_trend(row['diff'], row['diff_change']), axis=1)
+    rowwise = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = calculate_trend_from_macd(df)['trend']
+    vectorized = time.perf_counter() - started
+    assert np.array_equal(expected.to_numpy(), actual.to_numpy()), "向量化结果与逐行结果不一致"
+
+    # 批量接口: symbols 行 × (rows / symbols) 列，每行独立计算变化量
+    matrix = hist.reshape(symbols, -1)
+    started = time.perf_counter()
+    batch = classify_trend_matrix(matrix)
+    batched = time.perf_counter() - started
+    for i in range(symbols):
+        row = pd.DataFrame({'hist': matrix[i]})
+        assert np.array_equal(batch[i], calculate_trend_from_macd(row)['trend'].to_numpy()), \
+            f"第 {i} 个交易对批量结果不一致"
+
+    counts = {t: int((actual == t).sum()) for t in (1, 0, -1)}
+    print(f"[INFO] 趋势分类 {rows:,} 行 | 上涨/震荡/下跌: {counts[1]}/{counts[0]}/{counts[-1]}")
+    print(f"[INFO] 逐行 apply: {rowwise:.2f}s | 向量化: {vectorized * 1000:.1f}ms "
+          f"({rowwise / vectorized:.0f}x) | 批量 {symbols}×{rows // symbols}: {batched * 1000:.1f}ms")
+    print("[INFO] ✅ 结果与逐行实现完全一致")
+
+
+def update_symbol_trend(symbol, timeframe):
+    """更新单个 交易对/周期 的趋势数据，返回是否成功"""
+    state = trend_states[(symbol, timeframe)]
+    try:
+        with state.lock:
+            latest = sync_trend_state(state)
+            history = [row for row in state.recent if row['timestamp'] < latest['timestamp']]
+            history = history[-(HISTORY_ROWS - 1):] + [latest]
+
+            entry = {
+                'last_update': datetime.now().isoformat(),
+                'trend': int(latest['trend']),
+                'macd': float(latest['macd']),
+                'signal': float(latest['signal']),
+                'diff': float(latest['hist']),
+                'timestamp': latest['timestamp'],
+                'raw_data': history
+            }
+
+            # 更新全局数据（线程安全），整条替换避免读到一半更新的记录；
+            # 在 state.lock 内写入，同一 交易对/周期 的并发更新按计算顺序落盘
+            with data_lock:
+                trend_matrix[(symbol, timeframe)] = entry
+
+        logger.info(
+            f"✅ {symbol} {timeframe} 趋势: {entry['trend']} | "
+            f"MACD: {entry['macd']:.2f} | Signal: {entry['signal']:.2f} | "
+            f"Histogram: {entry['diff']:.2f}"
+        )
+        return True
 
-        # 其他情况 -> 震荡
-        return 0
+    except Exception as e:
+        logger.error(f"❌ 更新 {symbol} {timeframe} 趋势数据失败: {e}")
+        return False
 
-    df['trend'] = df.apply(get_trend, axis=1)
-    return df
+
+def update_all_trends(timeframes=None):
+    """
+    并发更新趋势矩阵
+
+    参数:
+        timeframes: 只更新这些周期（默认全部），供按周期收盘时间调度使用
+    """
+    timeframes = timeframes or TIMEFRAMES
+    jobs = [(s, tf) for s in SYMBOLS for tf in timeframes]
+    logger.info(f"开始更新趋势数据 - {len(SYMBOLS)} 个交易对 × {timeframes}")
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(jobs))) as pool:
+        results = list(pool.map(lambda job: update_symbol_trend(*job), jobs))
+
+    ok = sum(results)
+    publish_responses()
+    logger.info(f"✅ 趋势矩阵更新完成: {ok}/{len(jobs)} 成功，耗时 {time.monotonic() - started:.1f}s")
+    return ok
 
 
 def update_trend_data():
-    """更新趋势数据"""
-    global trend_data
+    """更新趋势数据（全部交易对和周期）"""
+    try:
+        update_all_trends()
+    except Exception as e:
+        logger.error(f"❌ 更新趋势数据失败: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+def _public_trend(data):
+    """对外返回的单条趋势字段"""
+    return {
+        'trend': data['trend'],
+        'macd': data['macd'],
+        'signal': data['signal'],
+        'diff': data['diff'],
+        'histogram': data['diff'],  # 添加 histogram 别名
+        'timestamp': data['timestamp'],
+        'last_update': data['last_update']
+    }
+
+
+# ==================== 响应构建 ====================
+
+def _trend_payload(key, snapshot):
+    """单个 交易对/周期 的响应: (status, payload)"""
+    data = snapshot[key]
+    if data['trend'] is None:
+        return 503, {
+            'error': 'Data not available yet',
+            'message': 'Please wait for the first update'
+        }
+    return 200, {'symbol': key[0], 'timeframe': key[1], **_public_trend(data)}
+
+
+def _trends_payload(snapshot):
+    """整个趋势矩阵: {symbol: {timeframe: trend | null}}"""
+    trends = {}
+    last_update = None
+    for (symbol, tf), data in snapshot.items():
+        if data['trend'] is None:
+            trends.setdefault(symbol, {})[tf] = None
+            continue
+        trends.setdefault(symbol, {})[tf] = _public_trend(data)
+        last_update = max(last_update or data['last_update'], data['last_update'])
+
+    return {
+        'default': {'symbol': SYMBOL, 'timeframe': TIMEFRAME},
+        'symbols': SYMBOLS,
+        'timeframes': TIMEFRAMES,
+        'trends': trends,
+        'last_update': last_update
+    }
+
+
+def _status_payload(snapshot):
+    default = snapshot[(SYMBOL, TIMEFRAME)]
+    return {
+        'service': 'trend_service',
+        'exchange': EXCHANGE_ID,
+        'symbol': SYMBOL,
+        'timeframe': TIMEFRAME,
+        'symbols': SYMBOLS,
+        'timeframes': TIMEFRAMES,
+        'trends_available': sum(1 for data in snapshot.values() if data['trend'] is not None),
+        'trends_total': len(snapshot),
+        'seed_candles': SEED_CANDLES,
+        'update_interval_hours': UPDATE_INTERVAL_HOURS,
+        'min_diff_threshold': MIN_DIFF_THRESHOLD,
+        'diff_thresholds': {s: TREND_THRESHOLDS.get(s) for s in SYMBOLS},
+        'min_diff_ratio': MIN_DIFF_RATIO,
+        'last_update': default['last_update'],
+        'data_available': default['trend'] is not None,
+        'current_trend': default['trend'],
+        'data_source': 'Binance API + incremental EMA'
+    }
+
+
+def _health_payload():
+    return {
+        'status': 'ok',
+        'service': 'trend_service',
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def _parse_time(value):
+    """毫秒时间戳或 ISO 时间（UTC） -> 毫秒时间戳"""
+    if value is None or value == '':
+        return None
+    if str(value).lstrip('-').isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def history_from_store(symbol, tf, start=None, end=None, limit=HISTORY_ROWS):
+    """
+    从本地 K 线存储计算历史趋势记录（仅已收盘 K 线）
+
+    有 start 时返回从 start 开始的前 limit 条，否则返回 end 之前的最后 limit 条；
+    MACD 从区间前 HISTORY_WARMUP 根 K 线开始递推
+    """
+    candles = candle_store.load(symbol, tf)
+    lo, hi = CandleStore.bounds(candles, start, end)
+    if start is not None:
+        hi = min(hi, lo + limit)
+    else:
+        lo = max(lo, hi - limit)
+    if lo >= hi:
+        return []
+
+    warm_lo = max(0, lo - HISTORY_WARMUP)
+    window = candles[warm_lo:hi]
+    df = calculate_binance_style_macd(pd.DataFrame({'close': window['close']}))
+    df = calculate_trend_from_macd(df, diff_threshold(symbol, window['close'])).iloc[lo - warm_lo:]
+    rows = window[lo - warm_lo:]
+
+    timestamps = pd.to_datetime(rows['open_time'], unit='ms').strftime('%Y-%m-%dT%H:%M:%S')
+    # JSON 不支持 NaN，第一根 K 线没有变化量
+    diff_change = df['diff_change'].astype(object).where(df['diff_change'].notna(), None)
+    return [
+        {
+            'timestamp': ts,
+            'open': float(o), 'high': float(h), 'low': float(l), 'close': float(c), 'volume': float(v),
+            'macd': float(macd), 'signal': float(signal), 'hist': float(hist), 'diff': float(hist),
+            'diff_change': change, 'trend': int(trend)
+        }
+        for ts, o, h, l, c, v, macd, signal, hist, change, trend in zip(
+            timestamps, rows['open'], rows['high'], rows['low'], rows['close'], rows['volume'],
+            df['macd'], df['signal'], df['hist'], diff_change, df['trend'])
+    ]
+
+
+def _history_payload(symbol, tf, limit, start=None, end=None):
+    """
+    历史趋势数据: (status, payload)
+
+    不带时间范围且 limit 不超过内存中的记录数时直接返回内存记录（含未收盘 K 线），
+    否则从本地 K 线存储读取任意范围；未跟踪的 交易对/周期 在访问存储之前返回 404
+    （tf 会拼进存储文件路径，不能直接使用请求参数）
+    """
+    symbol = _normalize_symbol(symbol)
+    if (symbol, tf) not in trend_matrix:
+        return 404, _UNKNOWN_TREND_PAYLOAD
+    try:
+        start, end = _parse_time(start), _parse_time(end)
+    except ValueError:
+        return 400, {'error': 'Invalid start/end, expected ms timestamp or ISO time'}
+
+    with data_lock:
+        data = trend_matrix[(symbol, tf)]
 
+    if start is None and end is None and limit <= HISTORY_ROWS:
+        if data['raw_data'] is None:
+            return 503, {
+                'error': 'Data not available yet'
+            }
+        history = data['raw_data'][-limit:]
+    else:
+        history = history_from_store(symbol, tf, start, end, max(1, min(limit, HISTORY_MAX_ROWS)))
+
+    return 200, {
+        'symbol': symbol,
+        'timeframe': tf,
+        'data': history,
+        'count': len(history),
+        'last_update': data['last_update']
+    }
+
+
+def _force_update_payload():
+    """执行一次全量更新: (status, payload)"""
     try:
-        logger.info(f"开始更新趋势数据 - {SYMBOL}")
+        ok = update_all_trends()
+        with data_lock:
+            default = trend_matrix[(SYMBOL, TIMEFRAME)]
+        return 200, {
+            'message': 'Update triggered successfully',
+            'updated': ok,
+            'total': len(trend_matrix),
+            'last_update': default['last_update'],
+            'current_trend': default['trend']
+        }
+    except Exception as e:
+        return 500, {
+            'error': 'Update failed',
+            'message': str(e)
+        }
+
+
+def _is_authorized(auth_token):
+    expected_token = os.getenv('TREND_SERVICE_TOKEN', 'default_secret_token')
+    return auth_token == f'Bearer {expected_token}'
+
+
+def _encode(payload):
+    """序列化为 JSON 字节，ETag 取内容哈希"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
 
-        # 从币安获取数据和 MACD
-        df = fetch_binance_macd(SYMBOL, TIMEFRAME, LOOKBACK)
+# 预序列化的响应: {path: (status, body, etag)}
+# 数据更新时构建新字典后整体替换引用，请求处理只读、无需加锁
+prebuilt_responses = {}
+# 串行化 publish_responses：各周期的定时任务和 force-update 可能同时发布，
+# 不加锁时读到旧快照的一方可能最后赋值，用旧响应覆盖新响应
+publish_lock = Lock()
 
-        # 计算趋势
-        df = calculate_trend_from_macd(df)
+_UNKNOWN_TREND_PAYLOAD = {
+    'error': 'Unknown symbol or timeframe',
+    'symbols': SYMBOLS,
+    'timeframes': TIMEFRAMES
+}
+_UNKNOWN_TREND = (404, _encode(_UNKNOWN_TREND_PAYLOAD)[0], None)
+
+
+class TrendBroadcaster:
+    """
+    趋势变化推送（SSE）
+
+    记录每个 交易对/周期 上次发布的趋势值，只有 trend 变化时才向订阅者推送；
+    订阅者是一个线程安全的 put 回调（Flask 用 queue.Queue，ASGI 用 call_soon_threadsafe）
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = set()
+        self.trends = {}
+        self.last_updates = {}  # 每个 交易对/周期 已发布的最新 last_update
+        self.seq = 0
+
+    def subscribe(self, put):
+        with self.lock:
+            self.subscribers.add(put)
+
+    def unsubscribe(self, put):
+        with self.lock:
+            self.subscribers.discard(put)
+
+    def publish(self, snapshot):
+        """
+        对比上次发布的趋势值，推送发生变化的条目，返回推送条数
+
+        只应在 publish_responses 中（持有 publish_lock）调用；last_update 早于已发布记录的
+        条目是旧快照，直接忽略，不会把趋势推回旧值
+        """
+        events = []
+        with self.lock:
+            for key, data in snapshot.items():
+                published_at = self.last_updates.get(key)
+                if data['trend'] is None or \
+                        (published_at is not None and data['last_update'] < published_at):
+                    continue
+                self.last_updates[key] = data['last_update']
+                previous = self.trends.get(key)
+                if data['trend'] == previous:
+                    continue
+                self.trends[key] = data['trend']
+                self.seq += 1
+                payload = {'symbol': key[0], 'timeframe': key[1], 'previous': previous, **_public_trend(data)}
+                events.append(_sse_event('trend', payload, self.seq))
+            subscribers = list(self.subscribers)
+
+        for event in events:
+            for put in subscribers:
+                put(event)
+        if events and subscribers:
+            logger.info(f"📣 推送 {len(events)} 个趋势变化给 {len(subscribers)} 个订阅者")
+        return len(events)
+
+
+def _sse_event(event, payload, event_id=None):
+    """格式化一条 SSE 消息"""
+    lines = f'id: {event_id}\n' if event_id is not None else ''
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return f'{lines}event: {event}\ndata: {data}\n\n'.encode('utf-8')
+
+
+_SSE_PING = b': ping\n\n'
+
+broadcaster = TrendBroadcaster()
+
+
+def _stream_snapshot():
+    """新连接的第一条消息: 当前整个趋势矩阵"""
+    with data_lock:
+        snapshot = dict(trend_matrix)
+    return _sse_event('snapshot', _trends_payload(snapshot))
+
+
+def publish_responses():
+    """
+    数据更新后重建所有可缓存端点的响应字节，并推送趋势变化
+
+    整个过程持有 publish_lock：发布依次进行，每次发布都能看到之前所有的矩阵写入
+    """
+    global prebuilt_responses
 
-        # 获取最新数据
-        latest = df.iloc[-1]
+    def build(status, payload):
+        body, etag = _encode(payload)
+        # 只有 200 响应带 ETag，503 不应被客户端缓存
+        return status, body, etag if status == 200 else None
 
-        # 更新全局数据（线程安全）
+    with publish_lock:
         with data_lock:
-            trend_data['last_update'] = datetime.now().isoformat()
-            trend_data['trend'] = int(latest['trend'])
-            trend_data['macd'] = float(latest['macd'])
-            trend_data['signal'] = float(latest['signal'])
-            trend_data['diff'] = float(latest['hist'])
-            trend_data['timestamp'] = latest['timestamp'].isoformat()
-            trend_data['raw_data'] = df.tail(10).to_dict('records')
-
-        logger.info(f"✅ 趋势数据更新成功")
-        logger.info(f"   趋势信号: {trend_data['trend']}")
-        logger.info(f"   MACD: {trend_data['macd']:.2f}")
-        logger.info(f"   Signal: {trend_data['signal']:.2f}")
-        logger.info(f"   Histogram: {trend_data['diff']:.2f}")
+            snapshot = dict(trend_matrix)
 
-    except Exception as e:
-        logger.error(f"❌ 更新趋势数据失败: {e}")
-        import traceback
-        traceback.print_exc()
+        responses = {}
+        for key in snapshot:
+            responses[f'/api/trend/{key[0]}/{key[1]}'] = build(*_trend_payload(key, snapshot))
+        responses['/api/trend'] = responses[f'/api/trend/{SYMBOL}/{TIMEFRAME}']
+        responses['/api/trends'] = build(200, _trends_payload(snapshot))
+        responses['/api/status'] = build(200, _status_payload(snapshot))
+
+        prebuilt_responses = responses
+        broadcaster.publish(snapshot)
+
+
+def lookup_response(path):
+    """按路径查找预构建响应，交易对大小写/分隔符不敏感；未知路径返回 None"""
+    response = prebuilt_responses.get(path)
+    if response is not None:
+        return response
+
+    parts = path.split('/')
+    if len(parts) == 5 and parts[1] == 'api' and parts[2] == 'trend':
+        return prebuilt_responses.get(f'/api/trend/{_normalize_symbol(parts[3])}/{parts[4]}', _UNKNOWN_TREND)
+    return None
+
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 请求头是否命中当前 ETag"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return etag in (tag[2:] if tag.startswith('W/') else tag for tag in candidates)
+
+
+publish_responses()
 
 
 # ==================== API 端点 ====================
 
+def _prebuilt(path):
+    """返回预构建响应，ETag 命中时返回 304"""
+    status, body, etag = lookup_response(path)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    headers = {'ETag': etag} if etag else {}
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
-    return jsonify({
-        'status': 'ok',
-        'service': 'trend_service',
-        'timestamp': datetime.now().isoformat()
-    })
+    return jsonify(_health_payload())
 
 
 @app.route('/api/trend', methods=['GET'])
 def get_trend():
-    """获取当前趋势信号"""
-    with data_lock:
-        if trend_data['trend'] is None:
-            return jsonify({
-                'error': 'Data not available yet',
-                'message': 'Please wait for the first update'
-            }), 503
-
-        return jsonify({
-            'trend': trend_data['trend'],
-            'macd': trend_data['macd'],
-            'signal': trend_data['signal'],
-            'diff': trend_data['diff'],
-            'histogram': trend_data['diff'],  # 添加 histogram 别名
-            'timestamp': trend_data['timestamp'],
-            'last_update': trend_data['last_update']
-        })
+    """获取当前趋势信号（默认交易对和周期）"""
+    return _prebuilt('/api/trend')
+
+
+@app.route('/api/trend/<symbol>/<tf>', methods=['GET'])
+def get_symbol_trend(symbol, tf):
+    """获取指定交易对/周期的趋势信号"""
+    return _prebuilt(f'/api/trend/{symbol}/{tf}')
+
+
+@app.route('/api/trends', methods=['GET'])
+def get_trends():
+    """一次返回整个趋势矩阵: {symbol: {timeframe: trend | null}}"""
+    return _prebuilt('/api/trends')
+
+
+@app.route('/api/trends/stream', methods=['GET'])
+def stream_trends():
+    """SSE 推送: 先发送 snapshot，此后只在趋势值变化时推送 trend 事件"""
+    events = queue.Queue()
+    put = events.put
+    broadcaster.subscribe(put)
+
+    def generate():
+        try:
+            yield _stream_snapshot()
+            while True:
+                try:
+                    yield events.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield _SSE_PING
+        finally:
+            broadcaster.unsubscribe(put)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/trend/history', methods=['GET'])
 def get_trend_history():
     """获取历史趋势数据"""
-    limit = request.args.get('limit', 10, type=int)
-    limit = min(limit, 100)
-
-    with data_lock:
-        if trend_data['raw_data'] is None:
-            return jsonify({
-                'error': 'Data not available yet'
-            }), 503
-
-        history = trend_data['raw_data'][-limit:]
-        return jsonify({
-            'data': history,
-            'count': len(history),
-            'last_update': trend_data['last_update']
-        })
+    status, payload = _history_payload(
+        request.args.get('symbol', SYMBOL),
+        request.args.get('tf', TIMEFRAME),
+        request.args.get('limit', 10, type=int),
+        request.args.get('start'),
+        request.args.get('end')
+    )
+    return jsonify(payload), status
 
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """获取服务状态"""
-    with data_lock:
-        return jsonify({
-            'service': 'trend_service',
-            'exchange': EXCHANGE_ID,
-            'symbol': SYMBOL,
-            'timeframe': TIMEFRAME,
-            'lookback': LOOKBACK,
-            'update_interval_hours': UPDATE_INTERVAL_HOURS,
-            'min_diff_threshold': MIN_DIFF_THRESHOLD,
-            'last_update': trend_data['last_update'],
-            'data_available': trend_data['trend'] is not None,
-            'current_trend': trend_data['trend'],
-            'data_source': 'Binance API + EMA calculation'
-        })
+    return _prebuilt('/api/status')
 
 
 @app.route('/api/force-update', methods=['POST'])
 def force_update():
     """手动触发更新（需要认证）"""
-    auth_token = request.headers.get('Authorization')
-    expected_token = os.getenv('TREND_SERVICE_TOKEN', 'default_secret_token')
-
-    if auth_token != f'Bearer {expected_token}':
+    if not _is_authorized(request.headers.get('Authorization')):
         return jsonify({'error': 'Unauthorized'}), 401
 
+    status, payload = _force_update_payload()
+    return jsonify(payload), status
+
+
+# ==================== ASGI 服务 ====================
+
+_JSON_HEADERS = [(b'content-type', b'application/json')]
+
+
+async def _asgi_send(send, status, body=b'', etag=None):
+    headers = _JSON_HEADERS + [(b'content-length', str(len(body)).encode())]
+    if etag:
+        headers.append((b'etag', etag.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _asgi_stream(receive, send):
+    """ASGI 版 /api/trends/stream；客户端断开时退出"""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def put(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    broadcaster.subscribe(put)
+    disconnected = asyncio.ensure_future(receive())
     try:
-        update_trend_data()
-        return jsonify({
-            'message': 'Update triggered successfully',
-            'last_update': trend_data['last_update'],
-            'current_trend': trend_data['trend']
-        })
-    except Exception as e:
-        return jsonify({
-            'error': 'Update failed',
-            'message': str(e)
-        }), 500
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'body': _stream_snapshot(), 'more_body': True})
+
+        while True:
+            getter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=STREAM_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                if disconnected.result()['type'] == 'http.disconnect':
+                    getter.cancel()
+                    return
+                # 首条 http.request（空请求体），继续等待断开
+                disconnected = asyncio.ensure_future(receive())
+            if getter in done:
+                body = getter.result()
+            else:
+                getter.cancel()
+                if done:
+                    continue
+                body = _SSE_PING
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        broadcaster.unsubscribe(put)
+        disconnected.cancel()
+
+
+async def asgi_app(scope, receive, send):
+    """
+    ASGI 应用（与 Flask 端点相同）
+
+    可缓存端点直接返回 publish_responses 预构建的字节，不加锁、不序列化
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    headers = dict(scope['headers'])
+
+    if method == 'GET':
+        if path == '/health':
+            await _asgi_send(send, 200, _encode(_health_payload())[0])
+            return
+
+        if path == '/api/trends/stream':
+            await _asgi_stream(receive, send)
+            return
+
+        if path == '/api/trend/history':
+            query = parse_qs(scope['query_string'].decode())
+            try:
+                limit = int(query.get('limit', ['10'])[0])
+            except ValueError:
+                limit = 10
+            # 大范围读取和 MACD 计算放到线程里，不阻塞事件循环
+            status, payload = await asyncio.to_thread(
+                _history_payload,
+                query.get('symbol', [SYMBOL])[0], query.get('tf', [TIMEFRAME])[0], limit,
+                query.get('start', [None])[0], query.get('end', [None])[0]
+            )
+            await _asgi_send(send, status, _encode(payload)[0])
+            return
+
+        response = lookup_response(path)
+        if response is not None:
+            status, body, etag = response
+            if etag_matches(headers.get(b'if-none-match', b'').decode(), etag):
+                await _asgi_send(send, 304, etag=etag)
+            else:
+                await _asgi_send(send, status, body, etag)
+            return
+
+    elif method == 'POST' and path == '/api/force-update':
+        if not _is_authorized(headers.get(b'authorization', b'').decode()):
+            await _asgi_send(send, 401, _encode({'error': 'Unauthorized'})[0])
+            return
+        # 拉取 K 线是阻塞 IO，放到线程里执行
+        status, payload = await asyncio.to_thread(_force_update_payload)
+        await _asgi_send(send, status, _encode(payload)[0])
+        return
+
+    await _asgi_send(send, 404, _encode({'error': 'Not found'})[0])
+
+
+def serve(host, port, mode=None):
+    """
+    启动 HTTP 服务
+
+    参数:
+        mode: 'asgi'（uvicorn，默认）或 'flask'（内置开发服务器）；
+              未安装 uvicorn 时回退到 flask
+    """
+    mode = mode or os.getenv('TREND_SERVER', 'asgi')
+    if mode == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            logger.warning("⚠️ 未安装 uvicorn，回退到 Flask 内置服务器")
+            mode = 'flask'
+
+    if mode == 'asgi':
+        logger.info("服务模式: ASGI (uvicorn)")
+        # 趋势数据在进程内存中，只能单进程运行
+        uvicorn.run(asgi_app, host=host, port=port, log_level='warning',
+                    access_log=False, backlog=4096)
+    else:
+        logger.info("服务模式: Flask")
+        app.run(host=host, port=port, debug=False, threaded=True)
+
+
+def _start_bench_server(mode, port):
+    """在后台线程启动服务，返回停止函数"""
+    if mode == 'asgi':
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port, log_level='warning',
+                                               access_log=False, backlog=4096))
+        thread = Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        def stop():
+            server.should_exit = True
+            thread.join()
+        return stop
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    server.socket.listen(4096)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        thread.join()
+    return stop
+
+
+async def _bench_client(port, path, etag, deadline, latencies, statuses):
+    """单个客户端: 尽量复用连接循环请求，服务端关闭连接时重连"""
+    request_bytes = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'.encode()
+    if etag:
+        request_bytes += f'If-None-Match: {etag}\r\n'.encode()
+    request_bytes += b'\r\n'
+
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            started = time.perf_counter()
+            writer.write(request_bytes)
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            headers = dict(line.lower().split(': ', 1) for line in lines[1:] if ': ' in line)
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            latencies.append(time.perf_counter() - started)
+            status = int(lines[0].split()[1])
+            statuses[status] = statuses.get(status, 0) + 1
+
+            if lines[0].startswith('HTTP/1.0') or headers.get('connection') == 'close':
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError):
+            statuses['error'] = statuses.get('error', 0) + 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+
+    if writer is not None:
+        writer.close()
+
+
+def _bench_load(port, path, etag, clients, first, duration, results):
+    """
+    压测客户端进程入口: clients 个客户端（编号从 first 开始，奇数号携带 If-None-Match）
+    持续请求 duration 秒，把 (耗时, 延迟列表, 状态码计数) 放入 results
+    """
+    async def run():
+        latencies, statuses = [], {}
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(
+            _bench_client(port, path, etag if (first + i) % 2 else None, deadline, latencies, statuses)
+            for i in range(clients)
+        ))
+        return latencies, statuses
+
+    started = time.monotonic()
+    latencies, statuses = asyncio.run(run())
+    results.put((time.monotonic() - started, latencies, statuses))
+
+
+def benchmark_serving(mode='asgi', clients=1000, duration=10.0, port=18765, procs=1):
+    """
+    压测 /api/trend: clients 个并发 keep-alive 客户端持续请求 duration 秒
+
+    一半客户端携带 If-None-Match（期望 304），一半每次拉取完整响应。
+    客户端分布在 procs 个独立进程中，不与服务端争用 GIL，测得的是服务端本身的吞吐
+    """
+    import multiprocessing
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # 每个连接在服务端和客户端进程各占一个文件描述符，子进程继承提高后的限制
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with data_lock:
+        for i, key in enumerate(trend_matrix):
+            trend_matrix[key] = {
+                'last_update': datetime.now().isoformat(),
+                'trend': (i % 3) - 1,
+                'macd': 100.0 + i,
+                'signal': 90.0 + i,
+                'diff': 10.0,
+                'timestamp': int(time.time() * 1000),
+                'raw_data': []
+            }
+    publish_responses()
+    etag = lookup_response('/api/trend')[2]
+
+    stop = _start_bench_server(mode, port)
+
+    # spawn 而不是 fork: 服务端线程已在运行，fork 出的子进程可能继承被持有的锁
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    shares = [clients // procs + (1 if i < clients % procs else 0) for i in range(procs)]
+    workers = [
+        ctx.Process(target=_bench_load,
+                    args=(port, '/api/trend', etag, share, sum(shares[:i]), duration, results))
+        for i, share in enumerate(shares)
+    ]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    stop()
+
+    latencies, statuses = [], {}
+    for _, worker_latencies, worker_statuses in outcomes:
+        latencies.extend(worker_latencies)
+        for status, count in worker_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    # 各进程只统计自己的请求窗口，不含进程启动和导入耗时
+    throughput = sum(len(worker_latencies) / elapsed for elapsed, worker_latencies, _ in outcomes)
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    print(f"[INFO] {mode} | {clients} 并发 ({procs} 个客户端进程) | {duration:.0f}s | "
+          f"完成 {len(latencies):,} 个请求")
+    print(f"[INFO] 吞吐: {throughput:,.0f} req/s | p50 {p50:.1f}ms | p99 {p99:.1f}ms")
+    print(f"[INFO] 状态码: {statuses}")
+
+
+# ==================== 离线回填 ====================
+
+def backfill_from_csv(symbol, timeframe, paths):
+    """
+    从 CSV 回填本地 K 线存储（离线执行，无需访问交易所）
+
+    参数:
+        paths: 币安格式的 K 线 CSV 文件列表（如 data.binance.vision 的月度文件）
+    """
+    symbol = _normalize_symbol(symbol)
+    total = 0
+    for path in paths:
+        candles = read_ohlcv_csv(path)
+        total += candle_store.backfill(symbol, timeframe, candles)
+        logger.info(f"📄 {path}: {len(candles)} 根 K 线")
+
+    stored = candle_store.load(symbol, timeframe)
+    if len(stored):
+        first, last = (datetime.fromtimestamp(int(t) / 1000, timezone.utc).date()
+                       for t in (stored['open_time'][0], stored['open_time'][-1]))
+        logger.info(f"✅ {symbol} {timeframe} 新增 {total} 根，共 {len(stored)} 根 ({first} ~ {last})")
+    return total
 
 
 # ==================== 定时任务 ====================
 
+def timeframe_cron(timeframe):
+    """
+    按 K 线收盘时间生成 cron 参数（收盘后稍等片刻再拉取）
+
+    timeframe 已在模块加载时按 BINANCE_INTERVALS 校验。d 忽略倍数：3d K 线按币安的
+    三日滚动边界收盘，cron 无法表达，与日线同样每天刷新（未收盘 K 线的试算值也随之更新）
+    """
+    amount, unit = int(timeframe[:-1]), timeframe[-1]
+    if unit == 'm':
+        return {'minute': f'*/{amount}', 'second': '5'}
+    if unit == 'h':
+        return {'hour': f'*/{amount}', 'minute': '1'}
+    if unit == 'd':
+        # 日线: 每天的固定时间点执行 00:01, 16:01, 18:01
+        return {'hour': '0,16,18', 'minute': '1'}
+    if unit == 'w':
+        return {'day_of_week': 'mon', 'hour': '0', 'minute': '1'}
+    if unit == 'M':
+        return {'day': '1', 'hour': '0', 'minute': '1'}
+    raise ValueError(f"不支持的周期: {timeframe}")
+
+
 def init_scheduler():
     """初始化定时任务"""
     scheduler = BackgroundScheduler()
@@ -361,19 +1285,24 @@ def init_scheduler():
     logger.info("📊 执行首次数据更新...")
     update_trend_data()
 
-    # 在每天的固定时间点执行: 00:01, 16:01, 18:01
-    scheduler.add_job(
-        func=update_trend_data,
-        trigger='cron',
-        hour='0,16,18',
-        minute='1',
-        id='update_trend',
-        name='Update trend data',
-        replace_existing=True
-    )
+    # 每个周期一个任务，在该周期 K 线收盘后更新全部交易对
+    for tf in TIMEFRAMES:
+        cron = timeframe_cron(tf)
+        scheduler.add_job(
+            func=update_all_trends,
+            trigger='cron',
+            args=[[tf]],
+            id=f'update_trend_{tf}',
+            name=f'Update {tf} trend data',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+            **cron
+        )
+        logger.info(f"✅ 定时任务已添加 - {tf}: {cron}")
 
     scheduler.start()
-    logger.info("✅ 定时任务已启动 - 每天 00:01, 16:01, 18:01 执行更新")
+    logger.info(f"✅ 定时任务已启动 - {len(SYMBOLS)} 个交易对 × {len(TIMEFRAMES)} 个周期")
 
     return scheduler
 
@@ -386,6 +1315,7 @@ def main():
     logger.info("趋势数据服务启动中...")
     logger.info(f"数据源: 币安 API")
     logger.info(f"MACD 计算: EMA(12), EMA(26), Signal(9)")
+    logger.info(f"趋势矩阵: {SYMBOLS} × {TIMEFRAMES}")
     logger.info("=" * 60)
 
     # 初始化定时任务
@@ -399,7 +1329,10 @@ def main():
     logger.info(f"API 端点:")
     logger.info(f"  - GET  /health              - 健康检查")
     logger.info(f"  - GET  /api/trend           - 获取当前趋势")
-    logger.info(f"  - GET  /api/trend/history   - 获取历史数据")
+    logger.info(f"  - GET  /api/trend/<s>/<tf>  - 获取指定交易对/周期趋势")
+    logger.info(f"  - GET  /api/trends          - 获取全部趋势矩阵")
+    logger.info(f"  - GET  /api/trends/stream   - 趋势变化推送 (SSE)")
+    logger.info(f"  - GET  /api/trend/history   - 获取历史数据 (?start=&end=&limit=)")
     logger.info(f"  - GET  /api/status          - 获取服务状态")
     logger.info(f"  - POST /api/force-update    - 手动触发更新")
     logger.info("=" * 60)
@@ -411,8 +1344,7 @@ def main():
     logger.info("")
 
     try:
-        # 启动 Flask 应用
-        app.run(host=host, port=port, debug=False, threaded=True)
+        serve(host, port)
     except KeyboardInterrupt:
         logger.info("收到停止信号，正在关闭...")
         scheduler.shutdown()
@@ -420,4 +1352,20 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-classify':
+        benchmark_trend_classification()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'backfill':
+        # python trend_service.py backfill BTCUSDT 1d BTCUSDT-1d-2020-01.csv ...
+        if len(sys.argv) < 5:
+            print("用法: python trend_service.py backfill <symbol> <timeframe> <csv> [csv ...]")
+            sys.exit(1)
+        backfill_from_csv(sys.argv[2], sys.argv[3], sys.argv[4:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench-serve':
+        # python trend_service.py bench-serve [asgi|flask] [clients] [客户端进程数]
+        benchmark_serving(
+            mode=sys.argv[2] if len(sys.argv) > 2 else 'asgi',
+            clients=int(sys.argv[3]) if len(sys.argv) > 3 else 1000,
+            procs=int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        )
+    else:
+        main()
\ No newline at end of file
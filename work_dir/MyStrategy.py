@@ -603,6 +603,12 @@ class MyStrategy(IStrategy):
 
             if self.trend_client.health_check():
                 print(f"[INFO] ✅ 趋势服务连接成功: {trend_service_url}")
+                # 订阅趋势推送，趋势变化即时更新缓存；断开时自动回退到轮询
+                # 启用节点共享缓存时由刷新者统一访问服务，不再每个容器各自订阅
+                if os.getenv('TREND_SERVICE_PUSH', '1') == '1' and not os.getenv('TREND_SHARED_CACHE'):
+                    self.trend_client.subscribe()
+                # 预热缓存，之后 populate_indicators 中的 get_trend 只读缓存、由后台线程续期
+                self.trend_client.get_trends()
             else:
                 print(f"[WARN] ⚠️  趋势服务连接失败: {trend_service_url}")
                 print(f"[WARN] 策略将使用默认趋势值 1")
@@ -828,7 +834,8 @@ class MyStrategy(IStrategy):
         trend_direction = 1
         if self.trend_client:
             try:
-                trend_direction = self.trend_client.get_trend(use_cache=True)
+                # 所有交易对共用一次 /api/trends 请求；服务未跟踪的币种回退到默认趋势
+                trend_direction = self.trend_client.get_trend(use_cache=True, symbol=f'{tar}USDT')
                 if trend_direction is None:
                     print(f'[WARN] {tar} 趋势服务返回 None，使用默认值 1')
                     trend_direction = 1